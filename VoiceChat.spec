@@ -32,6 +32,7 @@ a = Analysis(
         'opuslib.classes',
         'opuslib.exceptions',
         'pyogg',
+        'numpy',
         'client',
         'client.protocol',
         'client.config',
@@ -39,8 +40,14 @@ a = Analysis(
         'client.network.text_client',
         'client.network.voice_client',
         'client.audio',
+        'client.audio.bitrate',
+        'client.audio.capture',
+        'client.audio.dsp',
         'client.audio.engine',
         'client.audio.opus_codec',
+        'client.audio.playback',
+        'client.audio.vad',
+        'client.audio.processing',
         'client.audio.voice_modes',
         'client.ui',
         'client.ui.theme',
@@ -66,7 +73,6 @@ a = Analysis(
         'PyQt5.QtQuick',
         'PyQt5.QtQml',
         'matplotlib',
-        'numpy',
         'scipy',
         'pandas',
         'tkinter',
@@ -0,0 +1,145 @@
+"""
+Client PCM DSP: the old per-sample struct loops vs each client.audio.dsp backend.
+
+Runs on synthetic 20 ms frames (48 kHz mono, 16-bit), no audio device
+needed. For every operation reports microseconds per call and the share of
+the 20 ms frame budget, and checks each backend against the pure-Python one
+(largest sample difference, which should be at most 1 from rounding).
+
+    rms    level of one captured frame (calc_rms)
+    peak   largest absolute sample
+    gain   per-user volume x0.7 on a loud frame, with clipping (apply_volume)
+    mix    --speakers frames summed with gains, clipped once (playback mixer)
+
+    python -m benchmarks.bench_dsp --speakers 5 --iterations 2000
+"""
+
+import argparse
+import array
+import math
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.audio import dsp
+
+SAMPLE_RATE = 48000
+FRAME_SIZE = 960
+FRAME_BYTES = FRAME_SIZE * 2
+FRAME_US = FRAME_SIZE / SAMPLE_RATE * 1e6
+
+
+def legacy_rms(data):
+    """AudioEngine.calc_rms before the dsp module."""
+    count = len(data) // 2
+    if count == 0:
+        return 0
+    total = 0
+    for i in range(0, len(data) - 1, 2):
+        sample = struct.unpack('<h', data[i:i + 2])[0]
+        total += sample * sample
+    return (total / count) ** 0.5
+
+
+def legacy_peak(data):
+    return max(abs(struct.unpack('<h', data[i:i + 2])[0]) for i in range(0, len(data) - 1, 2))
+
+
+def legacy_gain(audio_data, vol):
+    """AudioEngine.apply_volume before the dsp module."""
+    adjusted = bytearray()
+    for i in range(0, len(audio_data) - 1, 2):
+        sample = struct.unpack('<h', audio_data[i:i + 2])[0]
+        sample = int(sample * vol)
+        sample = max(-32768, min(32767, sample))
+        adjusted.extend(struct.pack('<h', sample))
+    return bytes(adjusted)
+
+
+def legacy_mix(frames, size):
+    """apply_volume per sender, then samples summed with clipping."""
+    acc = [0] * (size // 2)
+    for pcm, gain in frames:
+        pcm = legacy_gain(pcm, gain)
+        for i in range(0, len(pcm) - 1, 2):
+            acc[i // 2] += struct.unpack('<h', pcm[i:i + 2])[0]
+    return b''.join(struct.pack('<h', max(-32768, min(32767, v))) for v in acc)
+
+
+class Legacy:
+    name = "legacy"
+    rms = staticmethod(legacy_rms)
+    peak = staticmethod(legacy_peak)
+    apply_gain = staticmethod(legacy_gain)
+    mix = staticmethod(legacy_mix)
+
+
+def voice_frame(rng, freq, amplitude):
+    """20 ms of a tone plus noise, little-endian 16-bit."""
+    phase = rng.random() * 2 * math.pi
+    samples = array.array('h', (
+        max(-32768, min(32767, int(amplitude * math.sin(phase + 2 * math.pi * freq * i / SAMPLE_RATE)
+                                   + rng.gauss(0, amplitude / 20))))
+        for i in range(FRAME_SIZE)
+    ))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def max_diff(a, b):
+    if isinstance(a, (int, float)):
+        return abs(a - b)
+    x, y = array.array('h', a), array.array('h', b)
+    if len(x) != len(y):
+        return float('inf')
+    return max(abs(p - q) for p, q in zip(x, y))
+
+
+def timed(fn, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--speakers", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    quiet = voice_frame(rng, 220, 3000)
+    loud = voice_frame(rng, 330, 30000)
+    frames = [(voice_frame(rng, 110 * (s + 2), 12000), 0.5 + 0.25 * s) for s in range(args.speakers)]
+    ops = {
+        "rms": lambda impl: impl.rms(quiet),
+        "peak": lambda impl: impl.peak(loud),
+        "gain": lambda impl: impl.apply_gain(loud, 0.7),
+        "mix": lambda impl: impl.mix(frames, FRAME_BYTES),
+    }
+    impls = [Legacy] + list(dsp.BACKENDS.values())
+    print(f"backends: {', '.join(dsp.BACKENDS)} (in use: {dsp.BACKEND.name}); "
+          f"{args.speakers} speakers in mix, {args.iterations} iterations")
+    header = f"{'op':<5} {'impl':<8} {'us/call':>9} {'% of 20 ms':>10} {'speedup':>8} {'max diff':>9}"
+    print(header)
+    print("-" * len(header))
+    for op, call in ops.items():
+        reference = call(dsp.PythonDSP)
+        base = None
+        for impl in impls:
+            iterations = max(10, args.iterations // 20) if impl is Legacy else args.iterations
+            us = timed(lambda: call(impl), iterations)
+            base = base or us
+            diff = max_diff(call(impl), reference)
+            print(f"{op:<5} {impl.name:<8} {us:>9.1f} {us / FRAME_US:>10.2%} {base / us:>7.1f}x {diff:>9.3g}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Voice bandwidth per user with Opus VBR, DTX and talk spurt ends.
+
+Speech with pauses is sent through the client's send path: the capture gate
+(voice activation at the default noise gate and threshold, or push-to-talk
+held throughout), then the Opus encoder in one of three setups:
+
+    before    constrained VBR, no DTX: what was sent before (every gated
+              frame a full packet)
+    vbr       unconstrained VBR
+    vbr+dtx   unconstrained VBR and DTX: frames the encoder marks as DTX
+              aren't sent, and each talk spurt closes with a spurt end
+
+For each, per user:
+    pkts/s       voice packets sent per second (spurt ends included)
+    ends         talk spurt ends sent
+    kbit/s       audio payload bitrate
+    wire kbit/s  the same on UDP/IPv4 with every header counted
+    saved %      wire bitrate saved against "before" with the same gate
+
+The input is 48 kHz mono 16-bit WAV files (--wav), recorded speech with
+pauses; without any, two synthetic recordings are made (voiced talk spurts,
+pauses with room noise, and the same with breathing and keyboard clicks in
+the pauses). --write DIR saves those as WAV fixtures. Needs opuslib and
+libopus.
+
+    python -m benchmarks.bench_dtx --wav talk.wav --seconds 60
+"""
+
+import argparse
+import array
+import math
+import os
+import random
+import sys
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.audio import dsp
+from client.audio.opus_codec import (
+    OPUS_AVAILABLE, CODEC_ID_OPUS, FRAME_SIZE, SAMPLE_RATE, OpusCodec, is_dtx,
+    build_compact_voice_frame,
+)
+from client.protocol import UDP_HEADER
+
+IP_UDP_HEADERS = 28
+# Client defaults (config.py): audio.noise_gate, audio.va_threshold
+NOISE_GATE = 200
+VA_THRESHOLD = 500
+SETUPS = ("before", "vbr", "vbr+dtx")
+
+
+def synthetic_talk(seconds, seed, clutter):
+    """16-bit PCM of talk spurts and pauses; clutter adds breaths and key clicks to the pauses."""
+    rng = random.Random(seed)
+    total = int(seconds * SAMPLE_RATE)
+    out = array.array('h')
+    phase = 0.0
+    while len(out) < total:
+        # A talk spurt: voiced syllables on a gliding pitch
+        length = int(rng.uniform(0.6, 2.5) * SAMPLE_RATE)
+        base = rng.uniform(110, 220)
+        for i in range(length):
+            t = i / SAMPLE_RATE
+            pitch = base * (1 + 0.15 * math.sin(2 * math.pi * 0.8 * t))
+            phase += 2 * math.pi * pitch / SAMPLE_RATE
+            # Syllables at 4.5 a second, faded in and out over 100 ms
+            envelope = (max(0.0, math.sin(math.pi * 4.5 * t)) ** 0.5
+                        * min(1.0, 10 * t, 10 * (length / SAMPLE_RATE - t)))
+            value = sum(math.sin(k * phase) / k for k in range(1, 8))
+            out.append(int(5000 * envelope * value + rng.gauss(0, 60)))
+        # A pause: room noise, maybe a breath and some key clicks
+        length = int(rng.uniform(0.4, 2.0) * SAMPLE_RATE)
+        pause = [rng.gauss(0, 60) for _ in range(length)]
+        if clutter:
+            start = rng.randrange(length // 2)
+            breath = int(0.4 * SAMPLE_RATE)
+            for i in range(min(breath, length - start)):
+                pause[start + i] += rng.gauss(0, 700) * math.sin(math.pi * i / breath)
+            for _ in range(rng.randrange(4)):
+                at = rng.randrange(length)
+                for i in range(min(480, length - at)):
+                    pause[at + i] += rng.gauss(0, 4000) * math.exp(-i / 60)
+        out.extend(max(-32768, min(32767, int(v))) for v in pause)
+    del out[total:]
+    if sys.byteorder == 'big':
+        out.byteswap()
+    return out.tobytes()
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2 or wav.getframerate() != SAMPLE_RATE:
+            sys.exit(f"{path}: need 48 kHz mono 16-bit PCM")
+        return wav.readframes(wav.getnframes())
+
+
+def write_wav(path, pcm):
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(pcm)
+
+
+def make_codec(setup):
+    codec = OpusCodec(dtx=(setup == "vbr+dtx"))
+    if setup == "before":
+        codec.pending["vbr_constraint"] = 1  # libopus's default
+    return codec
+
+
+def send(pcm, setup, gate):
+    """(packets, spurt ends, payload bytes, wire bytes) for pcm sent as the client would."""
+    codec = make_codec(setup)
+    packets = ends = payload = wire = 0
+    talking = False
+    for start in range(0, len(pcm) - FRAME_SIZE * 2 + 1, FRAME_SIZE * 2):
+        frame = pcm[start:start + FRAME_SIZE * 2]
+        rms = dsp.rms(frame)
+        body = None
+        if rms > gate:
+            codec_id, data = codec.encode(frame)
+            if codec_id != CODEC_ID_OPUS:
+                sys.exit("Opus encoder failed to initialise")
+            if not is_dtx(codec_id, data):
+                body = data
+        if body is not None:
+            talking = True
+        elif talking and setup == "vbr+dtx":
+            talking = False
+            ends += 1
+        else:
+            continue
+        packets += 1
+        payload += len(body or b'')
+        # A compact frame with its level byte, without the TCP length prefix
+        wire += IP_UDP_HEADERS + UDP_HEADER.size + len(build_compact_voice_frame(0, 0, body or b'', 0)) - 4
+    return packets, ends, payload, wire
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--wav", nargs="+", default=[], help="48 kHz mono 16-bit recordings")
+    parser.add_argument("--seconds", type=float, default=30.0, help="length of the synthetic recordings")
+    parser.add_argument("--write", metavar="DIR", help="save the synthetic recordings as WAV")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not OPUS_AVAILABLE:
+        sys.exit("opuslib / libopus not available: nothing to measure")
+    if args.wav:
+        fixtures = [(os.path.basename(path), read_wav(path)) for path in args.wav]
+    else:
+        fixtures = [("talk", synthetic_talk(args.seconds, args.seed, False)),
+                    ("talk+clutter", synthetic_talk(args.seconds, args.seed, True))]
+        if args.write:
+            os.makedirs(args.write, exist_ok=True)
+            for name, pcm in fixtures:
+                write_wav(os.path.join(args.write, name + ".wav"), pcm)
+
+    header = (f"{'recording':<14} {'gate':<4} {'setup':<8} {'pkts/s':>6} {'ends':>5} "
+              f"{'kbit/s':>7} {'wire kbit/s':>11} {'saved %':>7}")
+    print(header)
+    print("-" * len(header))
+    for name, pcm in fixtures:
+        seconds = len(pcm) / 2 / SAMPLE_RATE
+        for gate_name, gate in (("va", max(NOISE_GATE, VA_THRESHOLD)), ("ptt", -1)):
+            baseline = None
+            for setup in SETUPS:
+                packets, ends, payload, wire = send(pcm, setup, gate)
+                wire_kbps = wire * 8 / seconds / 1000
+                baseline = baseline or wire_kbps
+                saved = 100 * (1 - wire_kbps / baseline) if baseline else 0.0
+                print(f"{name:<14} {gate_name:<4} {setup:<8} {packets / seconds:>6.1f} {ends:>5} "
+                      f"{payload * 8 / seconds / 1000:>7.1f} {wire_kbps:>11.1f} {saved:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Echo cancellation offline: ERLE of processing.EchoCanceller on echo-path
+recordings.
+
+Each case is a far-end recording (what the speakers play) and a microphone
+recording of its echo, with near-end talk over it in places. The far end
+goes through EchoCanceller.played and the microphone through process() in
+20 ms frames, reference first as the output thread runs ahead of capture;
+the echo path's delay stands in for the device latencies.
+
+    ERLE dB   echo return loss enhancement: microphone over output power,
+              in frames where only the far end talks (far-end RMS over
+              FAR_ACTIVE, no near-end label), over
+                0-2s    the first 2 s
+                2-6s    2 to 6 s (still converging)
+                settled 6 s to the first near-end talk
+                after   once near-end talk has begun (double talk
+                        disturbs the filter)
+    dt dB     the same over double talk frames, as echo over what the
+              output holds besides the near-end speech and noise
+              (synthetic cases only: needs them separately)
+    near dB   level of the near-end speech and noise in the output over
+              double talk frames, against the microphone (the projection
+              on them; 0 is all kept, synthetic cases only)
+    >gate %   share of far-end-only frames (after the first 2 s) whose
+              output RMS is still over the client's default noise gate
+              (NOISE_GATE) ...
+    >va %     ... and over its default voice activation threshold
+              (VA_THRESHOLD): echo that would be sent
+    us/frame  mean and worst time per frame (capture budget: 20 000)
+
+The output is compared with the microphone one block (HOP) back, the
+postfilter's delay. Exits with status 1 if a case's settled ERLE is under
+--min-erle (MIN_ERLE dB).
+
+Recordings are 48 kHz mono 16-bit WAV: --far FAR.wav --mic MIC.wav, with
+near-end talk labelled in an Audacity label file next to MIC (same name,
+.txt: "start<TAB>end[<TAB>text]" per spurt; none if missing). Without
+them, synthetic cases are made: one far-end talker, echoed through an
+exponentially decaying random impulse response for a desk (speakers a
+metre away), a laptop (0 dB coupling) and a large room (long tail), with a
+near-end talker in the second half and microphone hiss. --write DIR saves
+them as far.wav and <case>-mic.wav with labels. Needs NumPy.
+
+    python -m benchmarks.bench_echo --far far.wav --mic mic.wav
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.audio.opus_codec import FRAME_SIZE, SAMPLE_RATE
+from client.audio.processing import HOP, NUMPY_AVAILABLE, EchoCanceller
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FRAME_BYTES = FRAME_SIZE * 2
+FAR_ACTIVE = 300       # far-end frame RMS above which it counts as talking
+MIC_NOISE = 20         # microphone hiss RMS in the synthetic cases
+NOISE_GATE = 200       # the client's default noise gate (frame RMS) ...
+VA_THRESHOLD = 500     # ... and voice activation threshold
+MIN_ERLE = 20.0        # settled ERLE (dB) a case must reach
+# (name, echo path delay ms, decay to -60 dB ms, echo gain)
+PATHS = (
+    ("desk", 40, 100, 0.3),
+    ("laptop", 30, 150, 1.0),
+    ("room", 80, 250, 0.5),
+)
+
+
+def talker(seconds, seed, peak, start=0.0):
+    """(float samples, bool talking per sample) of voiced talk spurts from start on."""
+    rng = random.Random(seed)
+    noise = numpy.random.default_rng(seed)
+    total = int(seconds * SAMPLE_RATE)
+    signal = numpy.zeros(total)
+    talking = numpy.zeros(total, dtype=bool)
+    pos = int((start + rng.uniform(0.3, 1.0)) * SAMPLE_RATE)
+    phase = 0.0
+    while pos < total:
+        length = min(int(rng.uniform(0.8, 2.5) * SAMPLE_RATE), total - pos)
+        base = rng.uniform(100, 220)
+        t = numpy.arange(length) / SAMPLE_RATE
+        pitch = base * (1 + 0.15 * numpy.sin(2 * numpy.pi * 0.8 * t))
+        phases = phase + numpy.cumsum(2 * numpy.pi * pitch / SAMPLE_RATE)
+        phase = phases[-1]
+        envelope = ((0.15 + 0.85 * numpy.maximum(0.0, numpy.sin(numpy.pi * 4 * t)) ** 0.7)
+                    * numpy.minimum(1.0, numpy.minimum(10 * t, 10 * (length / SAMPLE_RATE - t))))
+        # Harmonics up to 4 kHz falling 6 dB an octave, and some breath
+        value = sum(numpy.sin(k * phases) / k for k in range(1, int(4000 / base) + 1))
+        value += noise.normal(0, 0.08, length)
+        signal[pos:pos + length] = peak / 2.6 * envelope * value
+        talking[pos:pos + length] = True
+        pos += length + int(rng.uniform(0.5, 2.0) * SAMPLE_RATE)
+    return signal, talking
+
+
+def impulse_response(delay_ms, decay_ms, gain, seed):
+    rng = numpy.random.default_rng(seed)
+    delay = int(delay_ms * SAMPLE_RATE / 1000)
+    length = int(decay_ms * SAMPLE_RATE / 1000)
+    taps = numpy.zeros(delay + length)
+    taps[delay:] = rng.normal(0, 1, length) * numpy.exp(-6.9 * numpy.arange(length) / length)
+    return taps * gain / numpy.sqrt(taps.dot(taps))
+
+
+def pcm(values):
+    return numpy.clip(values, -32768, 32767).astype('<i2').tobytes()
+
+
+def samples(data):
+    return numpy.frombuffer(data, dtype='<i2').astype(numpy.float64)
+
+
+def labels_mask(labels, count):
+    mask = numpy.zeros(count, dtype=bool)
+    for start, end in labels:
+        mask[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)] = True
+    return mask
+
+
+def spans(mask):
+    """[(start, end)] seconds of the runs of True in mask."""
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], mask.astype(numpy.int8), [0]))))
+    return [(a / SAMPLE_RATE, b / SAMPLE_RATE) for a, b in zip(edges[::2], edges[1::2])]
+
+
+def synthetic(seconds, seed):
+    """far PCM and [(case, mic PCM, near-end labels, (echo, near + noise))]."""
+    far, _ = talker(seconds, seed, 6000)
+    far += numpy.random.default_rng(seed + 1).normal(0, 20, far.size)  # the far end's own room
+    near, near_talking = talker(seconds, seed + 2, 4000, start=seconds / 2)
+    cases = []
+    for i, (name, delay, decay, gain) in enumerate(PATHS):
+        echo = numpy.convolve(far, impulse_response(delay, decay, gain, seed + 3 + i))[:far.size]
+        rest = near + numpy.random.default_rng(seed + 10 + i).normal(0, MIC_NOISE, far.size)
+        cases.append((name, pcm(echo + rest), spans(near_talking), (echo, rest)))
+    return pcm(far), cases
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2 or wav.getframerate() != SAMPLE_RATE:
+            sys.exit(f"{path}: need 48 kHz mono 16-bit PCM")
+        return wav.readframes(wav.getnframes())
+
+
+def write_wav(path, data):
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(data)
+
+
+def read_labels(path):
+    labels = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.split("\t")
+                if len(fields) >= 2 and fields[0].strip():
+                    labels.append((float(fields[0]), float(fields[1])))
+    return labels
+
+
+def cancel(far, mic):
+    """(output PCM, [seconds per frame]) of mic through a fresh EchoCanceller."""
+    canceller = EchoCanceller()
+    out = []
+    spent = []
+    for start in range(0, min(len(far), len(mic)) - FRAME_BYTES + 1, FRAME_BYTES):
+        t0 = time.perf_counter()
+        canceller.played(far[start:start + FRAME_BYTES])
+        out.append(canceller.process(mic[start:start + FRAME_BYTES]))
+        spent.append(time.perf_counter() - t0)
+    return b''.join(out), spent
+
+
+def erle(mic, out, mask):
+    if mask.sum() < SAMPLE_RATE // 10:
+        return float('nan')
+    return 10 * numpy.log10(mic[mask].dot(mic[mask]) / max(out[mask].dot(out[mask]), 1.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--far", help="far-end recording (what the speakers played)")
+    parser.add_argument("--mic", nargs="+", default=[], help="microphone recordings of its echo")
+    parser.add_argument("--seconds", type=float, default=30.0, help="length of the synthetic cases")
+    parser.add_argument("--write", metavar="DIR", help="save the synthetic cases as WAV with labels")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--min-erle", type=float, default=MIN_ERLE,
+                        help="settled ERLE (dB) below which the run fails")
+    args = parser.parse_args()
+
+    if not NUMPY_AVAILABLE:
+        sys.exit("NumPy not available: the echo canceller needs it")
+    if args.far:
+        far = read_wav(args.far)
+        cases = [(os.path.basename(path), read_wav(path), read_labels(os.path.splitext(path)[0] + ".txt"), None)
+                 for path in args.mic]
+    else:
+        far, cases = synthetic(args.seconds, args.seed)
+        if args.write:
+            os.makedirs(args.write, exist_ok=True)
+            write_wav(os.path.join(args.write, "far.wav"), far)
+            for name, mic, labels, _ in cases:
+                write_wav(os.path.join(args.write, name + "-mic.wav"), mic)
+                with open(os.path.join(args.write, name + "-mic.txt"), 'w', encoding='utf-8') as f:
+                    for start, end in labels:
+                        f.write(f"{start:.3f}\t{end:.3f}\tnear\n")
+
+    header = (f"{'case':<12} {'0-2s':>6} {'2-6s':>6} {'settled':>8} {'after':>6} {'dt dB':>6} {'near dB':>8} "
+              f"{'>gate %':>8} {'>va %':>6} {'us/frame':>9} {'worst':>7}")
+    print(f"ERLE dB in far-end single talk; filter tail {EchoCanceller().partitions * 10} ms")
+    print(header)
+    print("-" * len(header))
+    far_samples = samples(far)
+    failed = []
+    for name, mic, labels, parts in cases:
+        out, spent = cancel(far, mic)
+        out = samples(out)[HOP:]  # undo the postfilter's delay
+        count = out.size
+        mic_samples = samples(mic)[:count]
+        # Far-end talk, frame by frame
+        frames = far_samples[:count - count % FRAME_SIZE].reshape(-1, FRAME_SIZE)
+        far_talking = numpy.repeat(numpy.sqrt((frames ** 2).mean(axis=1)) > FAR_ACTIVE, FRAME_SIZE)
+        far_talking = numpy.concatenate((far_talking, numpy.zeros(count - far_talking.size, dtype=bool)))
+        near = labels_mask(labels, count)
+        first_near = labels[0][0] * SAMPLE_RATE if labels else count
+        t = numpy.arange(count)
+        single = far_talking & ~near
+        columns = [erle(mic_samples, out, single & (t < 2 * SAMPLE_RATE)),
+                   erle(mic_samples, out, single & (t >= 2 * SAMPLE_RATE) & (t < 6 * SAMPLE_RATE)),
+                   erle(mic_samples, out, single & (t >= 6 * SAMPLE_RATE) & (t < first_near)),
+                   erle(mic_samples, out, single & (t >= first_near))]
+        double = kept = "-"
+        if parts is not None:
+            echo, rest = parts[0][:count], parts[1][:count]
+            both = far_talking & near
+            left = out[both] - rest[both]
+            double = f"{10 * numpy.log10(echo[both].dot(echo[both]) / max(left.dot(left), 1.0)):.1f}"
+            kept = f"{20 * numpy.log10(max(out[both].dot(rest[both]), 1.0) / rest[both].dot(rest[both])):.1f}"
+        # Output level of the far-end-only frames past the first 2 s
+        whole = count - count % FRAME_SIZE
+        only = (single & (t >= 2 * SAMPLE_RATE))[:whole].reshape(-1, FRAME_SIZE).all(axis=1)
+        levels = numpy.sqrt((out[:whole].reshape(-1, FRAME_SIZE) ** 2).mean(axis=1))[only]
+        over_gate = 100.0 * (levels > NOISE_GATE).mean() if levels.size else float('nan')
+        over_va = 100.0 * (levels > VA_THRESHOLD).mean() if levels.size else float('nan')
+        print(f"{name:<12} {columns[0]:>6.1f} {columns[1]:>6.1f} {columns[2]:>8.1f} {columns[3]:>6.1f} {double:>6} {kept:>8} "
+              f"{over_gate:>8.1f} {over_va:>6.1f} {sum(spent) / len(spent) * 1e6:>9.0f} {max(spent) * 1e6:>7.0f}")
+        if not columns[2] >= args.min_erle:  # nan (no settled far-end talk) fails too
+            failed.append(name)
+    if failed:
+        sys.exit(f"settled ERLE under {args.min_erle:g} dB: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
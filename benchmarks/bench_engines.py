@@ -0,0 +1,129 @@
+"""
+Threaded vs asyncio server engine: connected-client capacity and latency.
+
+For each engine and client count the server is started in a child process,
+every simulated user logs in and opens its voice socket, then all join
+General.
+Reported:
+    connect   time to bring all users online, mean login round trip
+    threads   server thread count / RSS once everyone is connected
+    text      MSG latency sender -> last user (fan-out to the whole channel)
+    voice     voice frame relay latency sender -> last user
+
+    python -m benchmarks.bench_engines --clients 50 200 500
+"""
+
+import argparse
+import os
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.server_harness import ServerProcess, ClientPool, USER_PREFIX, percentile
+
+CHANNEL = "General"
+
+
+def run_engine(engine, num_clients, messages, interval):
+    server = ServerProcess(engine, num_clients)
+    text_sent = {}
+    text_lat = []
+    voice_lat = []
+    receiver = {}
+    lock = threading.Lock()
+
+    def on_line(client, line):
+        if client is receiver.get("c") and line.startswith(f"MSG:{USER_PREFIX}0:bench:"):
+            seq = int(line.rsplit(":", 1)[1])
+            with lock:
+                if seq in text_sent:
+                    text_lat.append(time.perf_counter() - text_sent[seq])
+
+    def on_voice(client, payload):
+        # Bench frame body: [8B perf_counter double]
+        if client is receiver.get("c") and len(payload) >= 8:
+            sent_at = struct.unpack(">d", payload[-8:])[0]
+            voice_lat.append(time.perf_counter() - sent_at)
+
+    pool = ClientPool("127.0.0.1", server.text_port, server.voice_port, on_line, on_voice)
+    try:
+        t0 = time.perf_counter()
+        login_times = []
+        connected = 0
+        for i in range(num_clients):
+            t = time.perf_counter()
+            if pool.connect(f"{USER_PREFIX}{i}") is None:
+                break
+            login_times.append(time.perf_counter() - t)
+            connected += 1
+        connect_time = time.perf_counter() - t0
+        time.sleep(0.5)  # voice sockets must be registered before the join
+        for client in pool.clients:
+            pool.send_text(client, f"JOIN_CHANNEL:{CHANNEL}")
+        time.sleep(1.0 + connected / 200.0)  # let join broadcasts settle
+        proc = server.proc_status()
+
+        if connected < 2:
+            return {"engine": engine, "clients": num_clients, "connected": connected}
+
+        sender = pool.clients[0]
+        receiver["c"] = pool.clients[-1]
+        nick = sender.username.encode("utf-8")
+        for seq in range(messages):
+            with lock:
+                text_sent[seq] = time.perf_counter()
+            pool.send_text(sender, f"MSG:bench:{seq}")
+            # Legacy voice frame layout with the send time as the "audio" body
+            audio = struct.pack(">d", time.perf_counter())
+            frame = struct.pack(">H", len(nick)) + nick + bytes([0]) + struct.pack(">H", len(audio)) + audio
+            pool.send_voice(sender, frame)
+            time.sleep(interval)
+        time.sleep(1.0)
+    finally:
+        pool.close()
+        server.stop()
+
+    return {
+        "engine": engine,
+        "clients": num_clients,
+        "connected": connected,
+        "connect_s": connect_time,
+        "login_ms": 1000 * sum(login_times) / max(1, len(login_times)),
+        "threads": proc.get("threads", "?"),
+        "rss_mb": proc.get("rss_kb", 0) / 1024.0,
+        "text_p50": 1000 * percentile(text_lat, 50),
+        "text_p95": 1000 * percentile(text_lat, 95),
+        "voice_p50": 1000 * percentile(voice_lat, 50),
+        "voice_p95": 1000 * percentile(voice_lat, 95),
+        "lost": messages - len(text_lat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[50, 200, 500])
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.02)
+    args = parser.parse_args()
+
+    header = (f"{'engine':<9} {'clients':>7} {'online':>6} {'connect s':>9} {'login ms':>8} "
+              f"{'threads':>7} {'RSS MB':>7} {'text p50':>8} {'p95':>7} {'voice p50':>9} {'p95':>7} {'lost':>5}")
+    print(header)
+    print("-" * len(header))
+    for n in args.clients:
+        for engine in args.engines:
+            r = run_engine(engine, n, args.messages, args.interval)
+            if "connect_s" not in r:
+                print(f"{engine:<9} {n:>7} {r['connected']:>6}  (not enough clients connected)")
+                continue
+            print(f"{engine:<9} {n:>7} {r['connected']:>6} {r['connect_s']:>9.2f} {r['login_ms']:>8.2f} "
+                  f"{r['threads']:>7} {r['rss_mb']:>7.1f} {r['text_p50']:>8.2f} {r['text_p95']:>7.2f} "
+                  f"{r['voice_p50']:>9.2f} {r['voice_p95']:>7.2f} {r['lost']:>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Frame duration and packetization: server packets per second vs latency.
+
+For each framing (frame ms x frames per packet) a real server (child
+process) relays --senders streams to everyone in the channel (--listeners
+more), all of which negotiated that framing in the voice handshake, so
+bundles are relayed whole. Senders pace their packets in real time; each
+packet carries --bitrate worth of audio per frame, the first frame starting
+with its send time, which listeners compare with their arrival time.
+
+    pkts in/s    packets the server receives per second
+    pkts out/s   packets delivered to listeners per second
+    cpu %        server CPU time per second of wall time
+    wire kbit/s  one stream on UDP/IPv4 with every header counted
+    pack ms      packetization delay: audio buffered before a packet leaves
+    relay ms     send to arrival through the server (median / 99th percentile)
+
+The algorithmic delay of Opus itself and the receiver's jitter buffer come
+on top of pack ms + relay ms and are the same for every framing.
+
+    python -m benchmarks.bench_framing --framings 10x1 20x1 20x3 60x1 --seconds 5
+"""
+
+import argparse
+import os
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.server_harness import ServerProcess, ClientPool, USER_PREFIX, percentile
+from server.protocol import (
+    CODEC_OPUS, CODEC_OPUS_BUNDLE, AUDIO_HEADER, UDP_HEADER, VOICE_COMPACT_PREFIX,
+    VOICE_FRAMING_PREFIX, format_framing, pack_bundle, unpack_bundle,
+)
+
+CHANNEL = "General"
+SEND_TIME = struct.Struct('>d')
+IP_UDP_HEADERS = 28
+
+
+def packet_payload(frames, frame_bytes, sent_at):
+    """Compact payload of frames frames of frame_bytes each, stamped with sent_at."""
+    packets = [SEND_TIME.pack(sent_at) + bytes(frame_bytes - SEND_TIME.size)]
+    packets += [bytes(frame_bytes)] * (frames - 1)
+    if frames == 1:
+        codec, audio = CODEC_OPUS, packets[0]
+    else:
+        codec, audio = CODEC_OPUS_BUNDLE, pack_bundle(packets)
+    return bytes(2) + AUDIO_HEADER.pack(codec, len(audio)) + audio
+
+
+def sent_at(payload):
+    """The send time stamped in a relayed compact payload, or None (the framing reply)."""
+    if payload.startswith(VOICE_FRAMING_PREFIX.encode('ascii')):
+        return None
+    codec, length = AUDIO_HEADER.unpack_from(payload, 2)
+    audio = payload[2 + AUDIO_HEADER.size:2 + AUDIO_HEADER.size + length]
+    first = audio if codec == CODEC_OPUS else unpack_bundle(audio)[0]
+    return SEND_TIME.unpack_from(first)[0]
+
+
+def run(engine, frame_ms, frames, senders, listeners, bitrate, seconds):
+    server = ServerProcess(engine, senders + listeners)
+    delays = []
+    lock = threading.Lock()
+
+    def on_voice(client, payload):
+        stamp = sent_at(payload)
+        if stamp is not None:
+            now = time.perf_counter()
+            with lock:
+                delays.append(now - stamp)
+
+    pool = ClientPool("127.0.0.1", server.text_port, server.voice_port, on_voice=on_voice)
+    handshake = format_framing(frame_ms, frames) + ":" + VOICE_COMPACT_PREFIX
+    frame_bytes = max(SEND_TIME.size, bitrate * frame_ms // 8000)
+    interval = frame_ms * frames / 1000
+    try:
+        clients = [pool.connect(f"{USER_PREFIX}{i}", voice_handshake=handshake + f"{USER_PREFIX}{i}")
+                   for i in range(senders + listeners)]
+        time.sleep(0.3)
+        for c in clients:
+            pool.send_text(c, f"JOIN_CHANNEL:{CHANNEL}")
+        time.sleep(0.5)
+        with lock:
+            delays.clear()
+
+        sent = 0
+        cpu0, t0 = server.cpu_seconds(), time.perf_counter()
+        # Senders spread evenly over the packet interval, each on its own clock
+        slot = interval / senders
+        tick = 0
+        while True:
+            due = t0 + tick * slot
+            if due - t0 >= seconds:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.send_voice(clients[tick % senders], packet_payload(frames, frame_bytes, time.perf_counter()))
+            sent += 1
+            tick += 1
+        elapsed = time.perf_counter() - t0
+        time.sleep(0.3)
+        cpu = server.cpu_seconds() - cpu0
+    finally:
+        pool.close()
+        server.stop()
+    with lock:
+        delivered = list(delays)
+    wire = IP_UDP_HEADERS + UDP_HEADER.size + len(packet_payload(frames, frame_bytes, 0.0))
+    return {
+        "in": sent / elapsed,
+        "out": len(delivered) / elapsed,
+        "cpu": cpu / elapsed,
+        "wire_kbps": wire * 8 / interval / 1000,
+        "pack_ms": frame_ms * frames,
+        "p50": percentile(delivered, 50) * 1000,
+        "p99": percentile(delivered, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--framings", nargs="+",
+                        default=["10x1", "20x1", "20x2", "40x1", "20x3", "60x1", "60x2"],
+                        help="frame ms x frames per packet")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--senders", type=int, default=4)
+    parser.add_argument("--listeners", type=int, default=12)
+    parser.add_argument("--bitrate", type=int, default=24000, help="audio bit/s per stream")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"{args.engine} server, {args.senders} TCP senders -> {args.senders + args.listeners - 1} "
+          f"listeners each, {args.bitrate // 1000} kbit/s audio, {args.seconds:.0f} s per framing")
+    header = (f"{'framing':<8} {'pkts in/s':>9} {'pkts out/s':>10} {'cpu %':>6} {'wire kbit/s':>11} "
+              f"{'pack ms':>7} {'relay ms p50/p99':>16} {'pack+relay':>10}")
+    print(header)
+    print("-" * len(header))
+    for framing in args.framings:
+        frame_ms, _, frames = framing.partition("x")
+        r = run(args.engine, int(frame_ms), int(frames or 1), args.senders, args.listeners,
+                args.bitrate, args.seconds)
+        print(f"{framing:<8} {r['in']:>9.0f} {r['out']:>10.0f} {r['cpu'] * 100:>6.1f} {r['wire_kbps']:>11.1f} "
+              f"{r['pack_ms']:>7} {r['p50']:>7.2f} / {r['p99']:>6.2f} {r['pack_ms'] + r['p50']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
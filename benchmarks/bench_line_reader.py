@@ -0,0 +1,204 @@
+"""
+Text line framing: LineReader vs the old str buffer loop.
+
+fuzz   random protocol lines (Cyrillic, emoji, blank lines, CRLF) cut into
+       random chunks, including inside multi-byte UTF-8 characters. Every
+       line must come out exactly once and intact. Also checks that an
+       over-long line raises LineTooLong, over feed() and a real socket.
+bench  lines/s for a burst of ASCII chat lines (so the old loop can decode
+       them at all) delivered in 4 KB and 64 KB chunks, in-process (feed)
+       and over a socketpair (recv_into).
+
+    python -m benchmarks.bench_line_reader --fuzz 2000 --burst-mb 8
+"""
+
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.protocol import LineReader, LineTooLong, MAX_LINE_LENGTH
+
+ALPHABET = "abcxyz019 :,.-Привет всем ёЖ€😀"
+ASCII = "abcdefghijklmnopqrstuvwxyz0123456789 ,.-"
+
+
+class LegacyReader:
+    """The pre-LineReader loop from handle_text_client / TextClient.run."""
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, data):
+        lines = []
+        self.buffer += data.decode('utf-8')
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            line = line.strip()
+            if line:
+                lines.append(line)
+        return lines
+
+
+def random_stream(rng, count):
+    lines = []
+    for _ in range(count):
+        r = rng.random()
+        if r < 0.05:
+            lines.append("")
+        elif r < 0.07:
+            lines.append("x" * rng.randint(4000, 20000))
+        else:
+            lines.append("MSG:" + "".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 200))))
+    eol = [b"\r\n" if rng.random() < 0.1 else b"\n" for _ in lines]
+    data = b"".join(line.encode('utf-8') + e for line, e in zip(lines, eol))
+    return [line.strip() for line in lines if line.strip()], data
+
+
+def random_chunks(rng, data):
+    i = 0
+    while i < len(data):
+        n = rng.choice((1, 2, 3, rng.randint(1, 64), rng.randint(1, 8192)))
+        yield data[i:i + n]
+        i += n
+
+
+def fuzz(iterations, seed):
+    rng = random.Random(seed)
+    legacy_failures = 0
+    for it in range(iterations):
+        expected, data = random_stream(rng, rng.randint(1, 60))
+        chunks = list(random_chunks(rng, data))
+
+        reader = LineReader(bufsize=rng.choice((16, 256, 4096)))
+        got = []
+        for chunk in chunks:
+            got.extend(reader.feed(chunk))
+        assert got == expected, f"iteration {it}: LineReader output differs"
+
+        legacy = LegacyReader()
+        try:
+            got = []
+            for chunk in chunks:
+                got.extend(legacy.feed(chunk))
+            if got != expected:
+                legacy_failures += 1
+        except UnicodeDecodeError:
+            legacy_failures += 1
+
+    reader = LineReader(max_line=1000)
+    try:
+        reader.feed(b"y" * 1001)
+        raise AssertionError("over-long line accepted")
+    except LineTooLong:
+        pass
+    assert LineReader(max_line=1000).feed(b"y" * 1000 + b"\n") == ["y" * 1000]
+
+    a, b = socket.socketpair()
+    a.sendall(b"PING\n" + b"z" * (MAX_LINE_LENGTH + 10))
+    a.close()
+    reader = LineReader(b)
+    assert reader.read_line() == "PING"
+    try:
+        reader.read_line()
+        raise AssertionError("over-long line accepted from socket")
+    except LineTooLong:
+        pass
+    b.close()
+    return legacy_failures
+
+
+def burst(size_mb, seed):
+    rng = random.Random(seed)
+    lines = []
+    total = 0
+    while total < size_mb * 1024 * 1024:
+        line = ("MSG:user42:" + "".join(rng.choice(ASCII) for _ in range(rng.randint(10, 120)))).encode('utf-8') + b"\n"
+        lines.append(line)
+        total += len(line)
+    return b"".join(lines), len(lines)
+
+
+def bench_feed(make_reader, data, chunk):
+    reader = make_reader()
+    count = 0
+    t = time.perf_counter()
+    for i in range(0, len(data), chunk):
+        count += len(reader.feed(data[i:i + chunk]))
+    return count, time.perf_counter() - t
+
+
+def bench_socket(mode, data, chunk):
+    a, b = socket.socketpair()
+    b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+
+    def writer():
+        try:
+            for i in range(0, len(data), chunk):
+                a.sendall(data[i:i + chunk])
+        except OSError:
+            pass
+        a.close()
+
+    count = 0
+    t = time.perf_counter()
+    threading.Thread(target=writer, daemon=True).start()
+    if mode == "LineReader":
+        reader = LineReader(b, bufsize=chunk)
+        while reader.read_line() is not None:
+            count += 1
+    else:
+        legacy = LegacyReader()
+        while True:
+            data_in = b.recv(chunk)
+            if not data_in:
+                break
+            count += len(legacy.feed(data_in))
+    elapsed = time.perf_counter() - t
+    b.close()
+    return count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--fuzz", type=int, default=2000, help="fuzz iterations (0 to skip)")
+    parser.add_argument("--burst-mb", type=float, default=8.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.fuzz:
+        legacy_failures = fuzz(args.fuzz, args.seed)
+        print(f"fuzz: {args.fuzz} random streams OK with LineReader; "
+              f"old str loop failed on {legacy_failures} (split UTF-8 characters)")
+
+    data, count = burst(args.burst_mb, args.seed)
+    print(f"\nburst: {count} lines, {len(data) / 1e6:.1f} MB")
+    header = f"{'path':<7} {'chunk':>6} {'reader':<11} {'lines/s':>12} {'MB/s':>8}"
+    print(header)
+    print("-" * len(header))
+    for chunk in (4096, 65536):
+        for name in ("legacy", "LineReader"):
+            make = LegacyReader if name == "legacy" else (lambda: LineReader(bufsize=chunk))
+            try:
+                n, elapsed = bench_feed(make, data, chunk)
+            except UnicodeDecodeError:
+                print(f"{'feed':<7} {chunk:>6} {name:<11} {'decode error':>12}")
+                continue
+            assert n == count
+            print(f"{'feed':<7} {chunk:>6} {name:<11} {n / elapsed:>12.0f} {len(data) / elapsed / 1e6:>8.1f}")
+        for name in ("legacy", "LineReader"):
+            try:
+                n, elapsed = bench_socket(name, data, chunk)
+            except UnicodeDecodeError:
+                print(f"{'socket':<7} {chunk:>6} {name:<11} {'decode error':>12}")
+                continue
+            print(f"{'socket':<7} {chunk:>6} {name:<11} {n / elapsed:>12.0f} {len(data) / elapsed / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
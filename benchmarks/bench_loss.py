@@ -0,0 +1,176 @@
+"""
+Packet loss concealment on the client voice path: silence vs PLC vs FEC + PLC.
+
+A synthetic voiced signal (harmonics on a gliding pitch, syllable-rate
+envelope) is encoded in 20 ms Opus frames, then packets are dropped at each
+--loss rate, either independently or in bursts (Gilbert model, mean burst
+--burst frames). Surviving packets go through DecoderPool.receive with their
+sequence numbers, as UDP datagrams do, in three receivers:
+
+    silence  no concealment: each lost frame plays as silence (FEC off), the
+             decoder never hears about the gap
+    plc      gaps filled by the decoder's loss concealment (FEC off)
+    fec      last frame of a gap from the next packet's in-band FEC, the rest
+             by PLC; encoder tuned with packet_loss_perc = loss rate
+
+Each output is compared with a lossless decode of the same stream:
+    snr      signal-to-noise ratio over the whole signal (dB)
+    lost     segmental SNR over the lost frames only (dB, each within -10..35)
+    clicks   frame boundaries whose sample step is off the reference's by
+             more than CLICK_STEP (audible discontinuities)
+    kbit/s   encoded bitrate, which FEC raises
+
+Needs opuslib and libopus.
+
+    python -m benchmarks.bench_loss --loss 0 2 5 10 20 --seconds 20
+"""
+
+import argparse
+import array
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.audio.opus_codec import (
+    OPUS_AVAILABLE, CODEC_ID_OPUS, FRAME_SIZE, SAMPLE_RATE, OpusCodec, DecoderPool,
+)
+
+FRAME_SECONDS = FRAME_SIZE / SAMPLE_RATE
+CLICK_STEP = 4000
+SEGMENT_FLOOR, SEGMENT_CEIL = -10.0, 35.0
+
+
+def voiced_signal(seconds, seed):
+    """seconds of 16-bit PCM frames resembling voiced speech."""
+    rng = random.Random(seed)
+    frames = []
+    phase = 0.0
+    for f in range(int(seconds / FRAME_SECONDS)):
+        samples = array.array('h')
+        for i in range(FRAME_SIZE):
+            t = (f * FRAME_SIZE + i) / SAMPLE_RATE
+            pitch = 150 + 50 * math.sin(2 * math.pi * 0.7 * t)
+            phase += 2 * math.pi * pitch / SAMPLE_RATE
+            envelope = 0.55 + 0.45 * math.sin(2 * math.pi * 4 * t)
+            value = sum(math.sin(k * phase) / k for k in range(1, 8))
+            samples.append(int(6000 * envelope * value + rng.gauss(0, 150)))
+        frames.append(samples.tobytes())
+    return frames
+
+
+def loss_pattern(count, rate, burst, rng):
+    """[True if frame i is lost]: Bernoulli for burst <= 1, else Gilbert bursts."""
+    if rate <= 0:
+        return [False] * count
+    if burst <= 1:
+        return [rng.random() < rate for _ in range(count)]
+    leave = 1 / burst                   # P(bad -> good)
+    enter = rate * leave / (1 - rate)   # P(good -> bad), for a stationary loss of rate
+    lost, bad = [], False
+    for _ in range(count):
+        bad = rng.random() < (1 - leave if bad else enter)
+        lost.append(bad)
+    return lost
+
+
+def encode(pcm_frames, expected_loss):
+    codec = OpusCodec(expected_loss)
+    packets = []
+    for pcm in pcm_frames:
+        codec_id, data = codec.encode(pcm)
+        if codec_id != CODEC_ID_OPUS:
+            sys.exit("Opus encoder failed to initialise")
+        packets.append(data)
+    return packets
+
+
+def receive(packets, lost, mode):
+    """Decoded output, one frame per packet slot, as the receiver would play it."""
+    pool = DecoderPool(fec=(mode == "fec"))
+    silence = bytes(FRAME_SIZE * 2)
+    out = []
+    for seq, packet in enumerate(packets):
+        if lost[seq]:
+            continue
+        if mode == "silence":
+            # As before sequence numbers were used: a plain decode, nothing in the gap
+            frames = [pool.decode("sender", CODEC_ID_OPUS, packet) or silence]
+        else:
+            concealed, pcm = pool.receive("sender", CODEC_ID_OPUS, packet, seq & 0xFFFF)
+            frames = concealed + [silence if pcm is None else pcm]
+        # Slots nothing was synthesized for (gaps over MAX_CONCEAL) stay silent
+        out.extend([silence] * (seq - len(out) - (len(frames) - 1)))
+        out.extend(frames)
+    # A loss at the very end has no later packet to reveal it
+    out.extend([silence] * (len(packets) - len(out)))
+    return out, pool.stats()
+
+
+def samples(frames):
+    return array.array('h', b''.join(frames))
+
+
+def snr(ref, out):
+    signal = sum(s * s for s in ref)
+    noise = sum((a - b) ** 2 for a, b in zip(ref, out))
+    return 10 * math.log10(signal / noise) if noise else float('inf')
+
+
+def compare(ref_frames, out_frames, lost):
+    ref, out = samples(ref_frames), samples(out_frames)
+    lost_snrs = [
+        min(SEGMENT_CEIL, max(SEGMENT_FLOOR, snr(ref[i * FRAME_SIZE:(i + 1) * FRAME_SIZE],
+                                                  out[i * FRAME_SIZE:(i + 1) * FRAME_SIZE])))
+        for i, gone in enumerate(lost) if gone
+    ]
+    clicks = 0
+    for i in range(1, len(ref_frames)):
+        b = i * FRAME_SIZE
+        if abs((out[b] - out[b - 1]) - (ref[b] - ref[b - 1])) > CLICK_STEP:
+            clicks += 1
+    return snr(ref, out), sum(lost_snrs) / len(lost_snrs) if lost_snrs else float('nan'), clicks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--loss", type=float, nargs="+", default=[0, 2, 5, 10, 20],
+                        help="packet loss rates in percent")
+    parser.add_argument("--burst", type=float, default=1.0,
+                        help="mean loss burst length in frames (1 = independent losses)")
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not OPUS_AVAILABLE:
+        sys.exit("opuslib / libopus not available: nothing to measure")
+    pcm = voiced_signal(args.seconds, args.seed)
+    plain = encode(pcm, 0)
+    plain_ref, _ = receive(plain, [False] * len(plain), "plc")
+    plain_kbps = sum(map(len, plain)) * 8 / args.seconds / 1000
+
+    print(f"{args.seconds:.0f} s voiced signal, {len(pcm)} frames, "
+          f"{'independent losses' if args.burst <= 1 else f'mean burst {args.burst:g} frames'}")
+    header = (f"{'loss %':>6} {'mode':<8} {'lost':>5} {'fec':>5} {'plc':>5} {'snr dB':>7} "
+              f"{'lost dB':>8} {'clicks':>7} {'kbit/s':>7}")
+    print(header)
+    print("-" * len(header))
+    for rate in args.loss:
+        lost = loss_pattern(len(pcm), rate / 100, args.burst, random.Random(args.seed + int(rate * 100)))
+        fec = encode(pcm, rate)
+        fec_ref, _ = receive(fec, [False] * len(fec), "fec")
+        fec_kbps = sum(map(len, fec)) * 8 / args.seconds / 1000
+        for mode, packets, ref, kbps in (
+                ("silence", plain, plain_ref, plain_kbps),
+                ("plc", plain, plain_ref, plain_kbps),
+                ("fec", fec, fec_ref, fec_kbps)):
+            out, stats = receive(packets, lost, mode)
+            total, lost_db, clicks = compare(ref, out, lost)
+            print(f"{rate:>6g} {mode:<8} {sum(lost):>5} {stats['fec_frames']:>5} {stats['plc_frames']:>5} "
+                  f"{total:>7.1f} {lost_db:>8.1f} {clicks:>7} {kbps:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
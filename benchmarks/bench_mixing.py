@@ -0,0 +1,150 @@
+"""
+Server-side mixing (MCU) vs plain relay for one voice channel.
+
+For each channel size, --speakers members talk at once for --seconds of
+20 ms frames. Every frame goes through broadcast_voice; in mix mode the
+channel has a ChannelMixer and the mixing tick runs once per frame
+interval. Reports server CPU per mixed channel (ms per 20 ms tick and % of
+one core) and the downlink both modes queue to listeners.
+
+Senders use Opus if opuslib is installed, raw 16-bit PCM otherwise (then
+the mixer's CPU excludes codec work and byte counts are PCM-sized; the
+stream counts and the saving ratio still hold at equal bitrates).
+
+    python -m benchmarks.bench_mixing --members 5 20 50 --speakers 3
+"""
+
+import argparse
+import array
+import math
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.config import MIX_SAMPLE_RATE, MIX_FRAME_MS
+from server.mixer import ChannelMixer, OPUS_AVAILABLE, FRAME_SAMPLES, audioop
+from server.protocol import CODEC_OPUS, CODEC_RAW, SPEAKER_ID
+from server.state import ServerState
+from server.text_queue import TextSendQueue
+from server.voice_handler import broadcast_voice
+from server.voice_queue import VoiceSendQueue
+
+CHANNEL = "General"
+
+
+class FakeSocket:
+    pass
+
+
+def tone(freq, frames):
+    """frames x 20 ms of a sine tone as 16-bit PCM byte strings."""
+    out = []
+    for f in range(frames):
+        start = f * FRAME_SAMPLES
+        samples = array.array('h', (
+            int(4000 * math.sin(2 * math.pi * freq * (start + i) / MIX_SAMPLE_RATE))
+            for i in range(FRAME_SAMPLES)
+        ))
+        out.append(samples.tobytes())
+    return out
+
+
+def encode_stream(pcm_frames):
+    """(codec, [audio]) as a client would send them."""
+    if not OPUS_AVAILABLE:
+        return CODEC_RAW, pcm_frames
+    import opuslib
+    encoder = opuslib.Encoder(MIX_SAMPLE_RATE, 1, opuslib.APPLICATION_VOIP)
+    return CODEC_OPUS, [encoder.encode(pcm, FRAME_SAMPLES) for pcm in pcm_frames]
+
+
+def make_channel(members):
+    state = ServerState()
+    socks = []
+    for i in range(members):
+        ts, vs = FakeSocket(), FakeSocket()
+        state.add_text_client(ts, f"user{i}", TextSendQueue())
+        state.add_voice_client(vs, f"user{i}", VoiceSendQueue(maxlen=1000, max_age=3600), compact=True)
+        state.set_channel(ts, CHANNEL)
+        socks.append(vs)
+    return state, socks
+
+
+def drain(state):
+    """Empty every recipient queue; returns (frames, bytes) that were queued."""
+    frames = size = 0
+    for info in state.voice_clients.values():
+        while True:
+            item = info["queue"].pop()
+            if item is None:
+                break
+            frames += 1
+            size += len(item[0])
+    return frames, size
+
+
+def run(mode, members, speakers, ticks, streams):
+    state, socks = make_channel(members)
+    mixer = None
+    if mode == "mix":
+        mixer = state.mixers[CHANNEL] = ChannelMixer(CHANNEL, state)
+    codec, audio = streams
+    framed = [
+        [struct.pack('>I', 5 + len(a)) + SPEAKER_ID.pack(0) + struct.pack('>BH', codec, len(a)) + a
+         for a in audio[s]]
+        for s in range(speakers)
+    ]
+    cpu = 0.0
+    down_frames = down_bytes = 0
+    for t in range(ticks):
+        started = time.process_time()
+        for s in range(speakers):
+            broadcast_voice(framed[s][t % len(framed[s])], socks[s], state)
+        if mixer:
+            mixer.tick()
+        cpu += time.process_time() - started
+        frames, size = drain(state)
+        down_frames += frames
+        down_bytes += size
+    return cpu, down_frames, down_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--members", type=int, nargs="+", default=[5, 20, 50])
+    parser.add_argument("--speakers", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    if audioop is None:
+        sys.exit("audioop is not available in this Python: mixing can't run")
+    ticks = int(args.seconds * 1000 / MIX_FRAME_MS)
+    loop = min(ticks, 50)  # distinct frames per speaker, replayed
+    pcm = [tone(220 * (s + 1), loop) for s in range(max(args.speakers, 1))]
+    encoded = [encode_stream(p) for p in pcm]
+    streams = (encoded[0][0], [audio for _, audio in encoded])
+
+    print(f"{args.speakers} speakers, {args.seconds:.0f} s, codec: "
+          f"{'Opus' if OPUS_AVAILABLE else 'raw PCM (opuslib not installed)'}")
+    header = (f"{'members':>7} {'mode':<6} {'cpu ms/tick':>11} {'core %':>7} "
+              f"{'down streams/listener':>21} {'down kB/s':>10} {'saved':>6}")
+    print(header)
+    print("-" * len(header))
+    for members in args.members:
+        speakers = min(args.speakers, members)
+        base = None
+        for mode in ("relay", "mix"):
+            cpu, frames, size = run(mode, members, speakers, ticks, streams)
+            per_tick = cpu / ticks * 1000
+            kbps = size / args.seconds / 1000
+            base = base or kbps
+            saved = f"{1 - kbps / base:>5.0%}" if mode == "mix" else ""
+            print(f"{members:>7} {mode:<6} {per_tick:>11.3f} {per_tick / MIX_FRAME_MS:>7.1%} "
+                  f"{frames / ticks / members:>21.2f} {kbps:>10.1f} {saved:>6}")
+
+
+if __name__ == "__main__":
+    main()
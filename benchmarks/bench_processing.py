@@ -0,0 +1,193 @@
+"""
+Capture processing offline: noise suppression and automatic gain control.
+
+Synthetic speech (voiced talk spurts with pauses) is mixed with background
+noise and run through processing.CaptureProcessor in 20 ms frames, as the
+capture pipeline does, in four setups:
+
+    bypass   frames untouched (what was sent before)
+    denoise  noise suppression only (needs NumPy)
+    agc      automatic gain control only
+    full     noise suppression, then AGC (needs NumPy)
+
+Noise suppression (bypass and denoise), on each noise (white hiss, a
+low-passed fan) at the default speaker level:
+    noise dB   background level in the pauses, dBFS RMS
+    snr dB     segmental SNR of the speech frames against the clean speech
+               (each within -10..35)
+
+Gain control (bypass, agc and full), on the same talker recorded at each --levels microphone
+gain (dB from the default speaker level):
+    speech dBFS  speech level sent, once settled (the last half)
+    spread dB    loudest minus quietest speech level sent
+
+us/frame is each stage's time per frame (capture budget: 20 000).
+
+    python -m benchmarks.bench_processing --levels -20 -10 0 10 --seconds 20
+"""
+
+import argparse
+import array
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.audio import dsp
+from client.audio.opus_codec import FRAME_SIZE, SAMPLE_RATE
+from client.audio.processing import NUMPY_AVAILABLE, HOP, CaptureProcessor
+from client.audio.vad import level_db
+
+FRAME_SECONDS = FRAME_SIZE / SAMPLE_RATE
+SPEECH_PEAK = 6000   # the default speaker's voice peak amplitude
+NOISE_RMS = 300      # background noise level (about -40 dBFS)
+SEGMENT_FLOOR, SEGMENT_CEIL = -10.0, 35.0
+
+
+def speech(seconds, seed):
+    """([float samples], [frame has speech]) of voiced talk spurts and pauses."""
+    rng = random.Random(seed)
+    total = int(seconds * SAMPLE_RATE)
+    signal = [0.0] * total
+    pos = int(0.5 * SAMPLE_RATE)
+    phase = 0.0
+    while pos < total:
+        length = min(int(rng.uniform(0.8, 2.5) * SAMPLE_RATE), total - pos)
+        base = rng.uniform(100, 220)
+        for i in range(length):
+            t = i / SAMPLE_RATE
+            pitch = base * (1 + 0.15 * math.sin(2 * math.pi * 0.8 * t))
+            phase += 2 * math.pi * pitch / SAMPLE_RATE
+            envelope = ((0.15 + 0.85 * max(0.0, math.sin(math.pi * 4 * t)) ** 0.7)
+                        * min(1.0, 10 * t, 10 * (length / SAMPLE_RATE - t)))
+            value = sum(math.sin(k * phase) / k for k in range(1, 8))
+            signal[pos + i] = SPEECH_PEAK / 2.6 * envelope * value
+        pos += length + int(rng.uniform(0.5, 2.0) * SAMPLE_RATE)
+    frames = len(signal) // FRAME_SIZE
+    active = [any(signal[f * FRAME_SIZE:(f + 1) * FRAME_SIZE]) for f in range(frames)]
+    return signal, active
+
+
+def noise(kind, count, seed):
+    rng = random.Random(seed)
+    if kind == "hiss":
+        return [rng.gauss(0, NOISE_RMS) for _ in range(count)]
+    out, low = [], 0.0
+    for _ in range(count):
+        low += 0.1 * (rng.gauss(0, NOISE_RMS * 3.2) - low)
+        out.append(low)
+    return out
+
+
+def pcm(values, gain=1.0):
+    samples = array.array('h', (max(-32768, min(32767, int(v * gain))) for v in values))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def samples(data):
+    out = array.array('h')
+    out.frombytes(data)
+    if sys.byteorder == 'big':
+        out.byteswap()
+    return out
+
+
+class Times:
+    """StageTimes stand-in: total seconds per stage."""
+
+    def __init__(self):
+        self.total = {}
+
+    def add(self, stage, seconds):
+        self.total[stage] = self.total.get(stage, 0.0) + seconds
+
+
+def run(setup, data):
+    """(output PCM, {stage: seconds}) for data through one setup."""
+    processor = CaptureProcessor(FRAME_SIZE, denoise=(setup in ("denoise", "full")),
+                                 agc=(setup != "denoise"), bypass=(setup == "bypass"))
+    times = Times()
+    out = []
+    for start in range(0, len(data) - FRAME_SIZE * 2 + 1, FRAME_SIZE * 2):
+        out.append(processor.process(data[start:start + FRAME_SIZE * 2], times))
+    return b''.join(out), times.total
+
+
+def delay(setup):
+    """Samples the setup's output lags its input by."""
+    return HOP if setup in ("denoise", "full") and NUMPY_AVAILABLE else 0
+
+
+def segmental_snr(clean, out, active, lag):
+    snrs = []
+    for f, on in enumerate(active):
+        if not on:
+            continue
+        ref = clean[f * FRAME_SIZE:(f + 1) * FRAME_SIZE]
+        got = out[f * FRAME_SIZE + lag:(f + 1) * FRAME_SIZE + lag]
+        if len(got) < len(ref):
+            break
+        signal = sum(s * s for s in ref)
+        error = sum((a - b) ** 2 for a, b in zip(ref, got))
+        value = 10 * math.log10(signal / error) if error else SEGMENT_CEIL
+        snrs.append(min(SEGMENT_CEIL, max(SEGMENT_FLOOR, value)))
+    return sum(snrs) / len(snrs) if snrs else float('nan')
+
+
+def level(out, active, lag, settled=0):
+    """dBFS RMS over frames (from settled on) where active is what's wanted (True/False)."""
+    chunks = [out[f * FRAME_SIZE * 2 + lag * 2:(f + 1) * FRAME_SIZE * 2 + lag * 2]
+              for f in range(settled, len(active)) if active[f]]
+    return level_db(dsp.rms(b''.join(chunks)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--levels", type=float, nargs="+", default=[-20, -10, 0, 10],
+                        help="microphone gains to compare (dB from the default speaker)")
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    denoise_setups = ("bypass", "denoise") if NUMPY_AVAILABLE else ("bypass",)
+    gain_setups = ("bypass", "agc", "full") if NUMPY_AVAILABLE else ("bypass", "agc")
+    clean, active = speech(args.seconds, args.seed)
+    pauses = [not a for a in active]
+    print(f"dsp backend: {dsp.BACKEND.name}; NumPy {'loaded' if NUMPY_AVAILABLE else 'missing: no noise suppression'}")
+
+    header = f"{'noise':<6} {'setup':<7} {'noise dB':>9} {'snr dB':>7} {'us/frame':>24}"
+    print(header)
+    print("-" * len(header))
+    clean_pcm = samples(pcm(clean))
+    for kind in ("hiss", "fan"):
+        mixed = [s + n for s, n in zip(clean, noise(kind, len(clean), args.seed + 1))]
+        data = pcm(mixed)
+        frames = len(data) // (FRAME_SIZE * 2)
+        for setup in denoise_setups:
+            out, spent = run(setup, data)
+            lag = delay(setup)
+            snr = segmental_snr(clean_pcm, samples(out), active, lag)
+            stage_us = " ".join(f"{name} {seconds / frames * 1e6:.0f}" for name, seconds in spent.items())
+            print(f"{kind:<6} {setup:<7} {level(out, pauses, lag):>9.1f} {snr:>7.1f} {stage_us or '-':>24}")
+
+    print()
+    header = f"{'setup':<7} " + " ".join(f"{f'{gain:+g} dB':>8}" for gain in args.levels) + f" {'spread dB':>10}"
+    print(header)
+    print("-" * len(header))
+    mixed = [s + n for s, n in zip(clean, noise("hiss", len(clean), args.seed + 1))]
+    settled = len(active) // 2
+    for setup in gain_setups:
+        levels = []
+        for gain in args.levels:
+            out, _ = run(setup, pcm(mixed, 10 ** (gain / 20)))
+            levels.append(level(out, active, delay(setup), settled))
+        print(f"{setup:<7} " + " ".join(f"{value:>8.1f}" for value in levels)
+              + f" {max(levels) - min(levels):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Voice relay lock contention: 50 simultaneous speakers in one channel.
+
+Each speaker thread relays a frame every 20 ms while a churn thread keeps
+moving users between channels and a text thread polls rosters, as logins and
+chat do on a live server. ServerState.lock is replaced by a lock that
+measures how long acquirers waited.
+
+    locked    recipients copied under ServerState.lock every frame
+              (get_voice_sockets_in_channel, the pre-snapshot relay)
+    snapshot  broadcast_voice reading the immutable roster tuple
+
+    python -m benchmarks.bench_roster_contention --speakers 50 --seconds 5
+"""
+
+import argparse
+import os
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.state import ServerState
+from server.text_queue import TextSendQueue
+from server.voice_queue import VoiceSendQueue
+from server.voice_handler import broadcast_voice
+
+CHANNEL = "General"
+FRAME_INTERVAL = 0.02
+
+
+class TimedLock:
+    """threading.Lock that accumulates acquire wait time (updated while held).
+
+    Totals cover every thread; the speaker_* counters only the relay threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.wait = 0.0
+        self.acquisitions = 0
+        self.speaker_wait = 0.0
+        self.speaker_max_wait = 0.0
+        self.speaker_acquisitions = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        t = time.perf_counter()
+        ok = self._lock.acquire(blocking, timeout)
+        if ok:
+            waited = time.perf_counter() - t
+            self.wait += waited
+            self.acquisitions += 1
+            if threading.current_thread().name.startswith("speaker"):
+                self.speaker_wait += waited
+                self.speaker_max_wait = max(self.speaker_max_wait, waited)
+                self.speaker_acquisitions += 1
+        return ok
+
+    def release(self):
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FakeSocket:
+    pass
+
+
+def locked_broadcast(framed, sender_sock, state):
+    """Pre-snapshot relay: recipient list copied under the global lock."""
+    sender_info = state.voice_clients.get(sender_sock)
+    if not sender_info or not sender_info.get("channel"):
+        return
+    for sock in state.get_voice_sockets_in_channel(sender_info["channel"]):
+        if sock is not sender_sock:
+            info = state.voice_clients.get(sock)
+            if info:
+                info["queue"].put(framed)
+
+
+def run(mode, speakers, listeners, seconds):
+    state = ServerState()
+    state.lock = TimedLock()
+    voice_socks, text_socks = [], []
+    for i in range(speakers + listeners):
+        ts, vs = FakeSocket(), FakeSocket()
+        name = f"user{i}"
+        state.add_text_client(ts, name, TextSendQueue())
+        # Recipients' queues are never drained here; keep them tiny
+        state.add_voice_client(vs, name, VoiceSendQueue(maxlen=4))
+        state.set_channel(ts, CHANNEL)
+        voice_socks.append(vs)
+        text_socks.append(ts)
+    state.lock.reset()
+
+    relay = broadcast_voice if mode == "snapshot" else locked_broadcast
+    stop = threading.Event()
+    frames = [0] * speakers
+    frame = struct.pack(">I", 64) + bytes(64)
+
+    def speaker(idx):
+        sock = voice_socks[idx]
+        next_due = time.perf_counter()
+        while not stop.is_set():
+            relay(frame, sock, state)
+            frames[idx] += 1
+            next_due += FRAME_INTERVAL
+            pause = next_due - time.perf_counter()
+            if pause > 0:
+                time.sleep(pause)
+
+    def churn():
+        # A listener hops in and out of the channel (joins/leaves)
+        movers = text_socks[speakers:]
+        i = 0
+        while not stop.is_set():
+            ts = movers[i % len(movers)]
+            state.set_channel(ts, "Lobby")
+            state.set_channel(ts, CHANNEL)
+            i += 1
+            time.sleep(0.001)
+
+    def text_poller():
+        while not stop.is_set():
+            state.get_users_in_channel(CHANNEL)
+            state.get_text_sockets_in_channel(CHANNEL)
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=speaker, args=(i,), name=f"speaker-{i}") for i in range(speakers)]
+    threads += [threading.Thread(target=churn), threading.Thread(target=text_poller)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    total_frames = sum(frames)
+    lock = state.lock
+    return {
+        "mode": mode,
+        "frames": total_frames,
+        "fps": total_frames / elapsed,
+        "acq": lock.speaker_acquisitions,
+        "wait_ms": lock.speaker_wait * 1000,
+        "wait_per_frame_us": lock.speaker_wait / max(1, total_frames) * 1e6,
+        "max_wait_ms": lock.speaker_max_wait * 1000,
+        "all_wait_ms": lock.wait * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--speakers", type=int, default=50)
+    parser.add_argument("--listeners", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"{args.speakers} speakers + {args.listeners} listeners in one channel, {args.seconds:.0f} s")
+    print("lock columns are for the speaker threads; 'all' includes churn/text threads")
+    header = (f"{'mode':<9} {'frames':>8} {'frames/s':>9} {'lock acq':>9} "
+              f"{'wait ms':>9} {'wait/frame us':>13} {'max wait ms':>11} {'all wait ms':>11}")
+    print(header)
+    print("-" * len(header))
+    for mode in ("locked", "snapshot"):
+        r = run(mode, args.speakers, args.listeners, args.seconds)
+        print(f"{r['mode']:<9} {r['frames']:>8} {r['fps']:>9.0f} {r['acq']:>9} "
+              f"{r['wait_ms']:>9.1f} {r['wait_per_frame_us']:>13.2f} {r['max_wait_ms']:>11.2f} "
+              f"{r['all_wait_ms']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+ServerState lookup cost at 10k connected clients: membership index vs the
+old full scan.
+
+Clients are spread over --channels channels. "scan" re-implements the
+pre-index lookups over state.text_clients / state.voice_clients, "index"
+calls the ServerState methods.
+
+    python -m benchmarks.bench_state_index --clients 10000 --channels 100
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.state import ServerState
+from server.text_queue import TextSendQueue
+from server.voice_queue import VoiceSendQueue
+
+
+class FakeSocket:
+    pass
+
+
+def scan_voice_sockets(state, channel):
+    with state.lock:
+        return [s for s, info in state.voice_clients.items() if info.get("channel") == channel]
+
+
+def scan_users(state, channel):
+    with state.lock:
+        return [info["username"] for info in state.text_clients.values() if info.get("channel") == channel]
+
+
+def scan_online(state, username):
+    with state.lock:
+        return any(info["username"] == username for info in state.text_clients.values())
+
+
+def populate(num_clients, num_channels):
+    state = ServerState()
+    text_socks = []
+    for i in range(num_clients):
+        ts, vs = FakeSocket(), FakeSocket()
+        name = f"user{i}"
+        state.add_text_client(ts, name, TextSendQueue())
+        state.add_voice_client(vs, name, VoiceSendQueue())
+        state.set_channel(ts, f"ch{i % num_channels}")
+        text_socks.append(ts)
+    return state, text_socks
+
+
+def bench(label, fn, number):
+    per_call = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"  {label:<44} {per_call * 1e6:>10.2f} us")
+    return per_call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--channels", type=int, default=100)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    state, text_socks = populate(args.clients, args.channels)
+    members = args.clients // args.channels
+    last = f"user{args.clients - 1}"
+    print(f"{args.clients} clients, {args.channels} channels, ~{members} members each\n")
+
+    print("voice recipients for one frame (get_voice_sockets_in_channel)")
+    a = bench("scan", lambda: scan_voice_sockets(state, "ch7"), args.number)
+    b = bench("index", lambda: state.get_voice_sockets_in_channel("ch7"), args.number)
+    print(f"  speedup x{a / b:.0f}\n")
+
+    print("channel roster (get_users_in_channel)")
+    a = bench("scan", lambda: scan_users(state, "ch7"), args.number)
+    b = bench("index", lambda: state.get_users_in_channel("ch7"), args.number)
+    print(f"  speedup x{a / b:.0f}\n")
+
+    print("login check for the last user (is_username_online)")
+    a = bench("scan", lambda: scan_online(state, last), args.number)
+    b = bench("index", lambda: state.is_username_online(last), args.number)
+    print(f"  speedup x{a / b:.0f}\n")
+
+    print("channel switch (set_channel, index maintenance included)")
+    sock = text_socks[-1]
+    channels = [f"ch{i}" for i in range(args.channels)]
+    it = iter(range(10 ** 9))
+    bench("index", lambda: state.set_channel(sock, channels[next(it) % args.channels]), args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Text fan-out throughput: per-recipient send_line vs encode-once broadcast_line.
+
+Each round broadcasts one chat line to every recipient, as broadcast_text
+does for a channel.
+
+    per-socket  the pre-broadcast_line loop: send_line(sock, msg) for every
+                recipient, re-encoding the message each time
+    broadcast   broadcast_line: encode once, same buffer to everyone
+
+Sinks:
+    null    in-process socket stand-ins (serialization + call overhead only)
+    socket  connected socketpairs, drained by a reader thread
+    short   stand-ins that accept at most 7 bytes per send(); checks that
+            every recipient got the complete line
+
+    python -m benchmarks.bench_text_broadcast --recipients 1 100 1000
+"""
+
+import argparse
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.protocol import broadcast_line
+
+MESSAGE = "MSG:alice:" + "Привет всем, как слышно? " * 3
+
+
+def legacy_send_line(sock, message):
+    """send_line before this change: one send(), short writes ignored."""
+    sock.send((message + "\n").encode('utf-8'))
+
+
+def per_socket(sockets, message):
+    for sock in sockets:
+        try:
+            legacy_send_line(sock, message)
+        except Exception:
+            pass
+
+
+class NullSocket:
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.received = bytearray()
+
+    def send(self, data):
+        n = len(data) if self.limit is None else min(self.limit, len(data))
+        if self.limit is not None:
+            self.received += data[:n]
+        return n
+
+
+class Drain(threading.Thread):
+    """Reads and discards everything arriving on the receiving ends."""
+
+    def __init__(self, socks):
+        super().__init__(daemon=True)
+        self.sel = selectors.DefaultSelector()
+        for s in socks:
+            s.setblocking(False)
+            self.sel.register(s, selectors.EVENT_READ)
+        self.bytes = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for key, _ in self.sel.select(0.1):
+                try:
+                    self.bytes += len(key.fileobj.recv(262144))
+                except BlockingIOError:
+                    pass
+
+
+def make_socket_sink(n):
+    senders, receivers = [], []
+    for _ in range(n):
+        a, b = socket.socketpair()
+        senders.append(a)
+        receivers.append(b)
+    drain = Drain(receivers)
+    drain.start()
+
+    def close():
+        drain.running = False
+        drain.join()
+        for s in senders + receivers:
+            s.close()
+    return senders, drain, close
+
+
+def run(mode, sink, recipients, seconds):
+    fan_out = broadcast_line if mode == "broadcast" else per_socket
+    drain = None
+    if sink == "socket":
+        sockets, drain, close = make_socket_sink(recipients)
+    else:
+        sockets, close = [NullSocket() for _ in range(recipients)], lambda: None
+
+    rounds = 0
+    t0 = time.perf_counter()
+    deadline = t0 + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(max(1, 1000 // recipients)):
+            fan_out(sockets, MESSAGE)
+            rounds += 1
+    elapsed = time.perf_counter() - t0
+    if drain is not None:
+        expected = rounds * recipients * len((MESSAGE + "\n").encode('utf-8'))
+        while drain.bytes < expected and time.perf_counter() - t0 < elapsed + 5:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - t0
+    close()
+    return rounds / elapsed, rounds * recipients / elapsed
+
+
+def check_short_writes(recipients):
+    line = (MESSAGE + "\n").encode('utf-8')
+    results = {}
+    for mode in ("per-socket", "broadcast"):
+        sockets = [NullSocket(limit=7) for _ in range(recipients)]
+        (broadcast_line if mode == "broadcast" else per_socket)(sockets, MESSAGE)
+        results[mode] = sum(1 for s in sockets if bytes(s.received) == line)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--recipients", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--sink", choices=("null", "socket", "short"), nargs="+",
+                        default=["null", "socket", "short"])
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f"message: {len((MESSAGE + chr(10)).encode('utf-8'))} bytes UTF-8")
+    for sink in args.sink:
+        if sink == "short":
+            print("\nshort writes (7 bytes per send): recipients with the complete line")
+            for n in args.recipients:
+                r = check_short_writes(n)
+                print(f"  {n:>5} recipients   per-socket {r['per-socket']:>5}   broadcast {r['broadcast']:>5}")
+            continue
+        print(f"\nsink={sink}")
+        header = f"{'recipients':>10} {'mode':<11} {'broadcasts/s':>13} {'deliveries/s':>13} {'speedup':>8}"
+        print(header)
+        print("-" * len(header))
+        for n in args.recipients:
+            base = None
+            for mode in ("per-socket", "broadcast"):
+                rate, deliveries = run(mode, sink, n, args.seconds)
+                base = base or deliveries
+                print(f"{n:>10} {mode:<11} {rate:>13.0f} {deliveries:>13.0f} {deliveries / base:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Voice activation detectors, offline: what each would have sent of labelled
+recordings.
+
+Each recording is cut into 20 ms frames and run through the capture path's
+decision as in voice-activation mode (default noise gate and va_threshold),
+with the capture pipeline's pre-roll (vad.PREROLL) for the detectors:
+
+    before     RMS above va_threshold and the noise gate, no pre-roll (the
+               original behaviour)
+    threshold  the same with pre-roll
+    adaptive   vad.AdaptiveVAD with pre-roll
+
+Against the labels:
+    speech %   labelled speech frames sent
+    noise %    frames outside speech sent (false triggers)
+    clip ms    onset clipped: labelled start to the first frame sent, per
+               talk spurt, mean (a spurt never sent counts in full)
+    false      bursts sent that don't touch any labelled speech
+    us/frame   detector time per frame (capture budget: 20 000)
+
+Recordings are 48 kHz mono 16-bit WAV files (--wav), each labelled by an
+Audacity label file next to it (same name, .txt: "start<TAB>end[<TAB>text]"
+per talk spurt, seconds). Without any, synthetic ones are made: talk spurts
+with soft unvoiced onsets in a quiet room; the same with breaths and key
+clicks in the pauses; a quieter talker with a fan that gets 15 dB louder
+halfway. --write DIR saves those with their labels.
+
+    python -m benchmarks.bench_vad --wav meeting.wav --write fixtures
+"""
+
+import argparse
+import array
+import math
+import os
+import random
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.audio import dsp
+from client.audio.opus_codec import FRAME_SIZE, SAMPLE_RATE
+from client.audio.vad import PREROLL, ThresholdVAD, AdaptiveVAD
+
+FRAME_BYTES = FRAME_SIZE * 2
+FRAME_SECONDS = FRAME_SIZE / SAMPLE_RATE
+# Client defaults (config.py): audio.noise_gate, audio.va_threshold
+NOISE_GATE = 200
+VA_THRESHOLD = 500
+DETECTORS = (
+    ("before", ThresholdVAD, 0.0),
+    ("threshold", ThresholdVAD, PREROLL),
+    ("adaptive", AdaptiveVAD, PREROLL),
+)
+
+
+def synthetic(seconds, seed, loudness, room, clutter=False, fan_step=False):
+    """(16-bit PCM, [(start, end)] talk spurts) of speech with pauses.
+
+    loudness is the voice's peak amplitude, room the background noise RMS;
+    clutter puts breaths and key clicks in the pauses, fan_step makes the
+    background 15 dB louder halfway (low-passed, like a fan).
+    """
+    rng = random.Random(seed)
+    total = int(seconds * SAMPLE_RATE)
+    signal = [0.0] * total
+    labels = []
+    pos = int(rng.uniform(0.5, 1.5) * SAMPLE_RATE)
+    phase = 0.0
+    while pos < total:
+        length = min(int(rng.uniform(0.6, 2.5) * SAMPLE_RATE), total - pos)
+        labels.append((pos / SAMPLE_RATE, (pos + length) / SAMPLE_RATE))
+        base = rng.uniform(100, 220)
+        onset = int(0.06 * SAMPLE_RATE)
+        for i in range(length):
+            t = i / SAMPLE_RATE
+            fade = min(1.0, 8 * t, 10 * (length / SAMPLE_RATE - t))
+            if i < onset:
+                # Unvoiced onset, like "s" or "f": quiet hiss
+                signal[pos + i] += rng.gauss(0, loudness / 12) * fade
+                continue
+            pitch = base * (1 + 0.15 * math.sin(2 * math.pi * 0.8 * t))
+            phase += 2 * math.pi * pitch / SAMPLE_RATE
+            # Syllables at 4 a second, with dips between words
+            envelope = 0.15 + 0.85 * max(0.0, math.sin(math.pi * 4 * t)) ** 0.7
+            value = sum(math.sin(k * phase) / k for k in range(1, 8))
+            signal[pos + i] += loudness / 2.6 * fade * envelope * value
+        pos += length
+        pause = int(rng.uniform(0.5, 2.5) * SAMPLE_RATE)
+        if clutter and pos + pause < total:
+            start = pos + rng.randrange(pause // 2)
+            breath = int(0.4 * SAMPLE_RATE)
+            for i in range(min(breath, total - start)):
+                signal[start + i] += rng.gauss(0, loudness / 12) * math.sin(math.pi * i / breath)
+            for _ in range(rng.randrange(5)):
+                at = pos + rng.randrange(pause)
+                for i in range(min(480, total - at)):
+                    signal[at + i] += rng.gauss(0, loudness / 2) * math.exp(-i / 60)
+        pos += pause
+    low = 0.0
+    for i in range(total):
+        if fan_step:
+            level = room * (5.6 if i > total // 2 else 1.0)
+            low += 0.1 * (rng.gauss(0, level * 3.5) - low)
+            signal[i] += low
+        else:
+            signal[i] += rng.gauss(0, room)
+    samples = array.array('h', (max(-32768, min(32767, int(v))) for v in signal))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes(), labels
+
+
+def read_labels(path):
+    labels = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.split("\t")
+            if len(fields) >= 2 and fields[0].strip():
+                labels.append((float(fields[0]), float(fields[1])))
+    return labels
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2 or wav.getframerate() != SAMPLE_RATE:
+            sys.exit(f"{path}: need 48 kHz mono 16-bit PCM")
+        return wav.readframes(wav.getnframes())
+
+
+def write_fixture(directory, name, pcm, labels):
+    with wave.open(os.path.join(directory, name + ".wav"), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(pcm)
+    with open(os.path.join(directory, name + ".txt"), 'w', encoding='utf-8') as f:
+        for start, end in labels:
+            f.write(f"{start:.3f}\t{end:.3f}\tspeech\n")
+
+
+def decide(pcm, detector, preroll):
+    """[frame sent] for every frame of pcm, as the capture pipeline would, and seconds spent deciding."""
+    hold = math.ceil(preroll / FRAME_SECONDS)
+    sent = []
+    held = 0  # frames not sent, up to hold, that a start of speech sends after all
+    spent = 0.0
+    for start in range(0, len(pcm) - FRAME_BYTES + 1, FRAME_BYTES):
+        frame = pcm[start:start + FRAME_BYTES]
+        t0 = time.perf_counter()
+        go = detector.is_speech(frame, dsp.rms(frame), NOISE_GATE)
+        spent += time.perf_counter() - t0
+        if go:
+            for i in range(len(sent) - held, len(sent)):
+                sent[i] = True
+            held = 0
+        else:
+            held = min(hold, held + 1)
+        sent.append(go)
+    return sent, spent
+
+
+def score(sent, labels):
+    """(speech %, noise %, mean clip ms, false bursts)"""
+    speech = [False] * len(sent)
+    spans = []
+    for start, end in labels:
+        first = min(len(sent), int(start / FRAME_SECONDS + 0.5))
+        last = min(len(sent), int(end / FRAME_SECONDS + 0.5))
+        spans.append((first, last))
+        for i in range(first, last):
+            speech[i] = True
+    speech_frames = sum(speech)
+    noise_frames = len(sent) - speech_frames
+    hit = sum(1 for s, sp in zip(sent, speech) if s and sp)
+    false = sum(1 for s, sp in zip(sent, speech) if s and not sp)
+    clips = []
+    for first, last in spans:
+        onset = next((i for i in range(first, last) if sent[i]), last)
+        # Frames sent just before the label (pre-roll) cover the onset too
+        if first and sent[first - 1]:
+            onset = first
+        clips.append((onset - first) * FRAME_SECONDS * 1000)
+    bursts = 0
+    i = 0
+    while i < len(sent):
+        if not sent[i]:
+            i += 1
+            continue
+        j = i
+        while j < len(sent) and sent[j]:
+            j += 1
+        if not any(speech[max(0, i - 1):j + 1]):
+            bursts += 1
+        i = j
+    return (100 * hit / speech_frames if speech_frames else float('nan'),
+            100 * false / noise_frames if noise_frames else float('nan'),
+            sum(clips) / len(clips) if clips else float('nan'), bursts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--wav", nargs="+", default=[], help="labelled 48 kHz mono 16-bit recordings")
+    parser.add_argument("--seconds", type=float, default=30.0, help="length of the synthetic recordings")
+    parser.add_argument("--write", metavar="DIR", help="save the synthetic recordings and labels")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.wav:
+        recordings = [(os.path.basename(path), read_wav(path), read_labels(os.path.splitext(path)[0] + ".txt"))
+                      for path in args.wav]
+    else:
+        recordings = [
+            ("quiet-room", *synthetic(args.seconds, args.seed, 9000, 40)),
+            ("breath+keys", *synthetic(args.seconds, args.seed + 1, 9000, 40, clutter=True)),
+            ("fan-step", *synthetic(args.seconds, args.seed + 2, 4000, 60, fan_step=True)),
+        ]
+        if args.write:
+            os.makedirs(args.write, exist_ok=True)
+            for name, pcm, labels in recordings:
+                write_fixture(args.write, name, pcm, labels)
+
+    print(f"dsp backend: {dsp.BACKEND.name}; noise gate {NOISE_GATE}, va_threshold {VA_THRESHOLD}, "
+          f"pre-roll {PREROLL * 1000:.0f} ms")
+    header = (f"{'recording':<14} {'detector':<9} {'speech %':>8} {'noise %':>8} {'clip ms':>8} "
+              f"{'false':>6} {'us/frame':>9}")
+    print(header)
+    print("-" * len(header))
+    for name, pcm, labels in recordings:
+        for detector_name, detector, preroll in DETECTORS:
+            sent, spent = decide(pcm, detector(VA_THRESHOLD), preroll)
+            speech, noise, clip, bursts = score(sent, labels)
+            print(f"{name:<14} {detector_name:<9} {speech:>8.1f} {noise:>8.1f} {clip:>8.1f} "
+                  f"{bursts:>6} {spent / len(sent) * 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
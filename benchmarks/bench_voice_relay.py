@@ -0,0 +1,232 @@
+"""
+Voice relay cost: frames per CPU-second (one core).
+
+inproc  the server's receive + fan-out path in this process over loopback
+        sockets. Each batch of frames is written first, untimed; only the
+        relay loop reading it is timed (time.process_time):
+          tcp-legacy  recv_exact with bytes +=, length header re-packed
+          tcp         VoiceFrameBuffer (recv_into, one bytes copy per frame)
+          udp-legacy  recvfrom, body sliced, TCP frame and datagram rebuilt
+          udp         recvfrom_into, datagram relayed as received
+        Every frame is queued for --recipients listeners.
+server  a real server (child process) per engine; --senders TCP senders
+        stream frames to the channel as fast as the pool can send them.
+        Reports frames ingested per second of server CPU time.
+
+    python -m benchmarks.bench_voice_relay --recipients 1 10 50
+"""
+
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.server_harness import ServerProcess, ClientPool, USER_PREFIX
+from server.config import MAX_VOICE_FRAME, UDP_PEER_TIMEOUT
+from server.protocol import UDP_VOICE, build_udp_datagram, parse_udp_datagram, timestamp_ms
+from server.state import ServerState
+from server.text_queue import TextSendQueue
+from server.voice_handler import VoiceFrameBuffer, broadcast_voice, handle_voice_datagram
+from server.voice_queue import VoiceSendQueue
+
+CHANNEL = "General"
+PAYLOAD = 80  # a 20 ms Opus frame at ~32 kbit/s
+
+
+class FakeSocket:
+    pass
+
+
+def make_state(recipients, udp):
+    """Sender plus recipients in one channel; recipients are UDP-bound if udp."""
+    state = ServerState()
+    state.udp_sock = FakeSocket() if udp else None
+    socks = []
+    for i in range(recipients + 1):
+        ts, vs = FakeSocket(), FakeSocket()
+        state.add_text_client(ts, f"user{i}", TextSendQueue())
+        # Never drained; keep queues short so memory stays flat
+        state.add_voice_client(vs, f"user{i}", VoiceSendQueue(maxlen=4))
+        state.set_channel(ts, CHANNEL)
+        if udp:
+            addr = ("127.0.0.1", 40000 + i)
+            state.voice_clients[vs].update(udp_addr=addr, udp_seen=time.monotonic() + 3600)
+            state.udp_peers[addr] = vs
+        socks.append(vs)
+    return state, socks[0]
+
+
+def legacy_recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def legacy_broadcast(framed_data, sender_sock, state, seq=None, timestamp=None):
+    """broadcast_voice as it was before VoiceFrameBuffer (datagram rebuilt from the frame)."""
+    sender_info = state.voice_clients.get(sender_sock)
+    if not sender_info or not sender_info.get("channel"):
+        return
+
+    datagram = None
+    now = time.monotonic()
+    for sock, info in state.get_voice_roster(sender_info["channel"]):
+        if sock is sender_sock:
+            continue
+        if (info["udp_addr"] and state.udp_sock is not None
+                and now - info["udp_seen"] < UDP_PEER_TIMEOUT):
+            if datagram is None:
+                if seq is None:
+                    seq = sender_info["tx_seq"]
+                    sender_info["tx_seq"] = (seq + 1) & 0xFFFF
+                    timestamp = timestamp_ms()
+                datagram = build_udp_datagram(UDP_VOICE, seq, timestamp, framed_data[4:])
+            info["queue"].put(datagram, info["udp_addr"])
+        else:
+            info["queue"].put(framed_data)
+
+
+def run_tcp(mode, frames, recipients):
+    state, sender = make_state(recipients, udp=False)
+    a, b = socket.socketpair()
+    batch = 64 * 1024 // (4 + PAYLOAD)
+    chunk = (struct.pack('>I', PAYLOAD) + bytes(PAYLOAD)) * batch
+    buf = VoiceFrameBuffer()
+    cpu = 0.0
+    for _ in range(frames // batch):
+        a.sendall(chunk)  # not timed: the kernel now holds one batch
+        t = time.process_time()
+        if mode == "tcp-legacy":
+            for _ in range(batch):
+                len_data = legacy_recv_exact(b, 4)
+                msg_len = struct.unpack('>I', len_data)[0]
+                voice_data = legacy_recv_exact(b, msg_len)
+                legacy_broadcast(struct.pack('>I', msg_len) + voice_data, sender, state)
+        else:
+            relayed = 0
+            while relayed < batch:
+                frame = buf.next_frame()
+                if frame is None:
+                    buf.filled(b.recv_into(buf.writable()))
+                    continue
+                broadcast_voice(frame, sender, state)
+                relayed += 1
+        cpu += time.process_time() - t
+    a.close()
+    b.close()
+    return frames // batch * batch, cpu
+
+
+def run_udp(mode, frames, recipients):
+    state, sender = make_state(recipients, udp=True)
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(("127.0.0.1", 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tx.connect(rx.getsockname())
+    # The relay sees the datagrams as coming from the bound sender
+    addr = tx.getsockname()
+    state.udp_peers[addr] = sender
+    state.voice_clients[sender]["udp_addr"] = addr
+    body = struct.pack('>H', 5) + b"user0" + b"\x01" + struct.pack('>H', PAYLOAD) + bytes(PAYLOAD)
+    batch = 100  # fits in the default receive buffer
+    buf = bytearray(7 + MAX_VOICE_FRAME)
+    view = memoryview(buf)
+    cpu = 0.0
+    for i in range(frames // batch):
+        for j in range(batch):
+            tx.send(build_udp_datagram(UDP_VOICE, i * batch + j, 0, body))
+        t = time.process_time()
+        if mode == "udp-legacy":
+            for _ in range(batch):
+                data, peer = rx.recvfrom(MAX_VOICE_FRAME)
+                kind, seq, timestamp, payload = parse_udp_datagram(data)
+                sender_sock = state.touch_udp_peer(peer)
+                legacy_broadcast(struct.pack('>I', len(payload)) + payload, sender_sock, state, seq, timestamp)
+        else:
+            for _ in range(batch):
+                n, peer = rx.recvfrom_into(buf)
+                handle_voice_datagram(view[:n], peer, state)
+        cpu += time.process_time() - t
+    rx.close()
+    tx.close()
+    return frames // batch * batch, cpu
+
+
+def run_server(engine, senders, listeners, seconds):
+    server = ServerProcess(engine, senders + listeners)
+    received = [0]
+    lock = threading.Lock()
+
+    def on_voice(client, payload):
+        with lock:
+            received[0] += 1
+
+    pool = ClientPool("127.0.0.1", server.text_port, server.voice_port, on_voice=on_voice)
+    try:
+        clients = [pool.connect(f"{USER_PREFIX}{i}") for i in range(senders + listeners)]
+        time.sleep(0.3)
+        for c in clients:
+            pool.send_text(c, f"JOIN_CHANNEL:{CHANNEL}")
+        time.sleep(0.5)
+
+        payload = bytes(PAYLOAD)
+        sent = 0
+        cpu0, t0 = server.cpu_seconds(), time.perf_counter()
+        while time.perf_counter() - t0 < seconds:
+            for c in clients[:senders]:
+                pool.send_voice(c, payload)
+                sent += 1
+        time.sleep(0.5)
+        cpu = server.cpu_seconds() - cpu0
+        elapsed = time.perf_counter() - t0
+    finally:
+        pool.close()
+        server.stop()
+    return sent, received[0], cpu, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("inproc", "server"), nargs="+", default=["inproc", "server"])
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--recipients", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--senders", type=int, default=4)
+    parser.add_argument("--listeners", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    if "inproc" in args.mode:
+        print(f"in-process relay, {args.frames} frames of {PAYLOAD} B payload")
+        header = f"{'recipients':>10} {'path':<11} {'frames/cpu-s':>13} {'us/frame':>9} {'speedup':>8}"
+        print(header)
+        print("-" * len(header))
+        for n in args.recipients:
+            for legacy, new, run in (("tcp-legacy", "tcp", run_tcp), ("udp-legacy", "udp", run_udp)):
+                base = None
+                for mode in (legacy, new):
+                    frames, cpu = run(mode, args.frames, n)
+                    rate = frames / cpu
+                    base = base or rate
+                    print(f"{n:>10} {mode:<11} {rate:>13.0f} {cpu / frames * 1e6:>9.2f} {rate / base:>7.2f}x")
+
+    if "server" in args.mode:
+        print(f"\nserver process, {args.senders} TCP senders -> {args.listeners} listeners, {args.seconds:.0f} s")
+        header = f"{'engine':<9} {'sent':>8} {'delivered':>10} {'server cpu s':>12} {'frames/cpu-s':>13}"
+        print(header)
+        print("-" * len(header))
+        for engine in ("threaded", "asyncio"):
+            sent, delivered, cpu, _ = run_server(engine, args.senders, args.listeners, args.seconds)
+            print(f"{engine:<9} {sent:>8} {delivered:>10} {cpu:>12.2f} {sent / cpu if cpu else float('nan'):>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
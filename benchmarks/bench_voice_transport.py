@@ -0,0 +1,340 @@
+"""
+Loopback harness: TCP vs UDP voice under injected loss and reordering.
+
+A sender and a receiver log in to a real server (child process) and join
+General. The sender emits one frame every 20 ms carrying its capture time.
+The server -> receiver leg goes through an impairment proxy:
+
+    UDP  dropped datagrams are gone; "reordered" ones are held back by
+         --reorder-delay so later datagrams overtake them.
+    TCP  the payload can't be lost, so a lost segment is modelled as a
+         retransmission: it and everything behind it wait --tcp-rto
+         (head-of-line blocking). Reordered segments likewise stall the stream.
+
+Mouth-to-ear is capture time -> arrival at the receiver plus one frame of
+capture. Frames arriving after the --playout deadline count as late, which
+the listener hears as a gap just like a lost frame.
+
+    python -m benchmarks.bench_voice_transport --loss 0.02 --reorder 0.05
+"""
+
+import argparse
+import heapq
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.server_harness import ServerProcess, PASSWORD, USER_PREFIX, percentile
+from client.protocol import (
+    UDP_HELLO, UDP_HELLO_ACK, UDP_VOICE,
+    build_udp_datagram, parse_udp_datagram, timestamp_ms,
+)
+from client.audio.opus_codec import build_voice_frame, parse_voice_frame, CODEC_ID_RAW
+
+FRAME_MS = 20
+
+
+class Impairment:
+    """Decides the extra delay for each packet; None means drop."""
+
+    def __init__(self, loss, reorder, reorder_delay, rto, seed):
+        self.loss = loss
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.rto = rto
+        self.rng = random.Random(seed)
+
+    def udp_delay(self):
+        r = self.rng.random()
+        if r < self.loss:
+            return None
+        if r < self.loss + self.reorder:
+            return self.reorder_delay
+        return 0.0
+
+    def tcp_delay(self):
+        r = self.rng.random()
+        if r < self.loss:
+            return self.rto
+        if r < self.loss + self.reorder:
+            return self.reorder_delay
+        return 0.0
+
+
+class DelayLine(threading.Thread):
+    """Releases (deliver_at, data) items through send() at their due time."""
+
+    def __init__(self, send, in_order):
+        super().__init__(daemon=True)
+        self.send = send
+        self.in_order = in_order
+        self.heap = []
+        self.cv = threading.Condition()
+        self.last_due = 0.0
+        self.counter = 0
+        self.running = True
+
+    def put(self, delay, data):
+        with self.cv:
+            due = time.perf_counter() + delay
+            if self.in_order:
+                # TCP: nothing overtakes a stalled segment
+                due = max(due, self.last_due)
+                self.last_due = due
+            self.counter += 1
+            heapq.heappush(self.heap, (due, self.counter, data))
+            self.cv.notify()
+
+    def run(self):
+        while self.running:
+            with self.cv:
+                while not self.heap:
+                    self.cv.wait(0.1)
+                    if not self.running:
+                        return
+                due, _, data = self.heap[0]
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    self.cv.wait(wait)
+                    continue
+                heapq.heappop(self.heap)
+            try:
+                self.send(data)
+            except OSError:
+                return
+
+
+def tcp_proxy(server_port, impairment):
+    """Accept one client and forward to server_port; impair server -> client."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def run():
+        client, _ = listener.accept()
+        upstream = socket.create_connection(("127.0.0.1", server_port))
+        for s in (client, upstream):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        line = DelayLine(client.sendall, in_order=True)
+        line.start()
+        while True:
+            readable, _, _ = select.select([client, upstream], [], [])
+            for s in readable:
+                data = s.recv(65536)
+                if not data:
+                    return
+                if s is client:
+                    upstream.sendall(data)
+                else:
+                    line.put(impairment.tcp_delay(), data)
+
+    threading.Thread(target=run, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def udp_proxy(server_port, impairment):
+    """Relay datagrams between one client and the server; impair server -> client."""
+    front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    front.bind(("127.0.0.1", 0))
+    back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    back.connect(("127.0.0.1", server_port))
+    client_addr = {}
+
+    def run():
+        line = DelayLine(lambda d: front.sendto(d, client_addr["a"]), in_order=False)
+        line.start()
+        while True:
+            readable, _, _ = select.select([front, back], [], [])
+            for s in readable:
+                if s is front:
+                    data, client_addr["a"] = front.recvfrom(65536)
+                    back.send(data)
+                else:
+                    data = back.recv(65536)
+                    kind = data[0] if data else None
+                    delay = 0.0 if kind == UDP_HELLO_ACK else impairment.udp_delay()
+                    if delay is not None:
+                        line.put(delay, data)
+
+    threading.Thread(target=run, daemon=True).start()
+    return front.getsockname()[1]
+
+
+class VoiceUser:
+    """Minimal blocking client: text login, TCP voice, optional UDP voice."""
+
+    def __init__(self, text_port, voice_port, username):
+        self.username = username
+        self.text = socket.create_connection(("127.0.0.1", text_port))
+        self.text_buf = b""
+        self.send_line(f"LOGIN:{username}:{PASSWORD}")
+        self.expect("AUTH_OK")
+        self.voice = socket.create_connection(("127.0.0.1", voice_port))
+        self.voice.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.voice.sendall(username.encode("utf-8"))
+        self.udp = None
+        self.seq = 0
+
+    def send_line(self, line):
+        self.text.sendall((line + "\n").encode("utf-8"))
+
+    def expect(self, prefix, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            while b"\n" in self.text_buf:
+                raw, self.text_buf = self.text_buf.split(b"\n", 1)
+                line = raw.decode("utf-8")
+                if line.startswith(prefix):
+                    return line
+            self.text.settimeout(max(0.01, deadline - time.monotonic()))
+            try:
+                self.text_buf += self.text.recv(65536)
+            except socket.timeout:
+                break
+        raise RuntimeError(f"{self.username}: no {prefix}")
+
+    def negotiate_udp(self, port):
+        self.send_line("VOICE_UDP")
+        token = self.expect("VOICE_UDP:").split(":", 1)[1]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.connect(("127.0.0.1", port))
+        self.udp.settimeout(0.5)
+        for _ in range(10):
+            self.udp.send(build_udp_datagram(UDP_HELLO, 0, timestamp_ms(), token.encode("ascii")))
+            try:
+                parsed = parse_udp_datagram(self.udp.recv(65536))
+                if parsed and parsed[0] == UDP_HELLO_ACK:
+                    return
+            except socket.timeout:
+                pass
+        raise RuntimeError("UDP negotiation failed")
+
+    def send_frame(self, body):
+        frame = build_voice_frame(self.username, CODEC_ID_RAW, body)
+        if self.udp:
+            self.udp.send(build_udp_datagram(UDP_VOICE, self.seq, timestamp_ms(), frame[4:]))
+            self.seq = (self.seq + 1) & 0xFFFF
+        else:
+            self.voice.sendall(frame)
+
+
+def run_transport(transport, server, impairment, frames, playout):
+    sender = VoiceUser(server.text_port, server.voice_port, f"{USER_PREFIX}0")
+    if transport == "udp":
+        receiver = VoiceUser(server.text_port, server.voice_port, f"{USER_PREFIX}1")
+        sender.negotiate_udp(server.voice_port)
+        receiver.negotiate_udp(udp_proxy(server.voice_port, impairment))
+    else:
+        receiver = VoiceUser(server.text_port, tcp_proxy(server.voice_port, impairment), f"{USER_PREFIX}1")
+    time.sleep(0.3)  # voice sessions must exist before the join updates their channel
+    for user in (sender, receiver):
+        user.send_line("JOIN_CHANNEL:General")
+    time.sleep(0.5)
+
+    arrivals = {}
+    reordered = [0]
+    done = threading.Event()
+
+    def on_payload(payload):
+        parsed = parse_voice_frame(payload)
+        if not parsed:
+            return
+        seq, sent_at = struct.unpack(">Id", parsed[2][:12])
+        if arrivals and seq < max(arrivals):
+            reordered[0] += 1
+        arrivals.setdefault(seq, time.perf_counter() - sent_at)
+
+    def receive():
+        if transport == "udp":
+            receiver.udp.settimeout(0.5)
+            while not done.is_set():
+                try:
+                    parsed = parse_udp_datagram(receiver.udp.recv(65536))
+                except socket.timeout:
+                    continue
+                if parsed and parsed[0] == UDP_VOICE:
+                    on_payload(parsed[3])
+        else:
+            buf = b""
+            receiver.voice.settimeout(0.5)
+            while not done.is_set():
+                try:
+                    data = receiver.voice.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    return
+                buf += data
+                while len(buf) >= 4 and len(buf) >= 4 + struct.unpack(">I", buf[:4])[0]:
+                    size = struct.unpack(">I", buf[:4])[0]
+                    on_payload(buf[4:4 + size])
+                    buf = buf[4 + size:]
+
+    rx = threading.Thread(target=receive, daemon=True)
+    rx.start()
+
+    start = time.perf_counter()
+    for seq in range(frames):
+        due = start + seq * FRAME_MS / 1000.0
+        pause = due - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+        sender.send_frame(struct.pack(">Id", seq, time.perf_counter()) + bytes(48))
+    time.sleep(max(1.0, impairment.rto * 3))
+    done.set()
+    rx.join(1)
+
+    delays = [FRAME_MS + d * 1000 for d in arrivals.values()]
+    late = sum(1 for d in delays if d > playout)
+    return {
+        "transport": transport,
+        "received": len(arrivals),
+        "lost": frames - len(arrivals),
+        "late": late,
+        "reordered": reordered[0],
+        "p50": percentile(delays, 50),
+        "p95": percentile(delays, 95),
+        "p99": percentile(delays, 99),
+        "max": max(delays) if delays else float("nan"),
+        "audible_gaps": frames - len(arrivals) + late,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--loss", type=float, default=0.02)
+    parser.add_argument("--reorder", type=float, default=0.05)
+    parser.add_argument("--reorder-delay", type=float, default=0.03, help="seconds")
+    parser.add_argument("--tcp-rto", type=float, default=0.2, help="seconds")
+    parser.add_argument("--playout", type=float, default=80.0, help="playout deadline, ms")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"loss={args.loss:.0%} reorder={args.reorder:.0%} (+{args.reorder_delay * 1000:.0f} ms) "
+          f"tcp_rto={args.tcp_rto * 1000:.0f} ms playout={args.playout:.0f} ms frames={args.frames}")
+    header = (f"{'transport':<9} {'recv':>5} {'lost':>5} {'late':>5} {'reord':>5} "
+              f"{'m2e p50':>8} {'p95':>7} {'p99':>7} {'max':>7} {'gaps':>5}")
+    print(header)
+    print("-" * len(header))
+    for transport in ("tcp", "udp"):
+        server = ServerProcess(args.engine, 2)
+        try:
+            impairment = Impairment(args.loss, args.reorder, args.reorder_delay, args.tcp_rto, args.seed)
+            r = run_transport(transport, server, impairment, args.frames, args.playout)
+        finally:
+            server.stop()
+        print(f"{r['transport']:<9} {r['received']:>5} {r['lost']:>5} {r['late']:>5} {r['reordered']:>5} "
+              f"{r['p50']:>8.1f} {r['p95']:>7.1f} {r['p99']:>7.1f} {r['max']:>7.1f} {r['audible_gaps']:>5}")
+
+
+if __name__ == "__main__":
+    main()
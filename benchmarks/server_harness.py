@@ -0,0 +1,302 @@
+"""
+Shared helpers for server benchmarks.
+
+The server under test runs in a child process (so it gets its own GIL and its
+thread count can be read from /proc), the load clients run in the benchmark
+process on a single selector thread.
+
+    python -m benchmarks.server_harness --engine asyncio --users 500
+"""
+
+import argparse
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "benchpass"
+USER_PREFIX = "u"
+
+
+def make_managers(num_users, data_dir=None):
+    """AuthManager/ChannelManager backed by a temp dir with num_users accounts."""
+    from server.auth import AuthManager
+    from server.channels import ChannelManager
+
+    data_dir = data_dir or tempfile.mkdtemp(prefix="hybrid_bench_")
+    auth_mgr = AuthManager(os.path.join(data_dir, "users.json"))
+    for i in range(num_users):
+        auth_mgr.users[f"{USER_PREFIX}{i}"] = {
+            "password_hash": AuthManager._hash_password(PASSWORD),
+            "created_at": "",
+        }
+    auth_mgr._save()
+    channel_mgr = ChannelManager(os.path.join(data_dir, "channels.json"))
+    return auth_mgr, channel_mgr
+
+
+def _listen(port=0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", port))
+    sock.listen(1024)
+    return sock
+
+
+def serve_forever(engine, num_users):
+    """Child process body: start the engine on ephemeral ports and print them."""
+    from server.state import ServerState
+    from server.text_handler import accept_text_clients
+    from server.voice_handler import accept_voice_clients, serve_voice_udp
+
+    state = ServerState()
+    auth_mgr, channel_mgr = make_managers(num_users)
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+
+    def announce(text_port, voice_port):
+        real_stdout.write(f"PORTS {text_port} {voice_port}\n")
+        real_stdout.flush()
+
+    if engine == "asyncio":
+        import asyncio
+        from server.async_engine import start_servers
+
+        async def main():
+            text_srv, voice_srv = await start_servers(
+                state, auth_mgr, channel_mgr, "127.0.0.1", 0, 0
+            )
+            announce(text_srv.sockets[0].getsockname()[1], voice_srv.sockets[0].getsockname()[1])
+            await asyncio.gather(text_srv.serve_forever(), voice_srv.serve_forever())
+
+        asyncio.run(main())
+    else:
+        text_srv, voice_srv = _listen(), _listen()
+        threading.Thread(target=accept_text_clients,
+                         args=(text_srv, state, auth_mgr, channel_mgr), daemon=True).start()
+        threading.Thread(target=accept_voice_clients, args=(voice_srv, state), daemon=True).start()
+        udp_srv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_srv.bind(("127.0.0.1", voice_srv.getsockname()[1]))
+        threading.Thread(target=serve_voice_udp, args=(udp_srv, state), daemon=True).start()
+        announce(text_srv.getsockname()[1], voice_srv.getsockname()[1])
+        while True:
+            time.sleep(3600)
+
+
+class ServerProcess:
+    """Runs serve_forever() in a child interpreter."""
+
+    def __init__(self, engine, num_users):
+        self.engine = engine
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.server_harness",
+             "--engine", engine, "--users", str(num_users)],
+            cwd=ROOT, stdout=subprocess.PIPE, text=True,
+        )
+        line = self.proc.stdout.readline().split()
+        if not line or line[0] != "PORTS":
+            self.stop()
+            raise RuntimeError(f"server did not start: {line}")
+        self.text_port, self.voice_port = int(line[1]), int(line[2])
+
+    def proc_status(self):
+        """Threads and resident memory (KiB) of the server, Linux only."""
+        stats = {}
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for row in f:
+                    key, _, value = row.partition(":")
+                    if key == "Threads":
+                        stats["threads"] = int(value)
+                    elif key == "VmRSS":
+                        stats["rss_kb"] = int(value.split()[0])
+        except OSError:
+            pass
+        return stats
+
+    def cpu_seconds(self):
+        """User + system CPU time used by the server so far, Linux only."""
+        try:
+            with open(f"/proc/{self.proc.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return float("nan")
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def stop(self):
+        self.proc.kill()
+        self.proc.wait()
+
+
+class LoadClient:
+    """One simulated user: a text socket and an optional voice socket."""
+
+    def __init__(self, username):
+        self.username = username
+        self.text_sock = None
+        self.voice_sock = None
+        self.text_buf = b""
+        self.voice_buf = b""
+        self.authed = threading.Event()
+        self.failed = False
+
+
+class ClientPool:
+    """Drives many LoadClients from one selector thread.
+
+    on_line(client, line) and on_voice(client, payload) are called from the
+    selector thread for every received text line / voice frame payload.
+    """
+
+    def __init__(self, host, text_port, voice_port, on_line=None, on_voice=None):
+        self.host = host
+        self.text_port = text_port
+        self.voice_port = voice_port
+        self.on_line = on_line
+        self.on_voice = on_voice
+        self.clients = []
+        self.sel = selectors.DefaultSelector()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self.running = True
+        self._wake_r, self._wake_w = socket.socketpair()
+        self.sel.register(self._wake_r, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _register(self, sock, client, kind):
+        sock.setblocking(False)
+        with self._pending_lock:
+            self._pending.append((sock, (client, kind)))
+        self._wake_w.send(b"x")
+
+    def connect(self, username, join_channel=None, voice=True, timeout=10.0, voice_handshake=None):
+        """Log in one user. Returns the LoadClient or None on failure.
+
+        voice_handshake replaces the plain username sent on the voice socket.
+        """
+        client = LoadClient(username)
+        try:
+            client.text_sock = socket.create_connection((self.host, self.text_port), timeout=timeout)
+            client.text_sock.sendall(f"LOGIN:{username}:{PASSWORD}\n".encode("utf-8"))
+            self._register(client.text_sock, client, "text")
+            if not client.authed.wait(timeout) or client.failed:
+                return None
+            if voice:
+                client.voice_sock = socket.create_connection((self.host, self.voice_port), timeout=timeout)
+                client.voice_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                client.voice_sock.sendall((voice_handshake or username).encode("utf-8"))
+                self._register(client.voice_sock, client, "voice")
+            if join_channel:
+                self.send_text(client, f"JOIN_CHANNEL:{join_channel}")
+        except OSError:
+            return None
+        self.clients.append(client)
+        return client
+
+    def send_text(self, client, line):
+        self._send(client.text_sock, (line + "\n").encode("utf-8"))
+
+    def send_voice(self, client, payload):
+        self._send(client.voice_sock, struct.pack(">I", len(payload)) + payload)
+
+    @staticmethod
+    def _send(sock, data):
+        view = memoryview(data)
+        while view:
+            try:
+                sent = sock.send(view)
+                view = view[sent:]
+            except BlockingIOError:
+                time.sleep(0.0005)
+
+    def _loop(self):
+        while self.running:
+            for key, _ in self.sel.select(0.5):
+                if key.data is None:
+                    self._wake_r.recv(4096)
+                    with self._pending_lock:
+                        pending, self._pending = self._pending, []
+                    for sock, data in pending:
+                        self.sel.register(sock, selectors.EVENT_READ, data)
+                    continue
+                client, kind = key.data
+                try:
+                    data = key.fileobj.recv(65536)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    data = b""
+                if not data:
+                    self.sel.unregister(key.fileobj)
+                    client.failed = True
+                    client.authed.set()
+                    continue
+                if kind == "text":
+                    self._on_text(client, data)
+                else:
+                    self._on_voice(client, data)
+
+    def _on_text(self, client, data):
+        client.text_buf += data
+        while True:
+            idx = client.text_buf.find(b"\n")
+            if idx < 0:
+                break
+            line = client.text_buf[:idx].decode("utf-8", "replace")
+            client.text_buf = client.text_buf[idx + 1:]
+            if not client.authed.is_set():
+                if line.startswith("AUTH_OK"):
+                    client.authed.set()
+                elif line.startswith("AUTH_FAIL"):
+                    client.failed = True
+                    client.authed.set()
+            if self.on_line:
+                self.on_line(client, line)
+
+    def _on_voice(self, client, data):
+        client.voice_buf += data
+        while len(client.voice_buf) >= 4:
+            size = struct.unpack(">I", client.voice_buf[:4])[0]
+            if len(client.voice_buf) < 4 + size:
+                break
+            payload = client.voice_buf[4:4 + size]
+            client.voice_buf = client.voice_buf[4 + size:]
+            if self.on_voice:
+                self.on_voice(client, payload)
+
+    def close(self):
+        self.running = False
+        for client in self.clients:
+            for sock in (client.text_sock, client.voice_sock):
+                if sock:
+                    try:
+                        sock.close()
+                    except OSError:
+                        pass
+        self.thread.join(2)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+    serve_forever(args.engine, args.users)
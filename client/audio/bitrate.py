@@ -0,0 +1,161 @@
+"""
+Send-side congestion control for our Opus stream.
+
+Inputs: round-trip times from PING/PONG on the text connection, loss and
+jitter reported by the people hearing us (VOICE_REPORT), and our own encode
+time. Every update() the controller picks a bitrate (AIMD: multiplicative
+decrease on loss or queueing delay, additive increase on a clean link),
+tunes FEC to the loss it sees and trades Opus complexity against encode
+CPU, all within the configured bounds, and logs what it changed.
+
+Given the VoiceClient, it also adapts packetization: each congested update
+bundles one more frame per packet (fewer packets and less header overhead
+per second, up to what the server granted), and after FRAMES_CLEAN_UPDATES
+clean ones in a row it takes one back, down to the configured number. The
+frame duration itself stays as negotiated: capture processing is built
+around it.
+"""
+
+import collections
+import time
+from client.audio.opus_codec import BITRATE, EXPECTED_LOSS, SAMPLE_RATE
+
+MIN_BITRATE = 12000
+MAX_BITRATE = 64000
+INCREASE_STEP = 4000     # bit/s added per clean update
+DECREASE_FACTOR = 0.8    # bitrate kept on congestion
+LOSS_HIGH = 10.0         # % loss that counts as congestion
+LOSS_LOW = 2.0           # % loss below which the link is clean
+DELAY_HIGH = 0.15        # queueing delay (RTT above the minimum seen) that is congestion (s)
+DELAY_LOW = 0.05
+RTT_WINDOW = 60.0        # minimum RTT is taken over this long (s)
+REPORT_MAX_AGE = 10.0    # receiver reports older than this are ignored (s)
+MAX_FEC_LOSS = 25        # expected loss (%) FEC is never tuned above
+MIN_COMPLEXITY = 3
+MAX_COMPLEXITY = 10
+ENCODE_HIGH = 0.3        # encode time, as a share of the frame, that lowers complexity
+ENCODE_LOW = 0.1
+FRAMES_CLEAN_UPDATES = 3  # clean updates in a row before a packet loses a frame
+
+
+class BitrateController:
+    """AIMD bitrate, FEC, complexity and packetization control for one OpusCodec.
+
+    on_rtt(), on_report() and on_encode_time() feed measurements from any
+    thread; update() (on a timer) decides and applies. Decisions are kept
+    in history and printed.
+    """
+
+    def __init__(self, codec, min_bitrate=MIN_BITRATE, max_bitrate=MAX_BITRATE,
+                 min_loss=EXPECTED_LOSS, voice=None):
+        self.codec = codec
+        self.voice = voice  # VoiceClient whose frames per packet we adapt, if any
+        self.min_frames = self.frames = voice.framing[1] if voice is not None else 1
+        self.clean_updates = 0
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.min_loss = min_loss  # FEC is never tuned below the configured expectation
+        self.bitrate = max(min_bitrate, min(max_bitrate, BITRATE))
+        self.expected_loss = min_loss
+        self.complexity = MAX_COMPLEXITY
+        self.srtt = None
+        self.rtts = collections.deque()     # (time, rtt) within RTT_WINDOW
+        self.reports = {}                   # {reporter: (time, loss %, jitter ms)}
+        self.encode_share = None
+        self.history = collections.deque(maxlen=100)  # (time, message)
+
+    def on_rtt(self, rtt, now=None):
+        now = time.monotonic() if now is None else now
+        self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+        self.rtts.append((now, rtt))
+        while self.rtts and now - self.rtts[0][0] > RTT_WINDOW:
+            self.rtts.popleft()
+
+    def on_report(self, reporter, loss, jitter_ms, now=None):
+        self.reports[reporter] = (time.monotonic() if now is None else now, loss, jitter_ms)
+
+    def on_encode_time(self, seconds):
+        """Average seconds per encoded frame since the last update (capture stage times)."""
+        self.encode_share = seconds * SAMPLE_RATE / self.codec.frame_size
+
+    def loss(self, now):
+        """Worst loss (%) among fresh receiver reports; forgets stale reporters."""
+        for reporter in [r for r, (seen, _, _) in self.reports.items() if now - seen > REPORT_MAX_AGE]:
+            del self.reports[reporter]
+        return max((loss for _, loss, _ in self.reports.values()), default=0.0)
+
+    def queueing_delay(self):
+        if self.srtt is None or not self.rtts:
+            return 0.0
+        return max(0.0, self.srtt - min(rtt for _, rtt in self.rtts))
+
+    def update(self, now=None):
+        """Decide and apply new encoder settings; returns the list of changes made."""
+        now = time.monotonic() if now is None else now
+        loss = self.loss(now)
+        delay = self.queueing_delay()
+        changes = []
+
+        bitrate = self.bitrate
+        frames = self.frames
+        if loss > LOSS_HIGH or delay > DELAY_HIGH:
+            bitrate = int(bitrate * DECREASE_FACTOR)
+            frames += 1
+            self.clean_updates = 0
+        elif loss < LOSS_LOW and delay < DELAY_LOW:
+            bitrate += INCREASE_STEP
+            self.clean_updates += 1
+            if self.clean_updates >= FRAMES_CLEAN_UPDATES:
+                frames -= 1
+                self.clean_updates = 0
+        else:
+            self.clean_updates = 0
+        bitrate = max(self.min_bitrate, min(self.max_bitrate, bitrate))
+        if bitrate != self.bitrate:
+            self.bitrate = bitrate
+            self.codec.set_bitrate(bitrate)
+            changes.append(f"битрейт {bitrate // 1000} кбит/с")
+
+        if self.voice is not None:
+            frames = self.voice.set_frames_per_packet(max(self.min_frames, frames))
+            if frames != self.frames:
+                self.frames = frames
+                changes.append(f"кадров в пакете {frames} ({frames * self.voice.framing[0]} мс)")
+
+        expected = max(self.min_loss, min(MAX_FEC_LOSS, int(loss + 0.5)))
+        if expected != self.expected_loss:
+            self.expected_loss = expected
+            self.codec.set_expected_loss(expected)
+            changes.append(f"FEC на {expected}% потерь")
+
+        complexity = self.complexity
+        share, self.encode_share = self.encode_share, None  # only fresh measurements count
+        if share is not None:
+            if share > ENCODE_HIGH:
+                complexity -= 1
+            elif share < ENCODE_LOW:
+                complexity += 1
+        complexity = max(MIN_COMPLEXITY, min(MAX_COMPLEXITY, complexity))
+        if complexity != self.complexity:
+            self.complexity = complexity
+            self.codec.set_complexity(complexity)
+            changes.append(f"сложность {complexity}")
+
+        if changes:
+            message = (f"Голос: {', '.join(changes)} (потери {loss:.1f}%, "
+                       f"RTT {self.srtt * 1000 if self.srtt is not None else 0:.0f} мс, "
+                       f"задержка очереди {delay * 1000:.0f} мс)")
+            self.history.append((now, message))
+            print(message)
+        return changes
+
+    def stats(self):
+        return {
+            "bitrate": self.bitrate,
+            "expected_loss": self.expected_loss,
+            "complexity": self.complexity,
+            "frames_per_packet": self.frames,
+            "srtt_ms": self.srtt * 1000 if self.srtt is not None else None,
+            "queueing_delay_ms": self.queueing_delay() * 1000,
+            "reports": dict(self.reports),
+        }
@@ -0,0 +1,212 @@
+"""
+Microphone capture pipeline: a PyAudio callback-mode stream fills a ring
+buffer, and a separate thread analyses, encodes and sends each frame (20 ms
+unless another frame duration was negotiated).
+
+The device callback only appends to the ring, so a slow encode or a
+blocking socket send can't make the input device overflow; if the send
+stage falls that far behind, the oldest captured frames are dropped and
+counted instead.
+"""
+
+import collections
+import math
+import threading
+import time
+import pyaudio
+from client.audio import dsp
+from client.audio.opus_codec import FRAME_SIZE, SAMPLE_RATE
+
+RING_SAMPLES = 24000     # 500 ms of captured audio waiting for the send stage
+UNDERFLOW_WAIT = 0.1    # no captured frame for this long counts as an underflow (s)
+STAGES = ("capture", "analyse", "encode", "send")
+
+
+class StageTimes:
+    """Per-stage call counts and total/max time, in seconds."""
+
+    def __init__(self, stages=STAGES):
+        self.stages = stages
+        self.calls = dict.fromkeys(stages, 0)
+        self.total = dict.fromkeys(stages, 0.0)
+        self.max = dict.fromkeys(stages, 0.0)
+
+    def add(self, stage, seconds):
+        self.calls[stage] += 1
+        self.total[stage] += seconds
+        if seconds > self.max[stage]:
+            self.max[stage] = seconds
+
+    def stats(self):
+        """{stage: {calls, avg_us, max_us}}"""
+        return {
+            stage: {
+                "calls": self.calls[stage],
+                "avg_us": self.total[stage] / self.calls[stage] * 1e6 if self.calls[stage] else 0.0,
+                "max_us": self.max[stage] * 1e6,
+            }
+            for stage in self.stages
+        }
+
+
+class CapturePipeline:
+    """Callback-mode microphone capture feeding an encode/send thread.
+
+    should_send(pcm, rms) decides per frame whether it goes out (mute,
+    voice mode, noise gate); encode(pcm, rms) returns a frame ready for the
+    wire or None, send(frame) puts it on the wire. on_sent() is called after
+    each frame sent. flush(rms), if given, is asked for a frame whenever one
+    isn't sent (a packet of several frames cut short, the talk spurt end).
+    The last preroll seconds of frames should_send said False to are held
+    back and go out first when it says true (a detector's attack time);
+    None drops the frame and anything held.
+    processor, a processing.CaptureProcessor, runs on every frame before
+    anything else; its stages are timed alongside the pipeline's own.
+    frame_size is the frame length in samples; the device delivers buffers
+    of that size.
+
+    Counters: overflows (captured frames dropped because the ring was full,
+    plus input overflows PortAudio reported), underflows (the send stage
+    waited UNDERFLOW_WAIT without a frame while capturing, plus input
+    underflows PortAudio reported).
+    """
+
+    def __init__(self, engine, should_send, encode, send, on_sent=None, flush=None,
+                 frame_size=FRAME_SIZE, preroll=0.0, processor=None):
+        self.engine = engine
+        self.should_send = should_send
+        self.encode = encode
+        self.send = send
+        self.on_sent = on_sent
+        self.flush = flush
+        self.processor = processor
+        self.frame_size = frame_size
+        self.frame_bytes = frame_size * 2
+        self.ring_frames = max(1, RING_SAMPLES // frame_size)
+        self.held = collections.deque(maxlen=math.ceil(preroll * SAMPLE_RATE / frame_size))
+        self.ring = collections.deque()
+        self.ready = threading.Event()
+        self.stream = None
+        self.running = False
+        self.times = StageTimes(STAGES + (processor.names if processor else ()))
+        self.captured = 0
+        self.sent = 0
+        self.overflows = 0
+        self.underflows = 0
+
+    def start(self):
+        """Open the input stream and start the send thread; False if the device won't open."""
+        self.running = True
+        try:
+            self.stream = self.engine.open_input_stream(callback=self._callback, frame_size=self.frame_size)
+        except Exception:
+            self.running = False
+            return False
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+
+    def stop(self):
+        self.running = False
+        self.ready.set()
+        stream, self.stream = self.stream, None
+        if stream:
+            try:
+                stream.stop_stream()
+                stream.close()
+            except Exception:
+                pass
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        """PortAudio thread: queue the buffer and return at once."""
+        if not self.running:
+            return None, pyaudio.paComplete
+        started = time.perf_counter()
+        if status & pyaudio.paInputOverflow:
+            self.overflows += 1
+        if status & pyaudio.paInputUnderflow:
+            self.underflows += 1
+        if len(self.ring) >= self.ring_frames:
+            self.ring.popleft()
+            self.overflows += 1
+        self.ring.append(in_data)
+        self.captured += 1
+        self.ready.set()
+        self.times.add("capture", time.perf_counter() - started)
+        return None, pyaudio.paContinue
+
+    def _frames(self):
+        """Yield frame_bytes chunks as they are captured, re-slicing odd buffer sizes."""
+        frame_bytes = self.frame_bytes
+        pending = b''
+        while self.running:
+            if not self.ring:
+                self.ready.clear()
+                if not self.ring and not self.ready.wait(UNDERFLOW_WAIT):
+                    self.underflows += 1
+                continue
+            data = self.ring.popleft()
+            if not pending and len(data) == frame_bytes:
+                yield data
+                continue
+            pending += data
+            while len(pending) >= frame_bytes:
+                yield pending[:frame_bytes]
+                pending = pending[frame_bytes:]
+
+    def _run(self):
+        clock = time.perf_counter
+        held = self.held
+        processor = self.processor
+        for pcm in self._frames():
+            try:
+                if processor:
+                    pcm = processor.process(pcm, self.times)
+                t0 = clock()
+                rms = dsp.rms(pcm)
+                go = self.should_send(pcm, rms)
+                t1 = clock()
+                self.times.add("analyse", t1 - t0)
+                if go:
+                    while held:
+                        self._send(*held.popleft())
+                    self._send(pcm, rms)
+                    continue
+                if go is None:
+                    held.clear()
+                elif held.maxlen:
+                    held.append((pcm, rms))
+                if self.flush:
+                    # A part-filled packet goes out now, not with the next spurt, then the end marker
+                    frame = self.flush(rms)
+                    if frame is not None:
+                        self._deliver(frame, clock())
+            except Exception:
+                break
+        self.running = False
+
+    def _send(self, pcm, rms):
+        """Encode and send one frame."""
+        t1 = time.perf_counter()
+        frame = self.encode(pcm, rms)
+        t2 = time.perf_counter()
+        self.times.add("encode", t2 - t1)
+        if frame is not None:
+            self._deliver(frame, t2)
+
+    def _deliver(self, frame, started):
+        self.send(frame)
+        self.times.add("send", time.perf_counter() - started)
+        self.sent += 1
+        if self.on_sent:
+            self.on_sent()
+
+    def stats(self):
+        """{captured, sent, overflows, underflows, queued, stages: {stage: {calls, avg_us, max_us}}}"""
+        return {
+            "captured": self.captured,
+            "sent": self.sent,
+            "overflows": self.overflows,
+            "underflows": self.underflows,
+            "queued": len(self.ring),
+            "stages": self.times.stats(),
+        }
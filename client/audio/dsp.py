@@ -0,0 +1,202 @@
+"""
+PCM DSP helpers for 16-bit little-endian mono frames: RMS, peak, zero
+crossings, gain with saturation and mixing.
+
+Three interchangeable backends: audioop (C, in the standard library up to
+Python 3.12), NumPy and a pure-Python one on the array module. The
+module-level functions use the first of these that loaded: on 960-sample
+frames audioop's per-call overhead is lower than NumPy's (see
+benchmarks/bench_dsp.py). BACKENDS lists all that loaded.
+"""
+
+import array
+import sys
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:  # removed from the standard library in Python 3.13
+    audioop = None
+
+BIG_ENDIAN = sys.byteorder == 'big'
+# Mix 8 bits below full scale in 32-bit samples: 256 inputs can't wrap
+HEADROOM = 256
+
+
+class PythonDSP:
+    """array-module implementation; always available."""
+
+    name = "python"
+
+    @staticmethod
+    def _samples(pcm):
+        samples = array.array('h')
+        samples.frombytes(pcm[:len(pcm) & ~1])
+        if BIG_ENDIAN:
+            samples.byteswap()
+        return samples
+
+    @staticmethod
+    def _pack(values):
+        out = array.array('h', (max(-32768, min(32767, int(v))) for v in values))
+        if BIG_ENDIAN:
+            out.byteswap()
+        return out.tobytes()
+
+    @classmethod
+    def rms(cls, pcm):
+        samples = cls._samples(pcm)
+        if not samples:
+            return 0.0
+        return (sum(s * s for s in samples) / len(samples)) ** 0.5
+
+    @classmethod
+    def peak(cls, pcm):
+        samples = cls._samples(pcm)
+        return max(max(samples), -min(samples)) if samples else 0
+
+    @classmethod
+    def crossings(cls, pcm):
+        samples = cls._samples(pcm)
+        return sum(1 for a, b in zip(samples, samples[1:]) if (a < 0) != (b < 0))
+
+    @classmethod
+    def apply_gain(cls, pcm, gain):
+        return cls._pack(s * gain for s in cls._samples(pcm))
+
+    @classmethod
+    def mix(cls, frames, size):
+        acc = [0.0] * (size // 2)
+        for pcm, gain in frames:
+            for i, sample in enumerate(cls._samples(pcm[:size])):
+                acc[i] += sample * gain
+        return cls._pack(acc)
+
+
+class AudioopDSP:
+    """audioop implementation (C loops, native byte order)."""
+
+    name = "audioop"
+
+    @staticmethod
+    def _native(pcm):
+        pcm = pcm[:len(pcm) & ~1]
+        return audioop.byteswap(pcm, 2) if BIG_ENDIAN else pcm
+
+    @classmethod
+    def rms(cls, pcm):
+        return float(audioop.rms(cls._native(pcm), 2))
+
+    @classmethod
+    def peak(cls, pcm):
+        return audioop.max(cls._native(pcm), 2)
+
+    @classmethod
+    def crossings(cls, pcm):
+        return max(0, audioop.cross(cls._native(pcm), 2))  # -1 for an empty frame
+
+    @classmethod
+    def apply_gain(cls, pcm, gain):
+        out = audioop.mul(cls._native(pcm), 2, gain)
+        return audioop.byteswap(out, 2) if BIG_ENDIAN else out
+
+    @classmethod
+    def mix(cls, frames, size):
+        """Sum in 32-bit samples scaled down by HEADROOM, then clip once."""
+        mix = bytes(size * 2)
+        for pcm, gain in frames:
+            pcm = cls._native(pcm[:size])
+            if len(pcm) < size:
+                pcm += bytes(size - len(pcm))
+            wide = audioop.mul(audioop.lin2lin(pcm, 2, 4), 4, gain / HEADROOM)
+            mix = audioop.add(mix, wide, 4)
+        out = audioop.lin2lin(audioop.mul(mix, 4, HEADROOM), 4, 2)
+        return audioop.byteswap(out, 2) if BIG_ENDIAN else out
+
+
+class NumpyDSP:
+    """NumPy implementation."""
+
+    name = "numpy"
+
+    @staticmethod
+    def _samples(pcm):
+        return numpy.frombuffer(pcm, dtype='<i2', count=len(pcm) // 2)
+
+    @staticmethod
+    def _pack(values):
+        return numpy.clip(values, -32768, 32767).astype('<i2').tobytes()
+
+    @classmethod
+    def rms(cls, pcm):
+        samples = cls._samples(pcm).astype(numpy.float64)
+        if not samples.size:
+            return 0.0
+        return float(numpy.sqrt(numpy.dot(samples, samples) / samples.size))
+
+    @classmethod
+    def peak(cls, pcm):
+        samples = cls._samples(pcm)
+        return int(numpy.abs(samples.astype(numpy.int32)).max()) if samples.size else 0
+
+    @classmethod
+    def crossings(cls, pcm):
+        negative = cls._samples(pcm) < 0
+        return int(numpy.count_nonzero(negative[1:] != negative[:-1]))
+
+    @classmethod
+    def apply_gain(cls, pcm, gain):
+        return cls._pack(cls._samples(pcm) * numpy.float32(gain))
+
+    @classmethod
+    def mix(cls, frames, size):
+        acc = numpy.zeros(size // 2, dtype=numpy.float32)
+        for pcm, gain in frames:
+            samples = cls._samples(pcm[:size])
+            acc[:samples.size] += samples * numpy.float32(gain)
+        return cls._pack(acc)
+
+
+BACKENDS = {"python": PythonDSP}
+if audioop is not None:
+    BACKENDS["audioop"] = AudioopDSP
+if numpy is not None:
+    BACKENDS["numpy"] = NumpyDSP
+BACKEND = BACKENDS.get("audioop") or BACKENDS.get("numpy") or PythonDSP
+
+
+def rms(pcm):
+    """Root mean square of the samples (0.0 for an empty frame)."""
+    return BACKEND.rms(pcm)
+
+
+def peak(pcm):
+    """Largest absolute sample value."""
+    return BACKEND.peak(pcm)
+
+
+def crossings(pcm):
+    """Number of sign changes between neighbouring samples (zero crossings)."""
+    return BACKEND.crossings(pcm)
+
+
+def apply_gain(pcm, gain):
+    """pcm scaled by a linear gain, clipped to the 16-bit range."""
+    if gain == 1.0:
+        return pcm
+    return BACKEND.apply_gain(pcm, gain)
+
+
+def mix(frames, size):
+    """Sum [(pcm, gain)] into size bytes of PCM, clipping only the result.
+
+    Shorter frames count as padded with silence, longer ones are cut.
+    """
+    return BACKEND.mix(frames, size)
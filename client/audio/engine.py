@@ -3,10 +3,10 @@ Audio engine: device enumeration, stream management, mute flags.
 Ports the Windows MME ctypes logic from the old client_gui.py.
 """
 
-import struct
 import sys
 import ctypes
 import pyaudio
+from client.audio import dsp
 from client.audio.opus_codec import SAMPLE_RATE, CHANNELS, FRAME_SIZE
 
 FORMAT = pyaudio.paInt16
@@ -148,15 +148,17 @@ class AudioEngine:
         if self.output_devices:
             self.selected_output = self.output_devices[0][0]
 
-    def open_input_stream(self):
-        """Open microphone stream."""
+    def open_input_stream(self, callback=None, frame_size=None):
+        """Open microphone stream (callback mode if a PyAudio stream callback is
+        given), in buffers of frame_size samples (default self.frame_size)."""
         return self.audio.open(
             format=self.format,
             channels=self.channels,
             rate=self.sample_rate,
             input=True,
-            frames_per_buffer=self.frame_size,
-            input_device_index=self.selected_input
+            frames_per_buffer=frame_size or self.frame_size,
+            input_device_index=self.selected_input,
+            stream_callback=callback
         )
 
     def open_output_stream(self):
@@ -173,30 +175,16 @@ class AudioEngine:
     @staticmethod
     def calc_rms(data):
         """Compute RMS level of 16-bit PCM audio."""
-        count = len(data) // 2
-        if count == 0:
-            return 0
-        total = 0
-        for i in range(0, len(data) - 1, 2):
-            sample = struct.unpack('<h', data[i:i + 2])[0]
-            total += sample * sample
-        return (total / count) ** 0.5
+        return dsp.rms(data)
+
+    def gain(self, sender=None):
+        """Master x per-user volume as a linear factor."""
+        user_vol = self.user_volumes.get(sender, 100) if sender else 100
+        return (self.volume / 100.0) * (user_vol / 100.0)
 
     def apply_volume(self, audio_data, sender=None):
         """Apply master + per-user volume to PCM audio data."""
-        user_vol = self.user_volumes.get(sender, 100) if sender else 100
-        vol = (self.volume / 100.0) * (user_vol / 100.0)
-
-        if vol == 1.0:
-            return audio_data
-
-        adjusted = bytearray()
-        for i in range(0, len(audio_data) - 1, 2):
-            sample = struct.unpack('<h', audio_data[i:i + 2])[0]
-            sample = int(sample * vol)
-            sample = max(-32768, min(32767, sample))
-            adjusted.extend(struct.pack('<h', sample))
-        return bytes(adjusted)
+        return dsp.apply_gain(audio_data, self.gain(sender))
 
     def terminate(self):
         """Clean up PyAudio."""
@@ -4,10 +4,14 @@ Uses opuslib (ctypes binding to libopus).
 Falls back to raw PCM if opuslib/libopus not available.
 """
 
+import collections
 import struct
 import sys
 import os
 import ctypes
+import threading
+import time
+from client.protocol import unpack_bundle
 
 def _ensure_opus_dll():
     """Locate and preload opus.dll so opuslib can find it."""
@@ -48,29 +52,109 @@ except Exception:
 SAMPLE_RATE = 48000
 CHANNELS = 1
 FRAME_SIZE = 960  # 20ms at 48kHz
+FRAME_MS = 20
+# Frame durations the encoder can be set to (ms); see protocol.VOICE_FRAMING_PREFIX
+FRAME_DURATIONS = (10, 20, 40, 60)
+# Longest Opus packet (120 ms): decode buffers are this big, whatever the sender uses
+MAX_FRAME_SIZE = 5760
 BITRATE = 64000
+# Packet loss (%) the encoder's in-band FEC is tuned for; 0 turns FEC off
+EXPECTED_LOSS = 10
 CODEC_ID_OPUS = 0x01
 CODEC_ID_RAW = 0x00
+CODEC_ID_OPUS_BUNDLE = 0x02  # several Opus packets, see protocol.pack_bundle
+CODEC_ID_SPURT_END = 0x03    # no audio: the sender went quiet, see protocol.CODEC_SPURT_END
+# With DTX the encoder turns background noise into packets this short, which
+# carry nothing worth sending
+DTX_PACKET_BYTES = 2
+
+# Receive side: at most this many live per-sender decoders; one unused for
+# DECODER_IDLE seconds is released
+DECODER_POOL_SIZE = 16
+DECODER_IDLE = 30.0
+# Sequence gaps up to this many 20 ms frames of audio are concealed
+# (FEC/PLC); a longer one is still counted as lost but played as a new talk
+# spurt. A gap of more than MAX_LOSS_GAP packets is the sender's sequence
+# starting over (a reconnect), not loss. Packets LATE_WINDOW behind are late.
+MAX_CONCEAL = 5
+MAX_LOSS_GAP = 1000
+LATE_WINDOW = 50
+
+
+def frame_samples(frame_ms):
+    """Samples per frame of frame_ms milliseconds."""
+    return SAMPLE_RATE * frame_ms // 1000
+
+
+def is_dtx(codec_id, data):
+    """True for an Opus packet the encoder emitted in DTX (no speech to send)."""
+    return codec_id == CODEC_ID_OPUS and len(data) <= DTX_PACKET_BYTES
+
+
+def opus_packets(codec_id, data):
+    """The Opus packets in a voice frame's audio, or None if it isn't Opus."""
+    if codec_id == CODEC_ID_OPUS:
+        return [data]
+    if codec_id == CODEC_ID_OPUS_BUNDLE:
+        return unpack_bundle(data)
+    return None
 
 
 class OpusCodec:
-    """Opus encode/decode. Falls back to passthrough if opuslib unavailable."""
+    """Opus encode/decode. Falls back to passthrough if opuslib unavailable.
 
-    def __init__(self):
+    encode() takes frames of frame_size samples (frame_ms milliseconds).
+    The encoder runs unconstrained VBR, and with dtx it marks stretches of
+    background noise with DTX packets (is_dtx) instead of coding them.
+    """
+
+    def __init__(self, expected_loss=EXPECTED_LOSS, frame_ms=FRAME_MS, dtx=True):
         self.available = OPUS_AVAILABLE
         self.encoder = None
         self.decoder = None
+        self.frame_size = frame_samples(frame_ms)
+        # Encoder settings waiting for the encoding thread: {property: value}
+        self.pending = {}
 
         if self.available:
             try:
                 self.encoder = opuslib.Encoder(SAMPLE_RATE, CHANNELS, opuslib.APPLICATION_VOIP)
                 self.encoder.bitrate = BITRATE
+                self.set_expected_loss(expected_loss)
+                self.pending.update(vbr=1, vbr_constraint=0, dtx=1 if dtx else 0)
+                self._apply_pending()
                 self.decoder = opuslib.Decoder(SAMPLE_RATE, CHANNELS)
             except Exception:
                 self.available = False
                 self.encoder = None
                 self.decoder = None
 
+    def set_bitrate(self, bitrate):
+        self.pending["bitrate"] = int(bitrate)
+
+    def set_complexity(self, complexity):
+        """Opus encoder complexity, 0 (cheapest) to 10 (best quality per bit)."""
+        self.pending["complexity"] = int(complexity)
+
+    def set_expected_loss(self, percent):
+        """Tune in-band FEC for percent packet loss (0 disables it)."""
+        self.pending["inband_fec"] = 1 if percent > 0 else 0
+        self.pending["packet_loss_perc"] = max(0, min(100, int(percent)))
+
+    def _apply_pending(self):
+        """Apply queued settings; called on the encoding thread, between frames.
+
+        Through the encoder CTLs: opuslib's inband_fec and dtx property
+        setters don't pass the value on.
+        """
+        while self.pending:
+            name, value = self.pending.popitem()
+            try:
+                opuslib.api.encoder.encoder_ctl(
+                    self.encoder.encoder_state, getattr(opuslib.api.ctl, "set_" + name), value)
+            except Exception:
+                pass
+
     @property
     def codec_id(self):
         return CODEC_ID_OPUS if self.available else CODEC_ID_RAW
@@ -78,8 +162,10 @@ class OpusCodec:
     def encode(self, pcm_data):
         """Encode raw PCM bytes to Opus. Returns (codec_id, encoded_bytes)."""
         if self.available and self.encoder:
+            if self.pending:
+                self._apply_pending()
             try:
-                opus_data = self.encoder.encode(pcm_data, FRAME_SIZE)
+                opus_data = self.encoder.encode(pcm_data, self.frame_size)
                 return CODEC_ID_OPUS, opus_data
             except Exception:
                 pass
@@ -89,13 +175,179 @@ class OpusCodec:
         """Decode Opus or raw PCM back to raw PCM bytes."""
         if codec_id == CODEC_ID_OPUS and self.available and self.decoder:
             try:
-                return self.decoder.decode(data, FRAME_SIZE)
+                return self.decoder.decode(data, MAX_FRAME_SIZE)
             except Exception:
                 return data
         return data
 
 
-def build_voice_frame(nickname, codec_id, audio_data):
+class DecoderPool:
+    """One Opus decoder per sender, so each stream keeps its own decoder state.
+
+    Decoders are created on a sender's first frame and kept in LRU order;
+    past max_decoders the least recently used one is evicted, and any left
+    unused for idle seconds is released. Raw PCM frames pass through.
+    Decode time is accumulated per frame (stats()).
+
+    receive() also follows each sender's sequence numbers (UDP): a gap of up
+    to MAX_CONCEAL frames' worth of audio is filled in, the last missing
+    frame from the in-band FEC data of the packet that ended the gap (if
+    fec) and any before it by the decoder's packet loss concealment.
+
+    Senders may use any frame duration and bundle several frames per packet
+    (CODEC_ID_OPUS_BUNDLE); lost packets are taken to have been framed like
+    the last one received. A talk spurt end (CODEC_ID_SPURT_END) takes a
+    sequence number but has nothing to decode.
+    """
+
+    def __init__(self, max_decoders=DECODER_POOL_SIZE, idle=DECODER_IDLE, fec=True):
+        self.max_decoders = max_decoders
+        self.idle = idle
+        self.fec = fec
+        self.lock = threading.Lock()
+        # {sender: [decoder, last_used, next seq, packets received, packets lost,
+        #           samples per frame, frames per packet]}
+        self.decoders = collections.OrderedDict()
+        self.frames = 0
+        self.decode_time = 0.0
+        self.max_decode_time = 0.0
+        self.created = 0
+        self.evicted = 0
+        self.lost = 0
+        self.fec_frames = 0
+        self.plc_frames = 0
+        self.late = 0
+
+    def _get(self, sender, now):
+        """Entry for sender, created or refreshed as most recently used (lock held)."""
+        entry = self.decoders.get(sender)
+        if entry is not None:
+            entry[1] = now
+            self.decoders.move_to_end(sender)
+            return entry
+        # Release idle decoders (the oldest are at the front), then make room
+        while self.decoders:
+            oldest = next(iter(self.decoders.values()))
+            if now - oldest[1] <= self.idle and len(self.decoders) < self.max_decoders:
+                break
+            self.decoders.popitem(last=False)
+            self.evicted += 1
+        entry = self.decoders[sender] = [opuslib.Decoder(SAMPLE_RATE, CHANNELS), now, None, 0, 0,
+                                         FRAME_SIZE, 1]
+        self.created += 1
+        return entry
+
+    @staticmethod
+    def _decode(entry, packet):
+        """Decode one packet with entry's decoder, noting its frame size (lock held)."""
+        pcm = entry[0].decode(packet, MAX_FRAME_SIZE)
+        entry[5] = len(pcm) // 2 or entry[5]
+        return pcm
+
+    def _timed(self, started, frames):
+        elapsed = time.perf_counter() - started
+        self.frames += frames
+        self.decode_time += elapsed
+        self.max_decode_time = max(self.max_decode_time, elapsed / frames)
+
+    def decode(self, sender, codec_id, data):
+        """Decode one voice frame (one packet or a bundle) from sender to raw
+        PCM bytes, or None if it can't be."""
+        if codec_id == CODEC_ID_RAW:
+            return data
+        packets = opus_packets(codec_id, data)
+        if not packets or not OPUS_AVAILABLE:
+            return None
+        with self.lock:
+            started = time.perf_counter()
+            entry = self._get(sender, started)
+            try:
+                pcm = b''.join([self._decode(entry, packet) for packet in packets])
+            except Exception:
+                return None
+            entry[6] = len(packets)
+            self._timed(started, len(packets))
+        return pcm
+
+    def receive(self, sender, codec_id, data, seq):
+        """(concealed, pcm) for packet seq from sender: PCM frames standing in
+        for a gap before it, in order, then its own PCM (all of a bundle's
+        frames). pcm is None if the packet is late (its slot was already
+        concealed), undecodable or a talk spurt end.
+        """
+        if codec_id == CODEC_ID_RAW:
+            return [], data
+        packets = None if codec_id == CODEC_ID_SPURT_END else opus_packets(codec_id, data)
+        if (not packets and codec_id != CODEC_ID_SPURT_END) or not OPUS_AVAILABLE:
+            return [], None
+        with self.lock:
+            started = time.perf_counter()
+            entry = self._get(sender, started)
+            decoder, expected = entry[0], entry[2]
+            gap = 0 if expected is None else (seq - expected) & 0xFFFF
+            if 0 < (-gap) & 0xFFFF <= LATE_WINDOW:
+                self.late += 1
+                return [], None
+            entry[2] = (seq + 1) & 0xFFFF
+            entry[3] += 1
+            if packets is None:
+                return [], None  # Nothing to play, and nothing to conceal before a pause
+            concealed = []
+            try:
+                frame_size = entry[5]
+                missing = gap * entry[6]  # frames in the lost packets
+                if 0 < gap <= MAX_LOSS_GAP:
+                    entry[4] += gap
+                    self.lost += gap
+                if 0 < gap and missing * frame_size <= MAX_CONCEAL * FRAME_SIZE:
+                    plc = missing - 1 if self.fec else missing
+                    for _ in range(plc):
+                        concealed.append(decoder.decode(b'', frame_size))
+                    self.plc_frames += plc
+                    if self.fec:
+                        concealed.append(decoder.decode(packets[0], frame_size, decode_fec=True))
+                        self.fec_frames += 1
+                pcm = b''.join([self._decode(entry, packet) for packet in packets])
+            except Exception:
+                return concealed, None
+            entry[6] = len(packets)
+            self._timed(started, len(concealed) + len(packets))
+        return concealed, pcm
+
+    def take_loss(self):
+        """{sender: (packets received, packets lost)} since the last call, for
+        senders heard over UDP; the counts restart from zero."""
+        with self.lock:
+            report = {}
+            for sender, entry in self.decoders.items():
+                if entry[3] or entry[4]:
+                    report[sender] = (entry[3], entry[4])
+                    entry[3] = entry[4] = 0
+            return report
+
+    def discard(self, sender):
+        """Drop sender's decoder (the stream ended)."""
+        with self.lock:
+            self.decoders.pop(sender, None)
+
+    def stats(self):
+        """Decoder counts, loss concealment counts and per-frame decode time (microseconds)."""
+        with self.lock:
+            return {
+                "live": len(self.decoders),
+                "created": self.created,
+                "evicted": self.evicted,
+                "frames": self.frames,
+                "lost": self.lost,
+                "fec_frames": self.fec_frames,
+                "plc_frames": self.plc_frames,
+                "late": self.late,
+                "avg_decode_us": self.decode_time / self.frames * 1e6 if self.frames else 0.0,
+                "max_decode_us": self.max_decode_time * 1e6,
+            }
+
+
+def build_voice_frame(nickname, codec_id, audio_data, level=None):
     """Build a binary voice frame for transmission.
 
     Format:
@@ -105,6 +357,7 @@ def build_voice_frame(nickname, codec_id, audio_data):
         [1B]    codec_id
         [2B BE] audio_data_length
         [NB]    audio_data
+        [1B]    audio level (optional, see protocol.audio_level)
     """
     nick_bytes = nickname.encode('utf-8')
     payload = (
@@ -114,6 +367,8 @@ def build_voice_frame(nickname, codec_id, audio_data):
         struct.pack('>H', len(audio_data)) +
         audio_data
     )
+    if level is not None:
+        payload += bytes((level,))
     return struct.pack('>I', len(payload)) + payload
 
 
@@ -139,3 +394,32 @@ def parse_voice_frame(payload):
         return nickname, codec_id, audio_data
     except Exception:
         return None
+
+
+def build_compact_voice_frame(speaker_id, codec_id, audio_data, level=None):
+    """Build a voice frame that names the sender by speaker ID.
+
+    Format:
+        [4B BE] total_payload_length
+        [2B BE] speaker_id (0 if not yet known; the server fills it in)
+        [1B]    codec_id
+        [2B BE] audio_data_length
+        [NB]    audio_data
+        [1B]    audio level (optional, see protocol.audio_level)
+    """
+    if level is None:
+        header = struct.pack('>IHBH', len(audio_data) + 5, speaker_id, codec_id, len(audio_data))
+        return header + audio_data
+    header = struct.pack('>IHBH', len(audio_data) + 6, speaker_id, codec_id, len(audio_data))
+    return header + audio_data + bytes((level,))
+
+
+def parse_compact_voice_frame(payload):
+    """Parse a compact voice frame payload (without the 4-byte length prefix).
+
+    Returns: (speaker_id, codec_id, audio_data) or None on error.
+    """
+    if len(payload) < 5:
+        return None
+    speaker_id, codec_id, audio_len = struct.unpack_from('>HBH', payload)
+    return speaker_id, codec_id, payload[5:5 + audio_len]
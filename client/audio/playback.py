@@ -0,0 +1,327 @@
+"""
+Playback engine: per-sender adaptive jitter buffers and a mixer that turns
+everyone currently talking into one 20 ms output frame per tick, played by
+a dedicated output thread so nothing on the audio path waits for the GUI.
+"""
+
+import array
+import collections
+import random
+import threading
+import time
+from client.audio import dsp
+from client.audio.opus_codec import SAMPLE_RATE, FRAME_SIZE
+from client.protocol import level_rms
+
+FRAME_SECONDS = FRAME_SIZE / SAMPLE_RATE
+FRAME_BYTES = FRAME_SIZE * 2
+
+MIN_DEPTH = 1        # frames buffered before a sender starts playing
+MAX_DEPTH = 10       # hard cap (200 ms); older frames are dropped
+JITTER_K = 2.0       # target depth covers this many jitter estimates
+SPURT_END = 5        # ticks without frames that end a talk spurt (not underruns)
+FORGET_AFTER = 30.0  # drop a sender's buffer after this long without frames (s)
+INBOX_FRAMES = 256   # decoded frames waiting for the next tick (~1 s at 5 speakers)
+SPEAKING_HOLD = 0.5  # a sender counts as speaking this long after its last frame (s)
+COMFORT_HOLD = 10.0  # comfort noise stops this long after a sender's last frame (s)
+NOISE_RMS = 1000     # level of the stored comfort noise, scaled to each sender's
+NOISE_FRAMES = 50    # length of the stored comfort noise (frames)
+STOP_TIMEOUT = 1.0   # stop() waits this long for the output thread's last write (s)
+
+
+class JitterBuffer:
+    """Playout buffer for one sender, in 20 ms frames, sized to its arrival jitter.
+
+    Packets may carry any duration (other frame durations, bundles); their
+    PCM is cut into 20 ms frames, a remainder waiting for the next packet.
+    Jitter is estimated RFC 3550 style from inter-arrival times against the
+    duration each packet carried; the target depth is 1 + JITTER_K * jitter
+    in frames (rounded), plus the frames in a packet beyond the first,
+    within MIN_DEPTH..MAX_DEPTH. Playout starts once target frames are
+    queued and trims back to target when the buffer runs deeper, so latency
+    stays bounded.
+
+    end() marks the end of a talk spurt: what is queued still plays, then
+    the buffer stops without counting underruns, and the first packet of the
+    next spurt doesn't count towards jitter. comfort is the sender's
+    background noise (RMS) from then until that packet, if it was signalled.
+
+    Counters: concealed (frames synthesized for lost packets, see
+    DecoderPool.receive), underruns (ticks the sender had nothing to play
+    mid-spurt), late (frames that arrived after their tick was already
+    missed), dropped (frames discarded to bound latency).
+    """
+
+    def __init__(self):
+        self.frames = collections.deque()
+        self.partial = b''  # PCM short of a frame, from the last packet
+        self.playing = False
+        self.jitter = 0.0
+        self.target = MIN_DEPTH
+        self.last_arrival = None
+        self.ended = False  # the sender ended its talk spurt
+        self.comfort = None
+        self.starved = 0  # consecutive empty ticks while playing
+        self.received = 0
+        self.concealed = 0
+        self.underruns = 0
+        self.late = 0
+        self.dropped = 0
+
+    def push(self, pcm, now, concealed=()):
+        """Queue pcm, after any frames synthesized for packets lost before it."""
+        concealed_bytes = sum(map(len, concealed))
+        if self.last_arrival is not None and not self.ended:
+            # A packet is due as long after the last one as the audio it
+            # carries, and the one that ended a loss gap that much later again
+            interval = (len(pcm) + concealed_bytes) / FRAME_BYTES * FRAME_SECONDS
+            deviation = abs(now - self.last_arrival - interval)
+            self.jitter += (deviation - self.jitter) / 16
+            depth = MIN_DEPTH + int(JITTER_K * self.jitter / FRAME_SECONDS + 0.5)
+            # A packet of several frames empties the buffer that much further before the next
+            burst = max(0, (len(pcm) - 1) // FRAME_BYTES)
+            self.target = min(MAX_DEPTH, depth + burst)
+        self.last_arrival = now
+        self.ended = False
+        self.comfort = None
+        self.received += 1
+        if self.starved:
+            # The spurt went on after all: those empty ticks were underruns
+            self.underruns += self.starved
+            self.late += 1
+            self.starved = 0
+        self.concealed += (concealed_bytes + FRAME_BYTES - 1) // FRAME_BYTES
+        for chunk in concealed:
+            self._append(chunk)
+        self._append(pcm)
+        while len(self.frames) > MAX_DEPTH:
+            self.frames.popleft()
+            self.dropped += 1
+
+    def end(self, level=None):
+        """The sender ended its talk spurt; level is its background noise
+        (audio level byte), if it said."""
+        self.ended = True
+        self.comfort = level_rms(level) if level is not None else None
+
+    def _append(self, pcm):
+        if not self.partial and len(pcm) == FRAME_BYTES:
+            self.frames.append(pcm)
+            return
+        data = self.partial + pcm
+        whole = len(data) - len(data) % FRAME_BYTES
+        for start in range(0, whole, FRAME_BYTES):
+            self.frames.append(data[start:start + FRAME_BYTES])
+        self.partial = data[whole:]
+
+    def pop(self):
+        """The frame to play this tick, or None."""
+        if not self.playing:
+            if not self.frames or (len(self.frames) < self.target and not self.ended):
+                return None
+            self.playing = True
+        if not self.frames:
+            if self.ended:
+                self.playing = False
+                self.starved = 0
+                return None
+            self.starved += 1
+            if self.starved >= SPURT_END:
+                self.playing = False
+                self.starved = 0
+            return None
+        if len(self.frames) > self.target + 1:
+            self.frames.popleft()
+            self.dropped += 1
+        return self.frames.popleft()
+
+    def stats(self):
+        return {
+            "depth": len(self.frames),
+            "target": self.target,
+            "jitter_ms": self.jitter * 1000,
+            "received": self.received,
+            "concealed": self.concealed,
+            "underruns": self.underruns,
+            "late": self.late,
+            "dropped": self.dropped,
+        }
+
+
+class PlaybackMixer:
+    """Jitter buffers for every sender, mixed into one output frame per tick.
+
+    push() is called by the receiving thread for each decoded packet; it only
+    appends to a bounded deque (atomic, no lock), so the network thread never
+    waits on the output thread. mix_frame() is called once per 20 ms by the
+    output thread, which moves the inbox into the jitter buffers first.
+    gain(sender) returns the linear gain (master x per-user) for a sender.
+    With comfort_noise, senders who ended a talk spurt with their background
+    noise level get white noise at that level through the pause (for up to
+    COMFORT_HOLD).
+    """
+
+    def __init__(self, gain=None, comfort_noise=False):
+        self.gain = gain or (lambda sender: 1.0)
+        self.comfort_noise = comfort_noise
+        self.lock = threading.Lock()  # buffers: output thread vs stats()
+        # (sender, pcm, arrival time, concealed frames), or for a talk spurt
+        # end (sender, None, arrival time, level)
+        self.inbox = collections.deque(maxlen=INBOX_FRAMES)
+        self.buffers = {}  # {sender: JitterBuffer}
+        self.heard = {}    # {sender: time its last frame was played}
+        self.silence = bytes(FRAME_BYTES)
+        self.noise = None  # NOISE_FRAMES of white noise at NOISE_RMS, made on first use
+        self.noise_pos = 0
+
+    def push(self, sender, pcm, now=None, concealed=()):
+        """Queue a decoded packet's PCM, after any concealed frames standing in for lost packets."""
+        self.inbox.append((sender, pcm, time.monotonic() if now is None else now, concealed))
+
+    def end(self, sender, level=None, now=None):
+        """Queue the end of sender's talk spurt; level is its background noise (audio level byte)."""
+        self.inbox.append((sender, None, time.monotonic() if now is None else now, level))
+
+    def mix_frame(self):
+        """(one output frame of PCM, [senders heard in it])."""
+        now = time.monotonic()
+        inbox = self.inbox
+        with self.lock:
+            while inbox:
+                sender, pcm, arrived, extra = inbox.popleft()
+                buf = self.buffers.get(sender)
+                if pcm is None:
+                    if buf is not None:
+                        buf.end(extra)
+                    continue
+                if buf is None:
+                    buf = self.buffers[sender] = JitterBuffer()
+                buf.push(pcm, arrived, extra)
+            frames = []
+            noise = []
+            for sender, buf in list(self.buffers.items()):
+                pcm = buf.pop()
+                if pcm is not None:
+                    frames.append((sender, pcm))
+                    self.heard[sender] = now
+                elif not buf.frames and now - buf.last_arrival > FORGET_AFTER:
+                    del self.buffers[sender]
+                    self.heard.pop(sender, None)
+                elif buf.comfort and self.comfort_noise and now - buf.last_arrival < COMFORT_HOLD:
+                    noise.append((sender, buf.comfort))
+        if not frames and not noise:
+            return self.silence, []
+        senders = [sender for sender, _ in frames]
+        gains = [(pcm, self.gain(sender)) for sender, pcm in frames]
+        if noise:
+            gains.extend(self._comfort(noise))
+        if len(gains) == 1 and gains[0][1] == 1.0 and len(gains[0][0]) == FRAME_BYTES:
+            return gains[0][0], senders
+        return dsp.mix(gains, FRAME_BYTES), senders
+
+    def _comfort(self, noise):
+        """[(pcm, gain)] playing comfort noise for [(sender, background RMS)],
+        a different stretch of the stored noise for each."""
+        if self.noise is None:
+            rng = random.Random()
+            samples = array.array('h', (max(-32768, min(32767, int(rng.gauss(0, NOISE_RMS))))
+                                        for _ in range(NOISE_FRAMES * FRAME_SIZE)))
+            if dsp.BIG_ENDIAN:
+                samples.byteswap()
+            self.noise = samples.tobytes()
+        self.noise_pos = (self.noise_pos + FRAME_BYTES) % len(self.noise)
+        out = []
+        for i, (sender, rms) in enumerate(noise):
+            start = (self.noise_pos + 7 * i * FRAME_BYTES) % len(self.noise)
+            out.append((self.noise[start:start + FRAME_BYTES], rms / NOISE_RMS * self.gain(sender)))
+        return out
+
+    def speaking(self, hold=SPEAKING_HOLD):
+        """Senders played within the last hold seconds."""
+        now = time.monotonic()
+        with self.lock:
+            return {sender for sender, seen in self.heard.items() if now - seen < hold}
+
+    def stats(self):
+        """Per-sender jitter buffer counters: {sender: {depth, target, jitter_ms, ...}}."""
+        with self.lock:
+            return {sender: buf.stats() for sender, buf in self.buffers.items()}
+
+
+class AudioOutput:
+    """Output thread: writes one mixed frame per tick to the speaker stream.
+
+    The blocking write, paced by the device, is the clock. restart() reopens
+    the stream (after a device change) on the next tick; while muted the
+    mixer keeps draining but silence is written. on_played(frame), if set,
+    is called with every frame written (the echo canceller's reference).
+    The stream belongs to the output thread: only it opens, writes and
+    closes it, so stop() waits for the thread instead of closing a stream
+    in the middle of a write.
+    """
+
+    def __init__(self, engine, mixer):
+        self.engine = engine
+        self.mixer = mixer
+        self.running = False
+        self._thread = None
+        self._restart = False
+        self.on_played = None
+        self.writes = 0
+        self.errors = 0
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def restart(self):
+        self._restart = True
+
+    def stop(self):
+        """Stop the output thread; it closes the stream after its last write."""
+        self.running = False
+        thread, self._thread = self._thread, None
+        if thread:
+            thread.join(STOP_TIMEOUT)
+
+    @staticmethod
+    def _close(stream):
+        if stream:
+            try:
+                stream.stop_stream()
+                stream.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        me = threading.current_thread()
+        stream = None
+        try:
+            # A thread stop() gave up waiting for must not carry on after a new start()
+            while self.running and self._thread is me:
+                if stream is None or self._restart:
+                    self._restart = False
+                    self._close(stream)
+                    stream = None
+                    try:
+                        stream = self.engine.open_output_stream()
+                    except Exception:
+                        time.sleep(1.0)
+                        continue
+                frame, _ = self.mixer.mix_frame()
+                if self.engine.sound_muted:
+                    frame = self.mixer.silence
+                try:
+                    stream.write(frame)
+                    self.writes += 1
+                    on_played = self.on_played
+                    if on_played:
+                        on_played(frame)
+                except Exception:
+                    self.errors += 1
+                    self._close(stream)
+                    stream = None
+                    time.sleep(0.1)
+        finally:
+            self._close(stream)
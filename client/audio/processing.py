@@ -0,0 +1,360 @@
+"""
+Capture-side processing: echo cancellation, noise suppression, then
+automatic gain control, applied to every captured frame before voice
+activation and encoding.
+
+    echo     acoustic echo cancellation for people on speakers: what the
+             output thread plays (EchoCanceller.played) is the reference,
+             and an NLMS adaptive filter over ECHO_TAIL of echo path
+             (device latencies included) takes its estimated echo off the
+             microphone. The filter runs in the frequency domain on 10 ms
+             blocks, in partitions (overlap-save, like Speex's MDF), so a
+             long tail costs a few FFTs per block rather than a multiply
+             per tap and sample. After a warm-up at ECHO_STEP, the step
+             follows the share of the error that is residual echo (the
+             echo estimate's power times the leakage, fitted as in Valin's
+             MDF paper), so while the near end talks the filter hardly
+             moves. The linear filter leaves around 10 dB of echo, so a
+             postfilter follows (STFT as in denoise): the residual echo of
+             each frequency is the larger of the leakage times the echo
+             estimate's power and the share of the output coherent with
+             the echo estimate (which also catches a filter that has lost
+             the echo path), decaying by ECHO_TAIL_DECAY per block for the
+             reverberation beyond the filter; the output is scaled, as
+             denoise does, by the Wiener gain of its decision-directed
+             ratio to the residual echo, never by more than
+             ECHO_SUPPRESS_DB. Needs NumPy. Delays audio by one block (HOP).
+    denoise  spectral subtraction on 10 ms blocks (STFT, 50% overlapping
+             sqrt-Hann windows): the noise power of each frequency is the
+             minimum of its smoothed power over the last NOISE_WINDOW
+             (times NOISE_BIAS), so it follows a changing background but not
+             sustained speech; each frequency is scaled by the Wiener gain
+             of its decision-directed SNR estimate, which suppresses less
+             "musical noise" than plain subtraction, never by more than
+             REDUCTION_DB. Needs NumPy. Delays audio by one block (HOP).
+    agc      gain towards a target speech level (dBFS RMS): the level of
+             frames AGC_SNR_DB over the noise floor (followed as the voice
+             activity detector does) and above AGC_ACTIVE_DB is tracked,
+             the gain moves towards target minus level, quickly down and
+             slowly up, within AGC_MIN_DB..AGC_MAX_DB, and never so high
+             that a frame's peak goes over AGC_LIMIT. Runs on the dsp
+             backend (audioop).
+
+So everyone is sent at about the same loudness, whatever their microphone
+level, and listeners don't need per-user volumes to even them out; and
+voice activation isn't kept open by other people's voices from the
+speakers.
+
+NumPy is a requirement and is bundled in the frozen build; run without it,
+echo and denoise are left out and the main window says so at startup.
+
+CaptureProcessor.process() runs the chain on one frame and, given a
+StageTimes, records the time each stage took under its name; with bypass
+set frames pass through untouched.
+"""
+
+import collections
+import math
+import time
+from client.audio import dsp
+from client.audio.opus_codec import FRAME_SIZE, SAMPLE_RATE
+from client.audio.vad import FLOOR_INITIAL_DB, FLOOR_FALL, FLOOR_RISE, level_db
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY_AVAILABLE = numpy is not None
+
+HOP = 480                # echo cancellation and noise suppression block: 10 ms, FFTs twice that long
+NOISE_SMOOTH = 0.2       # per-block weight of new power in the smoothed spectrum
+NOISE_WINDOW = 1.6       # noise is the minimum smoothed power over this long (s) ...
+NOISE_SPLITS = 8         # ... kept as the minima of this many parts of it
+NOISE_BIAS = 2.0         # a minimum is this far below the mean noise power
+SNR_WEIGHT = 0.98        # weight of the last block's cleaned power in the SNR estimate
+REDUCTION_DB = 18.0      # most a frequency is ever attenuated
+
+ECHO_TAIL = 0.25         # echo path covered, output and input latency included (s)
+ECHO_STEP = 0.5          # NLMS step size (0..2), and the most it is ever set to
+ECHO_LEARN = 2.0         # step after warm-up: this many times the residual echo share of the error
+ECHO_WARMUP = 8.0        # warm-up: this long of reference at ECHO_QUIET_RMS, in energy (s)
+ECHO_QUIET_RMS = 200     # below roughly this reference level the filter adapts little ...
+ECHO_SPREAD = 0.3        # ... nor at frequencies under this share of the mean reference power
+ECHO_LEAK_SMOOTH = 0.05  # per-block weight of new power correlations in the leakage fit
+ECHO_SUPPRESS_DB = 30.0  # most the postfilter ever attenuates a frequency
+ECHO_TAIL_DECAY = 0.7    # per-block decay of the residual echo estimate
+ECHO_COHERENCE_SMOOTH = 0.2  # per-block weight of new spectra in the output / echo estimate coherence
+ECHO_SLACK = 2 * FRAME_SIZE  # reference queued beyond a frame's worth before the oldest is dropped (samples)
+REFERENCE_FRAMES = 50    # played frames queued at most while nothing is captured
+
+AGC_TARGET_DB = -23.0    # speech level aimed at (dBFS RMS)
+AGC_ACTIVE_DB = -55.0    # frames above this ...
+AGC_SNR_DB = 10.0        # ... and this far over the noise floor count towards the speech level
+AGC_LEVEL_TAU = 0.4      # time constant of the speech level (s)
+AGC_MIN_DB = -12.0
+AGC_MAX_DB = 20.0
+AGC_ATTACK = 40.0        # gain falls at most this fast (dB/s)
+AGC_RELEASE = 6.0        # ... and rises at most this fast (dB/s)
+AGC_LIMIT = 29000        # peak a frame is never amplified past
+
+
+class NoiseSuppressor:
+    """Spectral subtraction over HOP-sample blocks (see the module docstring).
+
+    Frames must be a whole number of blocks; the FFTs of a frame's blocks
+    run as one batch, the per-block noise and gain updates are vectorised
+    over frequencies.
+    """
+
+    name = "denoise"
+
+    def __init__(self, reduction_db=REDUCTION_DB):
+        n = numpy.arange(2 * HOP)
+        self.window = numpy.sqrt(0.5 - 0.5 * numpy.cos(numpy.pi * n / HOP)).astype(numpy.float32)
+        self.min_gain = 10 ** (-reduction_db / 20)
+        self.split_blocks = max(1, round(NOISE_WINDOW / NOISE_SPLITS * SAMPLE_RATE / HOP))
+        self.previous = numpy.zeros(HOP, dtype=numpy.float32)  # last input block
+        self.overlap = numpy.zeros(HOP, dtype=numpy.float32)   # second half of the last output window
+        self.smoothed = None
+        self.minima = None    # (NOISE_SPLITS, bins): minimum smoothed power of each past part
+        self.minimum = None   # ... of the part in progress
+        self.blocks = 0       # blocks in the part in progress
+        self.split = 0        # row of minima the part in progress replaces
+        self.clean = None     # last block's power after suppression
+
+    def process(self, pcm):
+        samples = numpy.frombuffer(pcm, dtype='<i2').astype(numpy.float32)
+        blocks = samples.size // HOP
+        if not blocks or samples.size % HOP:
+            return pcm
+        frames = numpy.empty((blocks, 2 * HOP), dtype=numpy.float32)
+        frames[0, :HOP] = self.previous
+        frames[1:, :HOP] = samples[:-HOP].reshape(blocks - 1, HOP)
+        frames[:, HOP:] = samples.reshape(blocks, HOP)
+        self.previous = samples[-HOP:]
+
+        spectra = numpy.fft.rfft(frames * self.window, axis=1)
+        power = spectra.real ** 2 + spectra.imag ** 2
+        if self.smoothed is None:
+            self.smoothed = power[0].copy()
+            self.minimum = power[0].copy()
+            self.minima = numpy.tile(power[0], (NOISE_SPLITS, 1))
+            self.clean = power[0].copy()
+        for i in range(blocks):
+            self.smoothed += NOISE_SMOOTH * (power[i] - self.smoothed)
+            numpy.minimum(self.minimum, self.smoothed, out=self.minimum)
+            self.blocks += 1
+            if self.blocks == self.split_blocks:
+                self.minima[self.split] = self.minimum
+                self.split = (self.split + 1) % NOISE_SPLITS
+                self.minimum = self.smoothed.copy()
+                self.blocks = 0
+            noise = numpy.maximum(numpy.minimum(self.minima.min(axis=0), self.minimum) * NOISE_BIAS, 1e-3)
+            snr = (SNR_WEIGHT * self.clean / noise
+                   + (1 - SNR_WEIGHT) * numpy.maximum(power[i] / noise - 1, 0.0))
+            gain = numpy.maximum(snr / (1 + snr), self.min_gain)
+            self.clean = gain * gain * power[i]
+            spectra[i] *= gain
+
+        out = numpy.fft.irfft(spectra, 2 * HOP, axis=1) * self.window
+        result = out[:, :HOP].copy()
+        result[0] += self.overlap
+        result[1:] += out[:-1, HOP:]
+        self.overlap = out[-1, HOP:].copy()
+        return numpy.clip(result, -32768, 32767).astype('<i2').tobytes()
+
+
+class EchoCanceller:
+    """Partitioned frequency-domain NLMS echo canceller and residual echo
+    postfilter (see the module docstring).
+
+    played() is called by the output thread with each frame written to the
+    speakers; process() by the capture thread, which takes as much of the
+    reference as it has microphone audio. The two run on the same sample
+    clock, so only the reference queued beyond ECHO_SLACK is dropped
+    (keeping the echo behind its reference), and a short queue is made up
+    with silence.
+    """
+
+    name = "echo"
+
+    def __init__(self, tail=ECHO_TAIL):
+        self.partitions = max(1, round(tail * SAMPLE_RATE / HOP))
+        bins = HOP + 1
+        self.weights = numpy.zeros((self.partitions, bins), dtype=numpy.complex128)
+        self.spectra = numpy.zeros((self.partitions, bins), dtype=numpy.complex128)  # reference, newest first
+        self.previous = numpy.zeros(HOP)    # last reference block
+        self.zeros = numpy.zeros(HOP)
+        self.delta = self.partitions * 2 * HOP * ECHO_QUIET_RMS ** 2
+        self.warmup = ECHO_WARMUP * SAMPLE_RATE * ECHO_QUIET_RMS ** 2
+        self.heard = 0.0     # reference energy so far
+        self.constrain = 0   # partition whose weights are constrained next
+        self.pey = 0.0       # leakage fit: correlation of error and echo estimate powers ...
+        self.pyy = 1.0       # ... and of the echo estimate power with itself
+        self.leak = 1.0      # residual echo share of the echo estimate power (all of it until fitted)
+        n = numpy.arange(2 * HOP)
+        self.window = numpy.sqrt(0.5 - 0.5 * numpy.cos(numpy.pi * n / HOP))
+        self.min_gain = 10 ** (-ECHO_SUPPRESS_DB / 20)
+        self.last_out = numpy.zeros(HOP)    # last block of linear filter output ...
+        self.last_echo = numpy.zeros(HOP)   # ... and of echo estimate
+        self.overlap = numpy.zeros(HOP)     # second half of the last postfilter window
+        self.residual = numpy.zeros(bins)   # residual echo power per frequency
+        self.cross = numpy.zeros(bins, dtype=numpy.complex128)  # smoothed output x echo estimate spectrum ...
+        self.out_power = numpy.zeros(bins)  # ... and their smoothed powers
+        self.echo_power = numpy.zeros(bins)
+        self.clean = numpy.zeros(bins)      # last block's power after the postfilter
+        self.queue = collections.deque(maxlen=REFERENCE_FRAMES)
+        self.pending = b''
+
+    def played(self, pcm):
+        """Output thread: pcm was just written to the speakers."""
+        self.queue.append(pcm)
+
+    def _reference(self, size):
+        pending = self.pending
+        queue = self.queue
+        while queue:
+            pending += queue.popleft()
+        excess = len(pending) - size - ECHO_SLACK * 2
+        if excess > 0:
+            pending = pending[excess & ~1:]
+        reference, self.pending = pending[:size], pending[size:]
+        return reference + bytes(size - len(reference))
+
+    def process(self, pcm):
+        mic = numpy.frombuffer(pcm, dtype='<i2').astype(numpy.float64)
+        blocks = mic.size // HOP
+        if not blocks or mic.size % HOP:
+            return pcm
+        reference = numpy.frombuffer(self._reference(len(pcm)), dtype='<i2').astype(numpy.float64)
+        out = numpy.empty_like(mic)
+        weights, spectra, zeros = self.weights, self.spectra, self.zeros
+        for i in range(blocks):
+            x = reference[i * HOP:(i + 1) * HOP]
+            d = mic[i * HOP:(i + 1) * HOP]
+            spectra[1:] = spectra[:-1]
+            spectra[0] = numpy.fft.rfft(numpy.concatenate((self.previous, x)))
+            self.previous = x
+            echo = numpy.fft.irfft((weights * spectra).sum(axis=0), 2 * HOP)[HOP:]
+            e = d - echo
+            error = numpy.fft.rfft(numpy.concatenate((zeros, e)))
+            self.heard += x.dot(x)
+            if self.heard < self.warmup:
+                step = ECHO_STEP
+            else:
+                # Residual echo is the leakage share of the echo estimate; a
+                # larger error is near-end speech or noise, not to be learnt from
+                estimate = numpy.fft.rfft(numpy.concatenate((zeros, echo)))
+                error_power = error.real ** 2 + error.imag ** 2
+                echo_power = estimate.real ** 2 + estimate.imag ** 2
+                error_dev = error_power - error_power.mean()
+                echo_dev = echo_power - echo_power.mean()
+                self.pey += ECHO_LEAK_SMOOTH * (error_dev.dot(echo_dev) - self.pey)
+                self.pyy += ECHO_LEAK_SMOOTH * (echo_dev.dot(echo_dev) - self.pyy)
+                self.leak = leak = min(1.0, max(0.005, self.pey / max(self.pyy, 1e-9)))
+                step = min(ECHO_STEP, ECHO_LEARN * leak * echo_power.sum() / (error_power.sum() + 1e-3))
+            power = (spectra.real ** 2 + spectra.imag ** 2).sum(axis=0)
+            weights += step * spectra.conj() * (error / (power + self.delta + ECHO_SPREAD * power.mean()))
+            # Keep one partition a linear (not circular) convolution per block
+            taps = numpy.fft.irfft(weights[self.constrain], 2 * HOP)
+            taps[HOP:] = 0.0
+            weights[self.constrain] = numpy.fft.rfft(taps)
+            self.constrain = (self.constrain + 1) % self.partitions
+            # A filter gone wrong (echo path change) mustn't add to what was heard
+            out[i * HOP:(i + 1) * HOP] = self._postfilter(e if e.dot(e) <= d.dot(d) else d, echo)
+        return numpy.clip(out, -32768, 32767).astype('<i2').tobytes()
+
+    def _postfilter(self, e, echo):
+        """Residual echo suppression of block e, given the block's echo
+        estimate; returns the block before it (50% overlapping windows)."""
+        spectrum = numpy.fft.rfft(numpy.concatenate((self.last_out, e)) * self.window)
+        estimate = numpy.fft.rfft(numpy.concatenate((self.last_echo, echo)) * self.window)
+        self.last_out, self.last_echo = e, echo
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        echo_power = estimate.real ** 2 + estimate.imag ** 2
+        self.cross += ECHO_COHERENCE_SMOOTH * (spectrum * estimate.conj() - self.cross)
+        self.out_power += ECHO_COHERENCE_SMOOTH * (power - self.out_power)
+        self.echo_power += ECHO_COHERENCE_SMOOTH * (echo_power - self.echo_power)
+        coherence = ((self.cross.real ** 2 + self.cross.imag ** 2)
+                     / (self.out_power * self.echo_power + 1e-3))
+        # Less the coherence smoothing alone gives unrelated spectra
+        bias = ECHO_COHERENCE_SMOOTH / 2
+        coherence = numpy.maximum(coherence - bias, 0.0) / (1 - bias)
+        self.residual = numpy.maximum(self.residual * ECHO_TAIL_DECAY,
+                                      numpy.maximum(self.leak * echo_power, coherence * power))
+        residual = self.residual + 1e-3
+        ratio = (SNR_WEIGHT * self.clean / residual
+                 + (1 - SNR_WEIGHT) * numpy.maximum(power / residual - 1, 0.0))
+        gain = numpy.maximum(ratio / (1 + ratio), self.min_gain)
+        self.clean = gain * gain * power
+        block = numpy.fft.irfft(spectrum * gain, 2 * HOP) * self.window
+        result = block[:HOP] + self.overlap
+        self.overlap = block[HOP:]
+        return result
+
+
+class AutomaticGainControl:
+    """Gain towards a target speech level (see the module docstring)."""
+
+    name = "agc"
+
+    def __init__(self, target_db=AGC_TARGET_DB):
+        self.target_db = target_db
+        self.power = 10 ** (target_db / 10)  # tracked speech power, relative to full scale
+        self.floor = FLOOR_INITIAL_DB
+        self.gain_db = 0.0
+
+    def process(self, pcm):
+        samples = len(pcm) // 2
+        if not samples:
+            return pcm
+        seconds = samples / SAMPLE_RATE
+        level = level_db(dsp.rms(pcm))
+        if level > AGC_ACTIVE_DB and level > self.floor + AGC_SNR_DB:
+            self.power += (10 ** (level / 10) - self.power) * min(1.0, seconds / AGC_LEVEL_TAU)
+        tau = FLOOR_FALL if level < self.floor else FLOOR_RISE
+        self.floor += (level - self.floor) * min(1.0, seconds / tau)
+        wanted = max(AGC_MIN_DB, min(AGC_MAX_DB, self.target_db - 10 * math.log10(self.power)))
+        step = (AGC_ATTACK if wanted < self.gain_db else AGC_RELEASE) * seconds
+        self.gain_db += max(-step, min(step, wanted - self.gain_db))
+        gain = 10 ** (self.gain_db / 20)
+        peak = dsp.peak(pcm)
+        if peak * gain > AGC_LIMIT:
+            gain = AGC_LIMIT / peak
+        return dsp.apply_gain(pcm, gain)
+
+
+class CaptureProcessor:
+    """The capture-side chain: EchoCanceller and NoiseSuppressor (each if
+    enabled, NumPy loaded and frame_size a whole number of blocks), then
+    AutomaticGainControl (if enabled). echo is the EchoCanceller or None;
+    its played() must see what the speakers play. bypass can be switched at
+    any time.
+    """
+
+    def __init__(self, frame_size=FRAME_SIZE, denoise=True, agc=True,
+                 agc_target=AGC_TARGET_DB, bypass=False, echo=False):
+        self.stages = []
+        blocks = NUMPY_AVAILABLE and frame_size % HOP == 0
+        self.echo = EchoCanceller() if echo and blocks else None
+        if self.echo:
+            self.stages.append(self.echo)
+        if denoise and blocks:
+            self.stages.append(NoiseSuppressor())
+        if agc:
+            self.stages.append(AutomaticGainControl(agc_target))
+        self.names = tuple(stage.name for stage in self.stages)
+        self.bypass = bypass
+
+    def process(self, pcm, times=None):
+        """pcm through every stage; each stage's time goes to times.add(name, seconds)."""
+        if self.bypass:
+            return pcm
+        clock = time.perf_counter
+        for stage in self.stages:
+            started = clock()
+            pcm = stage.process(pcm)
+            if times is not None:
+                times.add(stage.name, clock() - started)
+        return pcm
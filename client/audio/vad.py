@@ -0,0 +1,123 @@
+"""
+Voice activity detection for voice-activation mode.
+
+A detector sees every captured frame (pcm, its RMS and the noise gate) and
+says whether it is speech to send. Two are available (DETECTORS):
+
+    threshold  RMS above va_threshold and the noise gate: the original one
+    adaptive   energy over an adaptive noise floor, checked against the zero
+               crossing rate, with attack and hangover timing
+
+The adaptive detector follows the background level (a noise floor that
+falls quickly and rises slowly), so a fan or a noisier room doesn't keep
+it open, and a quiet voice in a quiet room still gets through. Voiced
+speech crosses zero rarely; breathing, hiss and key clicks are noise-like
+and cross often. Speech starts once ATTACK of voiced frames above the floor
+have come in a row; loud noise-like frames (unvoiced sounds within words)
+only keep it going. Speech goes on for HANGOVER after the last frame that
+kept it, so word endings and short pauses aren't cut. The capture pipeline
+holds back PREROLL of audio and sends it when speech starts, so an
+unvoiced onset and the attack time aren't lost either.
+
+Per frame this costs one RMS and one zero crossing count (dsp, C loops
+with audioop) and a few float operations.
+"""
+
+import math
+from client.audio import dsp
+from client.audio.opus_codec import SAMPLE_RATE
+
+ATTACK = 0.02        # voiced frames in a row that start speech (s)
+HANGOVER = 0.3       # speech goes on this long after the last frame that kept it (s)
+PREROLL = 0.08       # audio held back and sent when speech starts (s): ATTACK plus an unvoiced onset
+SNR_DB = 9.0         # a voiced frame is this far above the noise floor
+SNR_NOISY_DB = 20.0  # a noise-like frame (high zero crossing rate) this far to keep speech going
+ZCR_VOICED = 0.1     # zero crossings per sample below which a frame counts as voiced
+FLOOR_INITIAL_DB = -60.0
+FLOOR_FALL = 0.05    # time constant of the noise floor towards a quieter level (s)
+FLOOR_RISE = 3.0     # ... towards a louder one, while not in speech (s)
+FLOOR_RISE_SPEECH = 30.0  # ... during speech, so steady noise is learnt in the end
+
+
+def level_db(rms):
+    """RMS of 16-bit samples in dB relative to full scale (-96 for silence)."""
+    return 20 * math.log10(max(rms, 0.5) / 32768)
+
+
+class ThresholdVAD:
+    """Speech is any frame whose RMS is above both threshold and the gate."""
+
+    name = "threshold"
+
+    def __init__(self, threshold=500):
+        self.threshold = threshold
+
+    def is_speech(self, pcm, rms, gate=0):
+        return rms > self.threshold and rms > gate
+
+    def reset(self):
+        pass
+
+
+class AdaptiveVAD:
+    """Energy over an adaptive noise floor plus zero crossing rate, with
+    attack and hangover (see the module docstring).
+
+    The noise gate still applies to starting speech (a frame at or under it
+    never passes); hangover carries through quieter frames. threshold is
+    accepted for the same constructor as ThresholdVAD and not used.
+    """
+
+    name = "adaptive"
+
+    def __init__(self, threshold=None):
+        self.reset()
+
+    def reset(self):
+        self.floor = FLOOR_INITIAL_DB
+        self.active = False
+        self.run = 0.0    # frames in a row that passed (s)
+        self.quiet = 0.0  # since the last frame that passed (s)
+
+    def passes(self, level, zcr, rms, gate):
+        """Whether a frame starts or keeps speech (see the module docstring)."""
+        if rms <= gate:
+            return False
+        snr = level - self.floor
+        if zcr < ZCR_VOICED:
+            return snr > SNR_DB
+        return self.active and snr > SNR_NOISY_DB
+
+    def is_speech(self, pcm, rms, gate=0):
+        samples = len(pcm) // 2
+        if not samples:
+            return self.active
+        seconds = samples / SAMPLE_RATE
+        level = level_db(rms)
+        zcr = dsp.crossings(pcm) / samples
+        if self.passes(level, zcr, rms, gate):
+            self.run += seconds
+            self.quiet = 0.0
+            if self.run >= ATTACK:
+                self.active = True
+        else:
+            self.run = 0.0
+            self.quiet += seconds
+            if self.quiet > HANGOVER:
+                self.active = False
+        # Noise floor: quickly down to a quieter background, slowly up to a louder one
+        if level < self.floor:
+            tau = FLOOR_FALL
+        else:
+            tau = FLOOR_RISE_SPEECH if self.active or self.run else FLOOR_RISE
+        self.floor += (level - self.floor) * min(1.0, seconds / tau)
+        return self.active
+
+
+DETECTORS = {"threshold": ThresholdVAD, "adaptive": AdaptiveVAD}
+DEFAULT_DETECTOR = "adaptive"
+
+
+def make_detector(name, threshold=500):
+    """A new detector by name (DEFAULT_DETECTOR for an unknown one)."""
+    return DETECTORS.get(name, DETECTORS[DEFAULT_DETECTOR])(threshold)
@@ -2,6 +2,8 @@
 Voice mode logic: Push-to-Talk (PTT) and Voice Activity Detection (VA).
 """
 
+from client.audio.vad import DEFAULT_DETECTOR, make_detector
+
 
 class VoiceModeManager:
     def __init__(self):
@@ -9,6 +11,11 @@ class VoiceModeManager:
         self.ptt_active = False
         self.va_active = False
         self.va_threshold = 500
+        self.vad = make_detector(DEFAULT_DETECTOR, self.va_threshold)
+
+    def set_detector(self, name):
+        """Use the voice activity detector name (see vad.DETECTORS) from now on."""
+        self.vad = make_detector(name, self.va_threshold)
 
     def is_ptt(self):
         return self.mode == "ptt"
@@ -20,6 +27,7 @@ class VoiceModeManager:
         if self.mode == "ptt":
             self.mode = "va"
             self.va_active = True
+            self.vad.reset()
         else:
             self.mode = "ptt"
             self.va_active = False
@@ -31,10 +39,14 @@ class VoiceModeManager:
         if self.mode == "ptt":
             self.ptt_active = active
 
-    def should_transmit(self, rms=0):
-        """Check if audio should be transmitted based on mode and input level."""
+    def should_transmit(self, rms=0, pcm=b'', gate=0):
+        """Check if audio should be transmitted based on mode and input level.
+
+        gate is the noise gate: PTT frames at or under it aren't sent, and
+        in VA mode it is passed to the detector.
+        """
         if self.mode == "ptt":
-            return self.ptt_active
+            return self.ptt_active and rms > gate
         elif self.mode == "va":
-            return self.va_active and rms > self.va_threshold
+            return self.va_active and self.vad.is_speech(pcm, rms, gate)
         return False
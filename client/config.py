@@ -28,11 +28,48 @@ def load_config():
             "output_device": "",
             "noise_gate": 200,
             "va_threshold": 500,
-            "voice_mode": "ptt"
+            # Voice activation detector: "adaptive" (noise floor, zero
+            # crossings, hangover) or "threshold" (va_threshold only)
+            "vad": "adaptive",
+            "voice_mode": "ptt",
+            # Capture processing: echo cancellation for speakers and noise
+            # suppression (both need NumPy), automatic gain control towards
+            # agc_target dBFS; "processing": False bypasses all three
+            "processing": True,
+            "echo_cancellation": True,
+            "noise_suppression": True,
+            "agc": True,
+            "agc_target": -23,
+            # Opus frame duration: 10, 20, 40 or 60 ms
+            "frame_ms": 20,
+            # Opus DTX: background noise isn't sent, the talk spurt ends instead
+            "dtx": True,
+            # Play other people's background noise through their pauses
+            "comfort_noise": False
         },
         "volume": {
             "master": 100,
             "users": {}
+        },
+        "network": {
+            "voice_udp": True,
+            # Speaker IDs instead of nicknames in voice frames; turn off for
+            # a server that predates them
+            "voice_compact": True,
+            # Packet loss (%) Opus in-band FEC is tuned for at least; 0 turns it off
+            "expected_loss": 10,
+            # Bounds for the adaptive voice bitrate (bit/s)
+            "min_bitrate": 12000,
+            "max_bitrate": 64000,
+            # Frames bundled into each voice packet: fewer packets and headers
+            # per second, at frame_ms of latency per extra frame
+            "frames_per_packet": 1,
+            # Longest packet (ms) congestion may bundle frames up to; back
+            # to frames_per_packet once the link is clean. 0 keeps it fixed
+            "max_packet_ms": 60,
+            # Negotiate frame duration and bundling in the voice handshake;
+            # turn off for a server that predates it
+            "voice_framing": True
         }
     }
     try:
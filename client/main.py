@@ -14,6 +14,8 @@ from client.ui.main_window import MainWindow
 from client.network.text_client import TextClient
 from client.network.voice_client import VoiceClient
 from client.protocol import TEXT_PORT, VOICE_PORT
+from client.audio.opus_codec import EXPECTED_LOSS, FRAME_MS
+from client.config import load_config
 
 
 class HybridApp:
@@ -73,13 +75,30 @@ class HybridApp:
     def _on_auth_ok(self, host, username, password):
         """Authentication succeeded. Connect voice and open main window."""
         try:
-            self.voice_client = VoiceClient(host, username, VOICE_PORT)
+            config = load_config()
+            network = config.get("network", {})
+            self.voice_client = VoiceClient(
+                host, username, VOICE_PORT, compact=network.get("voice_compact", True),
+                expected_loss=network.get("expected_loss", EXPECTED_LOSS),
+                frame_ms=config.get("audio", {}).get("frame_ms", FRAME_MS),
+                frames_per_packet=network.get("frames_per_packet", 1),
+                max_packet_ms=network.get("max_packet_ms", 60),
+                negotiate_framing=network.get("voice_framing", True),
+                dtx=config.get("audio", {}).get("dtx", True))
+            # Speaker IDs may already be known from STATE
+            self.text_client.speakers_changed.connect(self.voice_client.set_speakers)
+            self.voice_client.set_speakers(self.text_client.speaker_table())
             self.voice_client.connect_to_server()
             self.voice_client.start()
         except Exception as e:
             self.login_window.show_error(f"Голосовое подключение не удалось: {e}")
             return
 
+        # Try the UDP voice path; TCP stays in use until the server acknowledges it
+        if load_config().get("network", {}).get("voice_udp", True):
+            self.text_client.voice_udp_token.connect(self.voice_client.start_udp)
+            self.text_client.request_voice_udp()
+
         # Disconnect auth signals to avoid duplicate handling
         try:
             self.text_client.auth_ok.disconnect()
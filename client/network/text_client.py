@@ -3,10 +3,12 @@ Text socket client running in a QThread.
 Emits signals for all protocol events.
 """
 
+import json
 import socket
+import threading
 from PyQt5.QtCore import QThread, pyqtSignal
 from client.protocol import (
-    send_line, parse_command,
+    send_line, parse_command, LineReader,
     RESP_REG_OK, RESP_REG_FAIL, RESP_AUTH_OK, RESP_AUTH_FAIL,
     EVT_CHANNEL_CREATED, EVT_CHANNEL_DELETED, EVT_CHANNEL_DELETE_FAIL,
     EVT_USER_JOINED_CHANNEL, EVT_USER_LEFT_CHANNEL, EVT_CHANNEL_LIST,
@@ -14,6 +16,9 @@ from client.protocol import (
     CMD_MSG, CMD_TYPING, CMD_PING, RESP_PONG,
     CMD_LOGIN, CMD_REGISTER, CMD_CREATE_CHANNEL, CMD_DELETE_CHANNEL,
     CMD_JOIN_CHANNEL, CMD_LEAVE_CHANNEL,
+    CMD_VOICE_UDP, RESP_VOICE_UDP, RESP_VOICE_UDP_FAIL, CMD_VOICE_REPORT,
+    EVT_STATE, EVT_PRESENCE, CMD_PRESENCE_RESYNC,
+    PRESENCE_ONLINE, PRESENCE_OFFLINE, PRESENCE_MOVE, PRESENCE_VOICE,
     TEXT_PORT,
 )
 
@@ -41,6 +46,16 @@ class TextClient(QThread):
     system_message = pyqtSignal(str)  # message
     user_list_updated = pyqtSignal(list)  # [usernames]
 
+    # Session state snapshot, then sequenced presence deltas
+    state_received = pyqtSignal(list, dict)  # [channel_names], {channel_name: [usernames]}
+    presence_moved = pyqtSignal(str, str)  # username, channel_name ("" = none)
+    presence_offline = pyqtSignal(str)  # username
+
+    # Voice transport
+    voice_udp_token = pyqtSignal(str)  # token for the UDP HELLO
+    speakers_changed = pyqtSignal(dict)  # {speaker_id: username}
+    voice_report = pyqtSignal(str, float, float)  # reporter, loss %, jitter ms
+
     # Connection
     disconnected = pyqtSignal()
 
@@ -50,6 +65,14 @@ class TextClient(QThread):
         self.port = port
         self.sock = None
         self.running = False
+        # Local copy of the server state, kept current from STATE and
+        # PRESENCE so a window created after login can start from it
+        self.state_lock = threading.Lock()
+        self.presence_seq = None  # None until the first STATE
+        self.channels = []
+        self.channel_members = {}  # {channel_name: [usernames]}
+        self.online_users = []
+        self.speaker_ids = {}  # {username: speaker_id}
 
     def connect_to_server(self):
         """Establish TCP connection. Call before start()."""
@@ -92,22 +115,34 @@ class TextClient(QThread):
     def delete_channel(self, name):
         self.send(f"{CMD_DELETE_CHANNEL}:{name}")
 
+    def request_voice_udp(self):
+        self.send(CMD_VOICE_UDP)
+
+    def send_voice_report(self, sender, loss, jitter_ms):
+        """Tell sender (via the server) how its voice reaches us."""
+        self.send(f"{CMD_VOICE_REPORT}:{loss:.1f}:{jitter_ms:.0f}:{sender}")
+
+    def session_state(self):
+        """(channel_names, {channel: [usernames]}) as last known, or None before STATE."""
+        with self.state_lock:
+            if self.presence_seq is None and not self.channels:
+                return None
+            return list(self.channels), {ch: list(users) for ch, users in self.channel_members.items()}
+
+    def speaker_table(self):
+        """{speaker_id: username} for every voice session, as last known."""
+        with self.state_lock:
+            return {sid: name for name, sid in self.speaker_ids.items()}
+
     def run(self):
         """QThread main loop: read and dispatch protocol messages."""
-        buffer = ""
+        reader = LineReader(self.sock)
         while self.running:
             try:
-                data = self.sock.recv(4096).decode('utf-8')
-                if not data:
+                line = reader.read_line()
+                if line is None:
                     break
-
-                buffer += data
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    line = line.strip()
-                    if not line:
-                        continue
-                    self._dispatch(line)
+                self._dispatch(line)
 
             except Exception:
                 break
@@ -129,6 +164,8 @@ class TextClient(QThread):
             self.reg_fail.emit(payload)
         elif cmd == EVT_CHANNEL_LIST:
             channels = payload.split(",") if payload else []
+            with self.state_lock:
+                self.channels = list(channels)
             self.channel_list_updated.emit(channels)
         elif cmd == EVT_CHANNEL_CREATED:
             self.channel_created.emit(payload)
@@ -164,6 +201,95 @@ class TextClient(QThread):
         elif cmd == EVT_USERLIST:
             users = payload.split(",") if payload else []
             self.user_list_updated.emit(users)
+        elif cmd == EVT_STATE:
+            self._apply_state(payload)
+        elif cmd == EVT_PRESENCE:
+            self._apply_presence_delta(payload)
+        elif cmd == RESP_VOICE_UDP:
+            if payload:
+                self.voice_udp_token.emit(payload)
+        elif cmd == RESP_VOICE_UDP_FAIL:
+            pass  # Server has UDP disabled: stay on TCP
+        elif cmd == CMD_VOICE_REPORT:
+            parts = payload.split(":", 2)
+            if len(parts) == 3:
+                try:
+                    self.voice_report.emit(parts[2], float(parts[0]), float(parts[1]))
+                except ValueError:
+                    pass
+
+    def _apply_state(self, payload):
+        """Replace the local state with STATE:<seq>:<json>."""
+        seq, _, body = payload.partition(":")
+        try:
+            snapshot = json.loads(body)
+            seq = int(seq)
+        except ValueError:
+            return
+        with self.state_lock:
+            self.presence_seq = seq
+            self.channels = list(snapshot.get("channels", []))
+            self.channel_members = {ch: list(users) for ch, users in snapshot.get("members", {}).items()}
+            self.online_users = list(snapshot.get("online", []))
+            self.speaker_ids = dict(snapshot.get("voice", {}))
+        channels, members = self.session_state()
+        self.state_received.emit(channels, members)
+        self.user_list_updated.emit(list(self.online_users))
+        self.speakers_changed.emit(self.speaker_table())
+
+    def _move_member(self, username, channel_name):
+        """Update channel_members for one user (state_lock held)."""
+        for ch, users in list(self.channel_members.items()):
+            if username in users:
+                users.remove(username)
+                if not users:
+                    del self.channel_members[ch]
+        if channel_name:
+            self.channel_members.setdefault(channel_name, []).append(username)
+
+    def _apply_presence_delta(self, payload):
+        """Apply PRESENCE:<seq>:<op>:<user>[:<channel>] if it is the next one.
+
+        On a gap, request a fresh snapshot and ignore deltas until it arrives.
+        """
+        parts = payload.split(":", 3)
+        if len(parts) < 3 or not parts[0].isdigit() or self.presence_seq is None:
+            return
+        seq = int(parts[0])
+        if seq <= self.presence_seq:
+            return  # Already covered by the snapshot
+        if seq != self.presence_seq + 1:
+            self.presence_seq = None
+            self.send(CMD_PRESENCE_RESYNC)
+            return
+        self.presence_seq = seq
+
+        op, username = parts[1], parts[2]
+        if op == PRESENCE_ONLINE:
+            with self.state_lock:
+                if username not in self.online_users:
+                    self.online_users.append(username)
+            self.user_list_updated.emit(list(self.online_users))
+        elif op == PRESENCE_OFFLINE:
+            with self.state_lock:
+                if username in self.online_users:
+                    self.online_users.remove(username)
+                self._move_member(username, None)
+            self.presence_offline.emit(username)
+            self.user_list_updated.emit(list(self.online_users))
+        elif op == PRESENCE_MOVE:
+            channel_name = parts[3] if len(parts) > 3 else ""
+            with self.state_lock:
+                self._move_member(username, channel_name)
+            self.presence_moved.emit(username, channel_name)
+        elif op == PRESENCE_VOICE:
+            speaker_id = parts[3] if len(parts) > 3 else ""
+            with self.state_lock:
+                if speaker_id.isdigit():
+                    self.speaker_ids[username] = int(speaker_id)
+                else:
+                    self.speaker_ids.pop(username, None)
+            self.speakers_changed.emit(self.speaker_table())
 
     def stop(self):
         self.running = False
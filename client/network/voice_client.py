@@ -1,47 +1,286 @@
 """
 Voice socket client running in a QThread.
 Handles binary voice frames with Opus decode.
+
+Frames go over the TCP voice socket by default. After text login the client
+can negotiate a UDP path (VOICE_UDP token -> UDP HELLO -> HELLO_ACK); once
+acknowledged, frames are sent and received as datagrams and TCP is kept open
+as the fallback.
+
+In compact mode (the default) frames carry the sender's 16-bit speaker ID
+instead of the nickname; the ID -> username table comes from the text
+connection (set_speakers).
+
+The frame duration and frames per packet are negotiated in the voice
+handshake (unless negotiate_framing is off, for a server that predates it:
+then frames are 20 ms, one per packet). We ask for up to max_packet_ms of
+frames per packet and start at frames_per_packet; set_frames_per_packet()
+moves between the two at runtime (the bitrate controller does, with
+congestion). Packets of several frames carry bundles, which are also what a
+negotiating client receives from a bundling sender; other listeners get
+them split by the server.
+
+When we stop sending (the capture pipeline's flush, or the encoder going
+into DTX on background noise) a talk spurt end frame follows the last audio,
+carrying the background noise level; one received stops the sender's jitter
+buffer without waiting for more packets.
+
+Decoded frames go straight to the playback mixer when one is attached
+(self.playback), without a trip through the GUI thread; voice_received is
+only emitted when there is none.
 """
 
 import socket
 import struct
 import select
+import time
 from PyQt5.QtCore import QThread, pyqtSignal
-from client.protocol import VOICE_PORT
-from client.audio.opus_codec import parse_voice_frame, build_voice_frame, OpusCodec
+from client.protocol import (
+    VOICE_PORT, UDP_HELLO, UDP_HELLO_ACK, UDP_VOICE, VOICE_COMPACT_PREFIX,
+    MIX_SPEAKER_ID, MIX_NICKNAME, DEFAULT_FRAMING,
+    audio_level, build_udp_datagram, parse_udp_datagram, timestamp_ms,
+    format_framing, parse_framing, pack_bundle,
+)
+from client.audio.opus_codec import (
+    parse_voice_frame, build_voice_frame,
+    parse_compact_voice_frame, build_compact_voice_frame, OpusCodec, DecoderPool,
+    EXPECTED_LOSS, FRAME_MS, FRAME_DURATIONS, CODEC_ID_OPUS, CODEC_ID_OPUS_BUNDLE,
+    CODEC_ID_SPURT_END, frame_samples, is_dtx,
+)
+
+UDP_HELLO_INTERVAL = 0.5   # resend HELLO until acknowledged
+UDP_HELLO_ATTEMPTS = 6     # then give up and stay on TCP
+UDP_KEEPALIVE = 5.0        # refresh NAT mapping / server binding
+UDP_TIMEOUT = 15.0         # no datagram for this long -> back to TCP
+FRAMING_TIMEOUT = 3.0      # wait this long for the server to answer a framing request
 
 
 class VoiceClient(QThread):
     # (sender_nickname, pcm_audio_bytes)
     voice_received = pyqtSignal(str, bytes)
+    transport_changed = pyqtSignal(str)  # "udp" / "tcp"
     disconnected = pyqtSignal()
 
-    def __init__(self, host, username, port=VOICE_PORT, parent=None):
+    def __init__(self, host, username, port=VOICE_PORT, compact=True,
+                 expected_loss=EXPECTED_LOSS, frame_ms=FRAME_MS, frames_per_packet=1,
+                 max_packet_ms=0, negotiate_framing=True, dtx=True, parent=None):
         super().__init__(parent)
         self.host = host
         self.port = port
         self.username = username
         self.sock = None
         self.running = False
-        self.codec = OpusCodec()
+        self.codec = OpusCodec(expected_loss, dtx=dtx)  # encoder for our own voice
+        self.requested_framing = (frame_ms, frames_per_packet)
+        self.max_packet_ms = max_packet_ms  # longest packet asked for, to adapt up to
+        self.negotiate_framing = negotiate_framing
+        self.framing = DEFAULT_FRAMING  # (frame ms, frames per packet) in use
+        self.max_frames = 1  # frames per packet the server granted
+        self.bundle = []  # encoded frames waiting to fill a packet
+        self.bundle_level = None
+        self.talking = False  # audio sent since the last talk spurt end
+        self.decoders = DecoderPool()  # one decoder per sender
+        self.playback = None  # PlaybackMixer fed from this thread, if set
+
+        self.compact = compact
+        self.speakers = {MIX_SPEAKER_ID: MIX_NICKNAME}  # replaced whole by set_speakers
+        self.speaker_id = 0  # own ID once announced
+
+        self.udp_sock = None
+        self.udp_token = None
+        self.udp_active = False
+        self.udp_seq = 0
+        self._udp_hello_sent = 0
+        self._udp_last_hello = 0.0
+        self._udp_last_rx = 0.0
 
     def connect_to_server(self):
-        """Establish voice TCP connection."""
+        """Establish voice TCP connection, negotiating framing if enabled."""
+        # Send username for voice identification
+        handshake = VOICE_COMPACT_PREFIX + self.username if self.compact else self.username
+        if self.negotiate_framing:
+            frame_ms, frames = self.requested_framing
+            ceiling = max(frames, self.max_packet_ms // frame_ms)
+            self._connect(format_framing(frame_ms, ceiling) + ":" + handshake)
+            framing = self._read_framing()
+            if framing is not None:
+                frame_ms, self.max_frames = framing
+                self._set_framing(frame_ms, min(frames, self.max_frames))
+                return
+            # No answer: a server that predates framing, which took the request
+            # for part of the username. Start over without it.
+            self.stop()
+        self._connect(handshake)
+        self.max_frames = 1
+        self._set_framing(*DEFAULT_FRAMING)
+
+    def _connect(self, handshake):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.host, self.port))
         self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        # Send username for voice identification
-        self.sock.send(self.username.encode('utf-8'))
+        self.sock.send(handshake.encode('utf-8'))
         self.running = True
 
-    def send_voice(self, pcm_data):
-        """Encode and send a voice frame."""
-        if not self.sock or not self.running:
+    def _read_framing(self):
+        """The (frame ms, frames per packet) the server granted, or None if it didn't answer."""
+        self.sock.settimeout(FRAMING_TIMEOUT)
+        header = self._recv_exact(4)
+        size = struct.unpack('>I', header)[0] if header else 0
+        reply = self._recv_exact(size) if 0 < size <= 64 else None
+        self.sock.settimeout(None)
+        try:
+            framing = parse_framing(reply.decode('ascii')) if reply else None
+        except UnicodeDecodeError:
+            return None
+        if framing is None or framing[0] not in FRAME_DURATIONS or framing[1] < 1:
+            return None
+        return framing
+
+    def _set_framing(self, frame_ms, frames):
+        """Encode frame_ms frames, frames to a packet (before capture starts)."""
+        self.framing = (frame_ms, frames)
+        self.codec.frame_size = frame_samples(frame_ms)
+        self.bundle = []
+        self.bundle_level = None
+
+    def set_frames_per_packet(self, frames):
+        """Bundle frames to a packet from now on, within what the server
+        granted; returns the number in use. Safe while encoding: a packet
+        already filling up goes out once it has the new number."""
+        frames = max(1, min(self.max_frames, frames))
+        self.framing = (self.framing[0], frames)
+        return frames
+
+    def set_speakers(self, speakers):
+        """Install a new {speaker_id: username} table."""
+        self.speaker_id = next((sid for sid, name in speakers.items() if name == self.username), 0)
+        old, self.speakers = self.speakers, {**speakers, MIX_SPEAKER_ID: MIX_NICKNAME}
+        # A speaker ID that went away won't be reused soon; free its decoder now
+        for speaker_id in old.keys() - self.speakers.keys():
+            self.decoders.discard(speaker_id)
+
+    def start_udp(self, token):
+        """Begin UDP negotiation with a token received over the text socket."""
+        try:
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.connect((self.host, self.port))
+        except OSError:
+            return
+        self.udp_token = token
+        self._udp_hello_sent = 0
+        self._udp_last_hello = 0.0
+        # Assigned last: run() starts selecting on it immediately
+        self.udp_sock = udp
+
+    def _udp_send_hello(self):
+        self._udp_last_hello = time.monotonic()
+        self._udp_hello_sent += 1
+        try:
+            self.udp_sock.send(build_udp_datagram(
+                UDP_HELLO, 0, timestamp_ms(), self.udp_token.encode('ascii')))
+        except OSError:
+            pass
+
+    def _udp_maintain(self):
+        """Drive HELLO retries, keepalives and the fall-back-to-TCP timeout."""
+        now = time.monotonic()
+        if not self.udp_active:
+            if self._udp_hello_sent >= UDP_HELLO_ATTEMPTS:
+                if now - self._udp_last_hello > UDP_HELLO_INTERVAL:
+                    self._close_udp()
+            elif now - self._udp_last_hello > UDP_HELLO_INTERVAL:
+                self._udp_send_hello()
             return
+        if now - self._udp_last_rx > UDP_TIMEOUT:
+            self._close_udp()
+            self.transport_changed.emit("tcp")
+        elif now - self._udp_last_hello > UDP_KEEPALIVE:
+            self._udp_send_hello()
+
+    def _close_udp(self):
+        self.udp_active = False
+        sock, self.udp_sock = self.udp_sock, None
+        if sock:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def loss_reports(self):
+        """{username: (packets received, packets lost)} over UDP since the last call."""
+        reports = {}
+        for sender, counts in self.decoders.take_loss().items():
+            name = self.speakers.get(sender) if self.compact else sender
+            if name is not None and name != MIX_NICKNAME:
+                reports[name] = counts
+        return reports
+
+    def decode_stats(self):
+        """Receive-side decoder pool counters and decode time per frame."""
+        return self.decoders.stats()
+
+    @property
+    def transport(self):
+        return "udp" if self.udp_active else "tcp"
+
+    def send_voice(self, pcm_data, rms=None):
+        """Encode and send a voice frame; rms (of pcm_data) adds its audio level."""
+        frame = self.encode_voice(pcm_data, rms)
+        if frame is not None:
+            self.send_frame(frame)
+
+    def encode_voice(self, pcm_data, rms=None):
+        """Opus-encode pcm_data (one frame of codec.frame_size samples) into a
+        TCP voice frame. None if not connected, or while a packet of several
+        frames is still filling up. Background noise the encoder marks as DTX
+        isn't sent: as with flush_voice, the spurt ends instead."""
+        if not self.sock or not self.running:
+            return None
         codec_id, encoded = self.codec.encode(pcm_data)
-        frame = build_voice_frame(self.username, codec_id, encoded)
+        if is_dtx(codec_id, encoded):
+            return self.flush_voice(rms)
+        self.talking = True
+        level = audio_level(rms) if rms is not None else None
+        # A packet started before set_frames_per_packet() went down to 1 still fills up
+        if (self.framing[1] > 1 or self.bundle) and codec_id == CODEC_ID_OPUS:
+            self.bundle.append(encoded)
+            if level is not None:
+                # The packet is as loud as its loudest frame
+                self.bundle_level = level if self.bundle_level is None else min(self.bundle_level, level)
+            if len(self.bundle) < self.framing[1]:
+                return None
+            return self.flush_voice()
+        return self._build_frame(codec_id, encoded, level)
+
+    def flush_voice(self, rms=None):
+        """What to send in place of a frame that isn't: the encoded frames
+        still waiting to fill a packet, as a voice frame, then, once per talk
+        spurt, the spurt end with the level of rms (background noise); None
+        after that."""
+        packets, self.bundle = self.bundle, []
+        level, self.bundle_level = self.bundle_level, None
+        if not packets:
+            if not self.talking:
+                return None
+            self.talking = False
+            return self._build_frame(CODEC_ID_SPURT_END, b'', audio_level(rms) if rms is not None else None)
+        if len(packets) == 1:
+            return self._build_frame(CODEC_ID_OPUS, packets[0], level)
+        return self._build_frame(CODEC_ID_OPUS_BUNDLE, pack_bundle(packets), level)
+
+    def _build_frame(self, codec_id, audio, level):
+        if self.compact:
+            return build_compact_voice_frame(self.speaker_id, codec_id, audio, level)
+        return build_voice_frame(self.username, codec_id, audio, level)
+
+    def send_frame(self, frame):
+        """Send a frame from encode_voice over UDP if negotiated, else TCP."""
         try:
-            self.sock.send(frame)
+            if self.udp_active:
+                self.udp_sock.send(build_udp_datagram(UDP_VOICE, self.udp_seq, timestamp_ms(), frame[4:]))
+                self.udp_seq = (self.udp_seq + 1) & 0xFFFF
+            else:
+                self.sock.send(frame)
         except Exception:
             pass
 
@@ -58,13 +297,79 @@ class VoiceClient(QThread):
                 return None
         return data if len(data) == n else None
 
+    def _handle_payload(self, payload, seq=None):
+        """Decode one voice payload; seq (UDP only) lets lost packets be concealed."""
+        if self.compact:
+            parsed = parse_compact_voice_frame(payload)
+            if not parsed:
+                return
+            speaker_id, codec_id, audio_data = parsed
+            nickname = self.speakers.get(speaker_id)
+            if nickname is None:
+                return  # Announcement not here yet
+            key = speaker_id
+        else:
+            parsed = parse_voice_frame(payload)
+            if not parsed:
+                return
+            nickname, codec_id, audio_data = parsed
+            key = nickname
+        if codec_id == CODEC_ID_SPURT_END:
+            if seq is not None:
+                self.decoders.receive(key, codec_id, audio_data, seq)  # Takes a sequence number
+            if self.playback is not None:
+                end = len(audio_data) + (5 if self.compact else 5 + len(nickname.encode('utf-8')))
+                self.playback.end(nickname, payload[end] if len(payload) > end else None)
+            return
+        if seq is None:
+            concealed, pcm_data = (), self.decoders.decode(key, codec_id, audio_data)
+        else:
+            concealed, pcm_data = self.decoders.receive(key, codec_id, audio_data, seq)
+        if pcm_data is None:
+            return
+        if self.playback is not None:
+            self.playback.push(nickname, pcm_data, concealed=concealed)
+        else:
+            for pcm in (*concealed, pcm_data):
+                self.voice_received.emit(nickname, pcm)
+
+    def _handle_datagram(self):
+        try:
+            data = self.udp_sock.recv(65536)
+        except OSError:
+            return
+        parsed = parse_udp_datagram(data)
+        if not parsed:
+            return
+        kind, seq, timestamp, body = parsed
+        self._udp_last_rx = time.monotonic()
+        if kind == UDP_HELLO_ACK:
+            if not self.udp_active:
+                self.udp_active = True
+                self.transport_changed.emit("udp")
+        elif kind == UDP_VOICE:
+            self._handle_payload(body, seq)
+
     def run(self):
         """QThread main loop: receive and decode voice frames."""
         while self.running:
-            ready = select.select([self.sock], [], [], 0.3)
+            udp = self.udp_sock
+            if udp:
+                self._udp_maintain()
+                udp = self.udp_sock
+            watch = [self.sock, udp] if udp else [self.sock]
+            try:
+                ready = select.select(watch, [], [], 0.1 if udp else 0.3)
+            except (OSError, ValueError):
+                break
             if not ready[0]:
                 continue
 
+            if udp and udp in ready[0]:
+                self._handle_datagram()
+            if self.sock not in ready[0]:
+                continue
+
             try:
                 len_data = self._recv_exact(4)
                 if not len_data:
@@ -77,18 +382,13 @@ class VoiceClient(QThread):
                 if not payload:
                     break
 
-                parsed = parse_voice_frame(payload)
-                if not parsed:
-                    continue
-
-                nickname, codec_id, audio_data = parsed
-                pcm_data = self.codec.decode(codec_id, audio_data)
-                self.voice_received.emit(nickname, pcm_data)
+                self._handle_payload(payload)
 
             except Exception:
                 break
 
         self.running = False
+        self._close_udp()
         self.disconnected.emit()
 
     def stop(self):
@@ -1,7 +1,7 @@
 """Main window: assembles sidebar, chat panel, bottom panel. Manages all connections."""
 
+import collections
 import time
-import threading
 from PyQt5.QtWidgets import (
     QMainWindow, QWidget, QHBoxLayout, QVBoxLayout,
     QInputDialog, QSlider, QDialog, QLabel, QMessageBox
@@ -16,10 +16,19 @@ from client.ui.settings_dialog import SettingsDialog
 from client.network.text_client import TextClient
 from client.network.voice_client import VoiceClient
 from client.audio.engine import AudioEngine
-from client.audio.opus_codec import OpusCodec, FRAME_SIZE
+from client.audio.opus_codec import OpusCodec, FRAME_SIZE, EXPECTED_LOSS
 from client.audio.voice_modes import VoiceModeManager
+from client.audio.vad import DEFAULT_DETECTOR, PREROLL
+from client.audio.playback import PlaybackMixer, AudioOutput, SPEAKING_HOLD
+from client.audio.capture import CapturePipeline
+from client.audio.processing import CaptureProcessor, AGC_TARGET_DB, NUMPY_AVAILABLE
+from client.audio.bitrate import BitrateController, MIN_BITRATE, MAX_BITRATE
 from client.config import load_config, save_config
 
+SPEAKING_POLL_MS = 100  # sidebar speaking indicators refresh period
+LINK_REPORT_MS = 2000   # RTT probe, receiver reports and bitrate update period
+PING_TIMEOUT = 10.0     # no automatic PING while one has been unanswered this long (s)
+
 
 class MainWindow(QMainWindow):
     def __init__(self, host, username, text_client, voice_client, parent=None):
@@ -29,15 +38,17 @@ class MainWindow(QMainWindow):
         self.text_client = text_client
         self.voice_client = voice_client
         self.current_channel = None
-        self.ping_time = 0
+        self.pings = collections.deque()  # (monotonic send time, typed by the user) per PING awaiting PONG
 
         # Audio
         self.audio_engine = AudioEngine()
         self.codec = OpusCodec()
         self.voice_mode = VoiceModeManager()
-        self.voice_sender_running = False
-        self.output_stream = None
-        self._restart_output = False
+        self.capture = None
+        self.playback = PlaybackMixer(gain=self.audio_engine.gain)
+        self.audio_output = AudioOutput(self.audio_engine, self.playback)
+        self.last_sent = 0.0  # when our own last voice frame went out
+        self.speaking = set()
 
         # Load saved config
         config = load_config()
@@ -46,9 +57,23 @@ class MainWindow(QMainWindow):
         voice_mode = config.get("audio", {}).get("voice_mode", "ptt")
         self.audio_engine.noise_gate = config.get("audio", {}).get("noise_gate", 200)
         self.voice_mode.va_threshold = config.get("audio", {}).get("va_threshold", 500)
+        self.voice_mode.set_detector(config.get("audio", {}).get("vad", DEFAULT_DETECTOR))
+        self.playback.comfort_noise = config.get("audio", {}).get("comfort_noise", False)
+        self.audio_config = config.get("audio", {})  # capture processing options, read at each capture start
+        network = config.get("network", {})
+        self.bitrate = BitrateController(
+            self.voice_client.codec, network.get("min_bitrate", MIN_BITRATE),
+            network.get("max_bitrate", MAX_BITRATE), network.get("expected_loss", EXPECTED_LOSS),
+            voice=self.voice_client)
+        self.encode_totals = (0, 0.0)  # capture encode stage (calls, seconds) at the last link tick
 
         self._setup_ui()
+        self._warn_missing_processing()
         self._connect_signals()
+        # STATE usually arrives with AUTH_OK, before this window existed
+        session = self.text_client.session_state()
+        if session:
+            self._on_state(*session)
         self._start_voice_receiver()
 
         # Set voice mode
@@ -113,14 +138,19 @@ class MainWindow(QMainWindow):
         tc.message_received.connect(self._on_message_received)
         tc.typing_indicator.connect(self._on_typing)
         tc.pong_received.connect(self._on_pong)
+        tc.voice_report.connect(self._on_voice_report)
         tc.system_message.connect(self._on_system_message)
         tc.user_list_updated.connect(self._on_user_list)
+        tc.state_received.connect(self._on_state)
+        tc.presence_moved.connect(self._on_presence_moved)
+        tc.presence_offline.connect(self._on_presence_offline)
         tc.disconnected.connect(self._on_disconnected)
 
         # Voice client signals
         vc = self.voice_client
-        vc.voice_received.connect(self._on_voice_received)
+        vc.playback = self.playback
         vc.disconnected.connect(self._on_voice_disconnected)
+        vc.transport_changed.connect(self._on_voice_transport)
 
         # Sidebar signals
         self.sidebar.channel_selected.connect(self._on_channel_selected)
@@ -144,90 +174,100 @@ class MainWindow(QMainWindow):
     # ==================== VOICE RECEIVER ====================
 
     def _start_voice_receiver(self):
-        """Start the output stream for playing received audio."""
-        def receiver_loop():
-            try:
-                self.output_stream = self.audio_engine.open_output_stream()
-            except Exception:
-                self.output_stream = None
-            # The actual playback happens in _on_voice_received slot
-
-        threading.Thread(target=receiver_loop, daemon=True).start()
-
-    @pyqtSlot(str, bytes)
-    def _on_voice_received(self, sender, pcm_data):
-        """Play received voice data."""
-        if self.audio_engine.sound_muted:
-            return
-        if not self.output_stream:
-            try:
-                self.output_stream = self.audio_engine.open_output_stream()
-            except Exception:
-                return
-
-        # Restart output if needed
-        if self._restart_output:
-            self._restart_output = False
-            try:
-                self.output_stream.stop_stream()
-                self.output_stream.close()
-            except Exception:
-                pass
-            try:
-                self.output_stream = self.audio_engine.open_output_stream()
-            except Exception:
-                return
-
-        adjusted = self.audio_engine.apply_volume(pcm_data, sender)
-        try:
-            self.output_stream.write(adjusted)
-        except Exception:
-            pass
-
-        # Highlight speaking user
-        self.sidebar.highlight_speaking(sender)
-        QTimer.singleShot(500, lambda s=sender: self.sidebar.clear_speaking(s))
+        """Start the output thread and the speaking-indicator timer."""
+        self.audio_output.start()
+        self.speaking_timer = QTimer(self)
+        self.speaking_timer.timeout.connect(self._update_speaking)
+        self.speaking_timer.start(SPEAKING_POLL_MS)
+        self.link_timer = QTimer(self)
+        self.link_timer.timeout.connect(self._link_tick)
+        self.link_timer.start(LINK_REPORT_MS)
+
+    def _send_ping(self, typed=False):
+        self.pings.append((time.monotonic(), typed))
+        self.text_client.send_ping()
+
+    def _link_tick(self):
+        """Probe RTT, report how each sender reaches us, retune our own encoder."""
+        if not self.pings or time.monotonic() - self.pings[0][0] > PING_TIMEOUT:
+            if self.pings:
+                self.pings.clear()  # lost to a reconnect; don't pair old PINGs with new PONGs
+            self._send_ping()
+        jitter = self.playback.stats()
+        for user, (received, lost) in self.voice_client.loss_reports().items():
+            loss = 100.0 * lost / (received + lost)
+            self.text_client.send_voice_report(user, loss, jitter.get(user, {}).get("jitter_ms", 0.0))
+        if self.capture:
+            times = self.capture.times
+            calls, total = times.calls["encode"], times.total["encode"]
+            last_calls, last_total = self.encode_totals
+            if calls < last_calls:  # a new capture pipeline
+                last_calls, last_total = 0, 0.0
+            if calls > last_calls:
+                self.bitrate.on_encode_time((total - last_total) / (calls - last_calls))
+            self.encode_totals = (calls, total)
+        self.bitrate.update()
+
+    def _update_speaking(self):
+        """Sync sidebar highlights with who was heard (or sent) recently."""
+        now_speaking = self.playback.speaking()
+        if time.monotonic() - self.last_sent < SPEAKING_HOLD:
+            now_speaking.add(self.username)
+        for user in now_speaking - self.speaking:
+            self.sidebar.highlight_speaking(user)
+        for user in self.speaking - now_speaking:
+            self.sidebar.clear_speaking(user)
+        self.speaking = now_speaking
 
     # ==================== VOICE SENDER ====================
 
+    def _warn_missing_processing(self):
+        """Say which enabled capture stages are left out for lack of NumPy."""
+        options = self.audio_config
+        if NUMPY_AVAILABLE or not options.get("processing", True):
+            return
+        missing = [name for key, name in (("echo_cancellation", "эхоподавление"),
+                                          ("noise_suppression", "шумоподавление"))
+                   if options.get(key, True)]
+        if missing:
+            verb = "не работают" if len(missing) > 1 else "не работает"
+            message = f"NumPy не установлен: {' и '.join(missing)} {verb}"
+            print(message)
+            self.chat_panel.add_system_message(message)
+
     def _start_voice_sender(self):
-        """Start the microphone capture + send loop."""
-        if self.voice_sender_running:
+        """Start microphone capture; frames are encoded and sent off the device thread."""
+        if self.capture and self.capture.running:
             return
-        self.voice_sender_running = True
-
-        def sender_loop():
-            try:
-                stream = self.audio_engine.open_input_stream()
-            except Exception:
-                self.voice_sender_running = False
-                return
-
-            while self.voice_sender_running:
-                try:
-                    data = stream.read(self.audio_engine.frame_size, exception_on_overflow=False)
-                    rms = self.audio_engine.calc_rms(data)
-
-                    if not self.audio_engine.mic_muted and self.voice_mode.should_transmit(rms):
-                        if rms > self.audio_engine.noise_gate:
-                            self.voice_client.send_voice(data)
-                            # Show speaking in sidebar (thread-safe via signal)
-                            QTimer.singleShot(0, lambda: self.sidebar.highlight_speaking(self.username))
-                            QTimer.singleShot(500, lambda: self.sidebar.clear_speaking(self.username))
-                except Exception:
-                    break
-
-            try:
-                stream.stop_stream()
-                stream.close()
-            except Exception:
-                pass
-            self.voice_sender_running = False
-
-        threading.Thread(target=sender_loop, daemon=True).start()
+        vc = self.voice_client
+        options = self.audio_config
+        processor = CaptureProcessor(
+            vc.codec.frame_size, options.get("noise_suppression", True), options.get("agc", True),
+            options.get("agc_target", AGC_TARGET_DB), bypass=not options.get("processing", True),
+            echo=options.get("echo_cancellation", True))
+        self.audio_output.on_played = processor.echo.played if processor.echo else None
+        self.capture = CapturePipeline(
+            self.audio_engine, self._should_send, vc.encode_voice, vc.send_frame, self._on_voice_sent,
+            flush=vc.flush_voice, frame_size=vc.codec.frame_size, preroll=PREROLL, processor=processor)
+        if not self.capture.start():
+            self.capture = None
+
+    def _should_send(self, pcm, rms):
+        """True to send pcm; False to hold it back in case speech is starting
+        (voice activation); None to drop it."""
+        if self.audio_engine.mic_muted:
+            return None
+        go = self.voice_mode.should_transmit(rms, pcm, self.audio_engine.noise_gate)
+        return go if go or self.voice_mode.is_va() else None
+
+    def _on_voice_sent(self):
+        self.last_sent = time.monotonic()
 
     def _stop_voice_sender(self):
-        self.voice_sender_running = False
+        self.audio_output.on_played = None
+        if self.capture:
+            self.capture.stop()
+            self.capture = None
 
     # ==================== TEXT CLIENT HANDLERS ====================
 
@@ -275,8 +315,17 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot()
     def _on_pong(self):
-        ping_ms = int((time.time() - self.ping_time) * 1000)
-        self.chat_panel.add_system_message(f"Пинг: {ping_ms} мс")
+        if not self.pings:
+            return
+        sent, typed = self.pings.popleft()
+        rtt = time.monotonic() - sent
+        self.bitrate.on_rtt(rtt)
+        if typed:
+            self.chat_panel.add_system_message(f"Пинг: {int(rtt * 1000)} мс")
+
+    @pyqtSlot(str, float, float)
+    def _on_voice_report(self, reporter, loss, jitter_ms):
+        self.bitrate.on_report(reporter, loss, jitter_ms)
 
     @pyqtSlot(str)
     def _on_system_message(self, message):
@@ -286,6 +335,18 @@ class MainWindow(QMainWindow):
     def _on_user_list(self, users):
         pass  # User list is managed via channel users
 
+    @pyqtSlot(list, dict)
+    def _on_state(self, channels, channel_members):
+        self.sidebar.apply_state(channels, channel_members)
+
+    @pyqtSlot(str, str)
+    def _on_presence_moved(self, username, channel):
+        self.sidebar.move_user(username, channel)
+
+    @pyqtSlot(str)
+    def _on_presence_offline(self, username):
+        self.sidebar.remove_user(username)
+
     @pyqtSlot()
     def _on_disconnected(self):
         self.chat_panel.add_error_message("Потеряно соединение с сервером")
@@ -296,6 +357,10 @@ class MainWindow(QMainWindow):
     def _on_voice_disconnected(self):
         self.chat_panel.add_error_message("Голосовое соединение потеряно")
 
+    @pyqtSlot(str)
+    def _on_voice_transport(self, transport):
+        self.chat_panel.add_system_message(f"Голосовой канал: {transport.upper()}")
+
     # ==================== SIDEBAR HANDLERS ====================
 
     def _on_channel_selected(self, channel_name):
@@ -363,8 +428,7 @@ class MainWindow(QMainWindow):
 
     def _on_send_message(self, text):
         if text.startswith("/ping"):
-            self.ping_time = time.time()
-            self.text_client.send_ping()
+            self._send_ping(typed=True)
         else:
             self.text_client.send_message(text)
             self.chat_panel.add_own_message(self.username, text)
@@ -391,7 +455,7 @@ class MainWindow(QMainWindow):
     def _on_settings(self):
         dialog = SettingsDialog(self.audio_engine, self)
         if dialog.exec_() == QDialog.Accepted:
-            self._restart_output = True
+            self.audio_output.restart()
             self.chat_panel.add_system_message("Настройки аудио применены")
 
     def _on_ptt_press(self):
@@ -435,12 +499,9 @@ class MainWindow(QMainWindow):
         self.text_client.stop()
         self.voice_client.stop()
 
-        if self.output_stream:
-            try:
-                self.output_stream.stop_stream()
-                self.output_stream.close()
-            except Exception:
-                pass
+        self.speaking_timer.stop()
+        self.link_timer.stop()
+        self.audio_output.stop()
 
         self.audio_engine.terminate()
         event.accept()
@@ -25,6 +25,7 @@ class Sidebar(QWidget):
         self.setStyleSheet(f"background-color: {BG_SIDEBAR};")
         self.channels = {}  # {name: ChannelItemWidget}
         self.channel_users = {}  # {channel_name: [UserItemWidget]}
+        self.user_channels = {}  # {username: channel_name}, survives channel list rebuilds
         self.current_channel = None
         self.my_username = ""
         self.speaking_users = set()
@@ -121,6 +122,9 @@ class Sidebar(QWidget):
         for name in channel_names:
             self._add_channel_widget(name)
 
+        for username, channel_name in self.user_channels.items():
+            self._add_user_widget(channel_name, username)
+
     def _add_channel_widget(self, name):
         is_active = (name == self.current_channel)
         ch_widget = ChannelItemWidget(name, is_active=is_active)
@@ -135,29 +139,59 @@ class Sidebar(QWidget):
     def update_channel_users(self, channel_name, usernames):
         """Update user list under a channel."""
         # Remove old user widgets for this channel
-        if channel_name in self.channel_users:
-            for uw in self.channel_users[channel_name]:
-                uw.deleteLater()
+        for uw in self.channel_users.get(channel_name, []):
+            self.user_channels.pop(uw.username, None)
+            self._remove_user_widget(uw)
+        if channel_name in self.channels:
             self.channel_users[channel_name] = []
-
+            self.channels[channel_name].set_user_count(0)
+
+        for username in usernames:
+            self.move_user(username, channel_name)
+
+    def apply_state(self, channel_names, channel_members):
+        """Rebuild channels and their members from a STATE snapshot in one pass."""
+        self.setUpdatesEnabled(False)
+        self.user_channels = {u: ch for ch, users in channel_members.items() for u in users}
+        self.update_channels(channel_names)
+        self.setUpdatesEnabled(True)
+
+    def move_user(self, username, channel_name):
+        """Apply a presence delta: username is now in channel_name (None/"" = none)."""
+        old = self.user_channels.pop(username, None)
+        if old is not None:
+            for uw in self.channel_users.get(old, []):
+                if uw.username == username:
+                    self.channel_users[old].remove(uw)
+                    self._remove_user_widget(uw)
+                    self.channels[old].set_user_count(len(self.channel_users[old]))
+                    break
+        if channel_name:
+            self.user_channels[username] = channel_name
+            self._add_user_widget(channel_name, username)
+
+    def remove_user(self, username):
+        """User went offline."""
+        self.move_user(username, None)
+
+    def _add_user_widget(self, channel_name, username):
         if channel_name not in self.channels:
             return
-
-        # Find channel widget index
         ch_widget = self.channels[channel_name]
+        users = self.channel_users[channel_name]
+        uw = UserItemWidget(username, is_self=(username == self.my_username))
+        uw.right_clicked.connect(self._on_user_right_click)
+        if username in self.speaking_users:
+            uw.set_speaking(True)
+        # User widgets follow their channel widget
         idx = self.channel_layout.indexOf(ch_widget)
+        self.channel_layout.insertWidget(idx + 1 + len(users), uw)
+        users.append(uw)
+        ch_widget.set_user_count(len(users))
 
-        # Update user count
-        ch_widget.set_user_count(len(usernames))
-
-        # Add user widgets after channel widget
-        for i, username in enumerate(usernames):
-            uw = UserItemWidget(username, is_self=(username == self.my_username))
-            uw.right_clicked.connect(self._on_user_right_click)
-            if username in self.speaking_users:
-                uw.set_speaking(True)
-            self.channel_layout.insertWidget(idx + 1 + i, uw)
-            self.channel_users[channel_name].append(uw)
+    def _remove_user_widget(self, uw):
+        self.channel_layout.removeWidget(uw)
+        uw.deleteLater()
 
     def set_active_channel(self, channel_name):
         """Highlight the active channel."""
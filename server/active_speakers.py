@@ -0,0 +1,71 @@
+import threading
+from server.config import FORWARD_LOUDEST, FORWARD_SWITCH_DB, FORWARD_HOLD, FORWARD_IDLE
+from server.protocol import AUDIO_LEVEL_SILENT
+
+# Weight of the newest frame in a sender's smoothed loudness
+SMOOTHING = 0.3
+# Forget the loudness of a sender that has been quiet this long (s)
+FORGET_AFTER = 10 * FORWARD_IDLE
+
+
+class ActiveSpeakers:
+    """Top-N loudest sender selection for one channel, with hysteresis.
+
+    broadcast_voice asks admit() about every frame that carries an audio
+    level; only senders holding one of the size slots are relayed. Loudness
+    is dB above silence, smoothed per sender. Free slots go to whoever
+    speaks; a full set only changes when a newcomer is FORWARD_SWITCH_DB
+    louder than the quietest holder and that holder has had its slot for
+    FORWARD_HOLD, so near-equal speakers don't flap.
+    """
+
+    def __init__(self, size=FORWARD_LOUDEST):
+        self.size = size
+        self.lock = threading.Lock()
+        self.senders = {}  # {sender sock: [smoothed loudness, last frame time]}
+        self.active = {}   # {sender sock: time the slot was taken}
+        self.forwarded = 0
+        self.suppressed = 0
+
+    def admit(self, sender, level, now):
+        """Record a frame at level from sender; True if it should be relayed."""
+        loudness = AUDIO_LEVEL_SILENT - level
+        with self.lock:
+            entry = self.senders.get(sender)
+            if entry is None:
+                entry = self.senders[sender] = [loudness, now]
+            else:
+                entry[0] += SMOOTHING * (loudness - entry[0])
+                entry[1] = now
+            if sender in self.active:
+                self.forwarded += 1
+                return True
+
+            self._expire(now)
+            if len(self.active) >= self.size:
+                quietest = min(self.active, key=lambda s: self.senders[s][0])
+                if (entry[0] < self.senders[quietest][0] + FORWARD_SWITCH_DB
+                        or now - self.active[quietest] < FORWARD_HOLD):
+                    self.suppressed += 1
+                    return False
+                del self.active[quietest]
+            self.active[sender] = now
+            self.forwarded += 1
+            return True
+
+    def holds(self, sender):
+        """True if sender has a slot (without counting a frame from it)."""
+        with self.lock:
+            return sender in self.active
+
+    def _expire(self, now):
+        """Free slots of senders gone idle; forget long-quiet senders (lock held)."""
+        for sock in [s for s in self.active if now - self.senders[s][1] > FORWARD_IDLE]:
+            del self.active[sock]
+        for sock in [s for s, (_, seen) in self.senders.items() if now - seen > FORGET_AFTER]:
+            del self.senders[sock]
+
+    def stats(self):
+        """{forwarded, suppressed} frame counts."""
+        with self.lock:
+            return {"forwarded": self.forwarded, "suppressed": self.suppressed}
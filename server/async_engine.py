@@ -0,0 +1,288 @@
+"""
+Single event loop server engine built on asyncio.
+
+Speaks exactly the same wire protocol as the threaded engine and reuses its
+per-line handlers: every connection is wrapped in a socket-like object whose
+send() writes into the asyncio transport, so broadcast helpers and
+ServerState work unchanged. Text connections use streams; voice connections
+are a BufferedProtocol receiving straight into a VoiceFrameBuffer.
+"""
+
+import asyncio
+import socket
+import threading
+from server.config import (
+    BIND_ADDRESS, TEXT_PORT, VOICE_PORT, MAX_WRITE_BUFFER, VOICE_UDP_ENABLED,
+)
+from server.protocol import MAX_LINE_LENGTH
+from server.text_handler import (
+    process_auth_line, process_text_line, client_logged_in, client_logged_out,
+)
+from server.voice_handler import (
+    VoiceFrameBuffer, broadcast_voice, handle_voice_datagram, register_voice_client,
+    send_queued_item, voice_client_closed,
+)
+from server.text_queue import TextSendQueue
+from server.voice_queue import VoiceSendQueue
+
+
+class StreamConnection:
+    """Socket-like facade over an asyncio StreamWriter."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, data):
+        """Queue data on the transport. Never blocks the event loop."""
+        if self.writer.is_closing():
+            raise ConnectionError("connection closed")
+        # A peer that stopped reading would otherwise grow the buffer forever
+        if self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            raise ConnectionError("write buffer overflow")
+        self.writer.write(data)
+        return len(data)
+
+    sendall = send
+
+    def close(self):
+        self.writer.close()
+
+
+async def _read_line(reader):
+    """Read one stripped protocol line. Returns None on EOF or error.
+
+    StreamReader already frames on bytes; the limit and the lenient decoding
+    match LineReader in the threaded engine.
+    """
+    try:
+        raw = await reader.readline()
+    except (ConnectionError, ValueError, asyncio.LimitOverrunError):
+        return None
+    if not raw.endswith(b"\n"):
+        return None
+    return raw.decode('utf-8', 'replace').strip()
+
+
+async def handle_text_stream(reader, writer, state, auth_mgr, channel_mgr):
+    """Text connection coroutine: auth phase, then the command loop."""
+    client = StreamConnection(writer)
+    print(f"Новое подключение от {writer.get_extra_info('peername')}")
+
+    username = None
+    try:
+        while username is None:
+            line = await _read_line(reader)
+            if line is None:
+                client.close()
+                return
+            if line:
+                username = process_auth_line(client, line, auth_mgr, state)
+            await writer.drain()
+    except Exception:
+        client.close()
+        return
+
+    queue = TextSendQueue()
+    client_logged_in(client, username, queue, state, channel_mgr)
+    queue.notify = text_queue_notifier(client, queue)
+    flush_text_queue(client, queue)
+    try:
+        while True:
+            line = await _read_line(reader)
+            if line is None:
+                break
+            if line:
+                process_text_line(client, username, line, state, channel_mgr)
+            await writer.drain()
+    except Exception:
+        pass
+
+    client_logged_out(client, username, state)
+
+
+def text_queue_notifier(client, queue):
+    """notify callback for a text connection's TextSendQueue.
+
+    Writes never block here, so on the loop the queue is flushed at once,
+    which keeps the writer.drain() backpressure on whoever caused the
+    deltas; from another thread the flush is handed to the loop.
+    """
+    loop = asyncio.get_running_loop()
+    loop_thread = threading.get_ident()
+
+    def notify():
+        if threading.get_ident() == loop_thread:
+            flush_text_queue(client, queue)
+        else:
+            loop.call_soon_threadsafe(flush_text_queue, client, queue)
+    return notify
+
+
+def flush_text_queue(client, queue):
+    """Write out everything queued for one text connection."""
+    data = queue.pop_all()
+    if data:
+        try:
+            client.send(data)
+        except Exception:
+            pass
+
+
+class VoiceStreamProtocol(asyncio.BufferedProtocol):
+    """Voice TCP connection: the transport receives straight into a VoiceFrameBuffer.
+
+    The protocol object is also the socket-like connection registered in
+    ServerState (send/sendall/close), like StreamConnection for text.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.transport = None
+        self.frames = VoiceFrameBuffer()
+        self.nick_buf = bytearray(1024)
+        self.queue = None
+        self.wakeup = asyncio.Event()
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.writer_task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def get_buffer(self, sizehint):
+        if self.queue is None:
+            return self.nick_buf  # First read is the nickname, as in the threaded engine
+        return self.frames.writable()
+
+    def buffer_updated(self, nbytes):
+        if self.queue is None:
+            self._register(bytes(self.nick_buf[:nbytes]).decode('utf-8', 'replace').strip())
+            return
+        self.frames.filled(nbytes)
+        while True:
+            try:
+                frame = self.frames.next_frame()
+            except ValueError:
+                self.transport.close()
+                return
+            if frame is None:
+                return
+            broadcast_voice(frame, self, self.state)
+
+    def _register(self, nick_data):
+        loop = asyncio.get_running_loop()
+        self.queue = VoiceSendQueue()
+        self.queue.notify = lambda: loop.call_soon_threadsafe(self.wakeup.set)
+        nick_data = register_voice_client(self, nick_data, self.queue, self.state)
+        self.writer_task = loop.create_task(drain_voice_queue(self, self.queue, self.wakeup, self.state))
+        print(f"Голосовое подключение от {self.transport.get_extra_info('peername')} ({nick_data})")
+
+    def connection_lost(self, exc):
+        if self.queue is not None:
+            voice_client_closed(self, self.state)
+            self.writer_task.cancel()
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def drain(self):
+        """Wait until the transport's write buffer is below its high-water mark."""
+        await self.can_write.wait()
+
+    def send(self, data):
+        """Queue data on the transport. Never blocks the event loop."""
+        if self.transport.is_closing():
+            raise ConnectionError("connection closed")
+        if self.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            raise ConnectionError("write buffer overflow")
+        self.transport.write(data)
+        return len(data)
+
+    sendall = send
+
+    def close(self):
+        self.transport.close()
+
+
+async def drain_voice_queue(voice_client, queue, wakeup, state):
+    """Writer task for one voice connection.
+
+    While drain() waits on a slow peer, frames keep aging in the queue and
+    stale ones are dropped instead of piling up in the transport buffer.
+    """
+    while not queue.closed:
+        wakeup.clear()
+        while True:
+            item = queue.pop()
+            if item is None:
+                break
+            data, udp_addr = item
+            try:
+                send_queued_item(voice_client, data, udp_addr, state)
+            except Exception:
+                continue
+            queue.mark_sent()
+        try:
+            await voice_client.drain()
+        except Exception:
+            return
+        await wakeup.wait()
+
+
+class VoiceDatagramProtocol(asyncio.DatagramProtocol):
+    """UDP voice endpoint. The transport's sendto() matches socket.sendto()."""
+
+    def __init__(self, state):
+        self.state = state
+
+    def connection_made(self, transport):
+        self.state.udp_sock = transport
+
+    def datagram_received(self, data, addr):
+        handle_voice_datagram(data, addr, self.state)
+
+    def error_received(self, exc):
+        pass
+
+
+async def start_servers(state, auth_mgr, channel_mgr,
+                        bind=BIND_ADDRESS, text_port=TEXT_PORT, voice_port=VOICE_PORT):
+    """Open both listeners (and the UDP voice endpoint) on the running loop.
+
+    Returns (text_server, voice_server).
+    """
+    text_server = await asyncio.start_server(
+        lambda r, w: handle_text_stream(r, w, state, auth_mgr, channel_mgr),
+        bind, text_port, reuse_address=True, limit=MAX_LINE_LENGTH + 1
+    )
+    voice_server = await asyncio.get_running_loop().create_server(
+        lambda: VoiceStreamProtocol(state),
+        bind, voice_port, reuse_address=True
+    )
+    if VOICE_UDP_ENABLED:
+        await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: VoiceDatagramProtocol(state),
+            local_addr=(bind, voice_server.sockets[0].getsockname()[1])
+        )
+    return text_server, voice_server
+
+
+async def serve(state, auth_mgr, channel_mgr,
+                bind=BIND_ADDRESS, text_port=TEXT_PORT, voice_port=VOICE_PORT):
+    """Run both listeners until cancelled."""
+    text_server, voice_server = await start_servers(
+        state, auth_mgr, channel_mgr, bind, text_port, voice_port
+    )
+    async with text_server, voice_server:
+        await asyncio.gather(text_server.serve_forever(), voice_server.serve_forever())
+
+
+def run_async_server(state, auth_mgr, channel_mgr):
+    """Blocking entry point used by server/main.py."""
+    asyncio.run(serve(state, auth_mgr, channel_mgr))
@@ -57,6 +57,11 @@ class ChannelManager:
         with self.lock:
             return [ch["name"] for ch in self.channels]
 
+    def get_mixing_channels(self):
+        """Names of channels configured for server-side mixing."""
+        with self.lock:
+            return [ch["name"] for ch in self.channels if ch.get("mixing")]
+
     def channel_exists(self, name):
         with self.lock:
             return any(ch["name"] == name for ch in self.channels)
@@ -4,11 +4,55 @@ TEXT_PORT = 5557
 VOICE_PORT = 5556
 BIND_ADDRESS = '0.0.0.0'
 
+# "threaded" (one thread per socket) or "asyncio" (single event loop)
+SERVER_ENGINE = 'threaded'
+
 DATA_DIR = os.path.dirname(os.path.abspath(__file__))
 USERS_FILE = os.path.join(DATA_DIR, '..', 'users.json')
 CHANNELS_FILE = os.path.join(DATA_DIR, '..', 'channels.json')
 
 MAX_VOICE_FRAME = 65536
+
+# Per-recipient outbound voice queue: capacity in packets (50 = 1 s of single
+# 20 ms frames) and the age after which a queued frame is stale and dropped (s)
+VOICE_QUEUE_FRAMES = 50
+VOICE_MAX_AGE = 0.2
+# Every this many seconds, log the voice connections whose queues dropped
+# frames since the last report (0 turns the report off)
+VOICE_STATS_INTERVAL = 10.0
+# Per-client outbound text queue (bytes); past it the oldest lines are
+# dropped. The threaded engine stops reading a client's commands while its
+# own queue holds more than half of it.
+TEXT_QUEUE_BYTES = 1024 * 1024
+# Frame durations (ms) a client may negotiate in its voice handshake, and the
+# longest packet it may bundle frames into (duration x frames per packet, ms)
+VOICE_FRAME_DURATIONS = (10, 20, 40, 60)
+VOICE_MAX_PACKET_MS = 120
+
+# Optional UDP voice transport on VOICE_PORT (TCP stays as fallback)
+VOICE_UDP_ENABLED = True
+# A UDP peer that has not sent anything for this long falls back to TCP
+UDP_PEER_TIMEOUT = 15.0
+# Active-speaker forwarding: per channel, only the FORWARD_LOUDEST loudest
+# senders (by the audio level byte in their voice frames) are relayed; 0
+# relays everyone. A newcomer takes the quietest forwarded sender's slot only
+# when FORWARD_SWITCH_DB louder and after that sender held it FORWARD_HOLD
+# seconds; a sender that sends nothing for FORWARD_IDLE seconds frees its slot.
+FORWARD_LOUDEST = 3
+FORWARD_SWITCH_DB = 6
+FORWARD_HOLD = 0.5
+FORWARD_IDLE = 0.3
+
+# Server-side mixing (MCU) for channels marked "mixing": true in
+# channels.json: senders are decoded, each listener gets one mix of everyone
+# else every MIX_FRAME_MS, re-encoded. Opus senders need opuslib on the
+# server; without it (or without audioop) those channels are relayed as usual.
+MIX_SAMPLE_RATE = 48000
+MIX_FRAME_MS = 20
+MIX_BITRATE = 64000
+MIX_JITTER_FRAMES = 3  # per-sender backlog kept between mixing ticks
+# Per-connection outbound buffer limit for the asyncio engine (bytes)
+MAX_WRITE_BUFFER = 1024 * 1024
 MAX_USERNAME_LEN = 32
 MIN_USERNAME_LEN = 2
 MIN_PASSWORD_LEN = 4
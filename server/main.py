@@ -1,3 +1,4 @@
+import argparse
 import socket
 import threading
 import sys
@@ -6,12 +7,14 @@ import os
 # Add project root to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from server.config import TEXT_PORT, VOICE_PORT, BIND_ADDRESS
+from server.config import TEXT_PORT, VOICE_PORT, BIND_ADDRESS, SERVER_ENGINE, VOICE_UDP_ENABLED
 from server.state import ServerState
 from server.auth import AuthManager
 from server.channels import ChannelManager
 from server.text_handler import accept_text_clients
-from server.voice_handler import accept_voice_clients
+from server.voice_handler import accept_voice_clients, serve_voice_udp, start_voice_queue_reports
+from server.async_engine import run_async_server
+from server.mixer import start_mixers
 
 
 def get_local_ip():
@@ -35,33 +38,33 @@ def get_local_ip():
             return "не удалось определить"
 
 
-def main():
-    state = ServerState()
-    auth_mgr = AuthManager()
-    channel_mgr = ChannelManager()
-
-    text_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    text_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    text_server.bind((BIND_ADDRESS, TEXT_PORT))
-    text_server.listen()
-
-    voice_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    voice_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    voice_server.bind((BIND_ADDRESS, VOICE_PORT))
-    voice_server.listen()
-
+def print_banner(engine, auth_mgr, channel_mgr):
     local_ip = get_local_ip()
     print("=" * 50)
     print("  HYBRID Server v2.0")
     print("=" * 50)
     print(f"  Текстовый сервер: порт {TEXT_PORT}")
-    print(f"  Голосовой сервер: порт {VOICE_PORT}")
+    print(f"  Голосовой сервер: порт {VOICE_PORT}" + (" (TCP + UDP)" if VOICE_UDP_ENABLED else ""))
     print(f"  Локальный IP: {local_ip}")
+    print(f"  Движок: {engine}")
     print(f"  Каналы: {', '.join(channel_mgr.get_channel_names())}")
     print(f"  Зарегистрировано пользователей: {len(auth_mgr.users)}")
     print("=" * 50)
     print("Ожидание подключений...\n")
 
+
+def run_threaded_server(state, auth_mgr, channel_mgr):
+    """One accept thread per port, one handler thread per connection."""
+    text_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    text_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    text_server.bind((BIND_ADDRESS, TEXT_PORT))
+    text_server.listen()
+
+    voice_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    voice_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    voice_server.bind((BIND_ADDRESS, VOICE_PORT))
+    voice_server.listen()
+
     text_thread = threading.Thread(
         target=accept_text_clients,
         args=(text_server, state, auth_mgr, channel_mgr),
@@ -76,8 +79,33 @@ def main():
     text_thread.start()
     voice_thread.start()
 
+    if VOICE_UDP_ENABLED:
+        udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_server.bind((BIND_ADDRESS, VOICE_PORT))
+        threading.Thread(target=serve_voice_udp, args=(udp_server, state), daemon=True).start()
+
+    text_thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HYBRID VoiceChat server")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default=SERVER_ENGINE,
+                        help="connection handling engine")
+    args = parser.parse_args()
+
+    state = ServerState()
+    auth_mgr = AuthManager()
+    channel_mgr = ChannelManager()
+
+    print_banner(args.engine, auth_mgr, channel_mgr)
+    start_mixers(state, channel_mgr)
+    start_voice_queue_reports(state)
+
     try:
-        text_thread.join()
+        if args.engine == "asyncio":
+            run_async_server(state, auth_mgr, channel_mgr)
+        else:
+            run_threaded_server(state, auth_mgr, channel_mgr)
     except KeyboardInterrupt:
         print("\nСервер остановлен.")
 
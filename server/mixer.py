@@ -0,0 +1,300 @@
+import collections
+import threading
+import time
+import warnings
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:  # removed from the standard library in Python 3.13
+    audioop = None
+
+try:
+    import opuslib
+    OPUS_AVAILABLE = True
+except Exception:
+    OPUS_AVAILABLE = False
+
+from server.config import (
+    MIX_SAMPLE_RATE, MIX_FRAME_MS, MIX_BITRATE, MIX_JITTER_FRAMES, UDP_PEER_TIMEOUT,
+)
+from server.protocol import (
+    CODEC_RAW, CODEC_OPUS, CODEC_OPUS_BUNDLE, CODEC_SPURT_END, UDP_VOICE, SPEAKER_ID, AUDIO_HEADER,
+    MIX_SPEAKER_ID, MIX_NICKNAME, build_udp_datagram, timestamp_ms, unpack_bundle,
+)
+from server.voice_handler import FRAME_HEADER, audio_offset
+
+MIXING_AVAILABLE = audioop is not None and OPUS_AVAILABLE
+
+FRAME_SAMPLES = MIX_SAMPLE_RATE * MIX_FRAME_MS // 1000
+FRAME_BYTES = FRAME_SAMPLES * 2
+# Longest Opus packet (120 ms): senders may use any negotiated framing
+MAX_PACKET_SAMPLES = MIX_SAMPLE_RATE * 120 // 1000
+# Mix 8 bits below full scale in 32-bit samples: 256 speakers can't wrap
+HEADROOM = 256
+# Payload prefix naming the mix, by listener format: legacy, compact
+MIX_TAGS = (
+    SPEAKER_ID.pack(len(MIX_NICKNAME.encode('utf-8'))) + MIX_NICKNAME.encode('utf-8'),
+    SPEAKER_ID.pack(MIX_SPEAKER_ID),
+)
+
+
+def split_payload(payload, compact):
+    """(codec, audio bytes) from a legacy or compact voice payload, or None if malformed."""
+    offset = audio_offset(payload, compact)
+    if offset is None:
+        return None
+    codec, length = AUDIO_HEADER.unpack_from(payload, offset)
+    offset += AUDIO_HEADER.size
+    return codec, bytes(payload[offset:offset + length])
+
+
+def widen(pcm):
+    """16-bit PCM -> 32-bit samples scaled down by HEADROOM, ready to add."""
+    return audioop.mul(audioop.lin2lin(pcm, 2, 4), 4, 1 / HEADROOM)
+
+
+def narrow(mix):
+    """Inverse of widen, clipping to the 16-bit range."""
+    return audioop.lin2lin(audioop.mul(mix, 4, HEADROOM), 4, 2)
+
+
+class ChannelMixer:
+    """Server-side mixer (MCU) for one channel.
+
+    broadcast_voice hands every frame sent in the channel to push() instead
+    of relaying it. tick(), run every MIX_FRAME_MS by the mixing thread,
+    takes one frame per active sender, decodes it and sends each listener a
+    single encoded stream from MIX_SPEAKER_ID: the mix of everyone but
+    themselves. Listeners who aren't speaking all get the same full mix,
+    encoded once.
+
+    Senders may use any frame duration and bundle several frames per packet
+    (CODEC_OPUS_BUNDLE); packets are decoded as needed and their PCM is cut
+    into MIX_FRAME_MS frames, the remainder carried to the next tick.
+
+    Senders' talk spurt ends aren't mixed; once one has come in and the mix
+    goes quiet, listeners get a spurt end from MIX_SPEAKER_ID.
+    """
+
+    def __init__(self, channel, state):
+        self.channel = channel
+        self.state = state
+        self.lock = threading.Lock()
+        self.pending = {}   # {sender sock: deque of (codec, audio), one packet each}
+        self.carry = {}     # {sender sock: decoded PCM short of a frame, or left over}
+        self.decoders = {}  # {sender sock: opuslib.Decoder}
+        self.encoders = {}  # {listener sock, or None for the shared mix: opuslib.Encoder}
+        self.seq = 0
+        self.sounding = False  # the last tick sent a mix
+        self.ending = False    # a sender ended its talk spurt since
+        self.ticks = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def push(self, sender_sock, payload, compact):
+        """Accept one voice payload (in the sender's format) for the next tick."""
+        parsed = split_payload(payload, compact)
+        if parsed is None:
+            return
+        if parsed[0] == CODEC_SPURT_END:
+            self.ending = True
+            return
+        if parsed[0] == CODEC_OPUS_BUNDLE:
+            packets = unpack_bundle(parsed[1])
+            if not packets:
+                return
+            items = [(CODEC_OPUS, packet) for packet in packets]
+        else:
+            items = [parsed]
+        backlog = MIX_JITTER_FRAMES * len(items)
+        with self.lock:
+            frames = self.pending.get(sender_sock)
+            if frames is None or frames.maxlen < backlog:
+                frames = self.pending[sender_sock] = collections.deque(frames or (), maxlen=backlog)
+            frames.extend(items)
+            self.frames_in += len(items)
+
+    def _decode(self, sock, codec, audio):
+        if codec == CODEC_RAW:
+            return audio
+        if codec == CODEC_OPUS and OPUS_AVAILABLE:
+            decoder = self.decoders.get(sock)
+            if decoder is None:
+                decoder = self.decoders[sock] = opuslib.Decoder(MIX_SAMPLE_RATE, 1)
+            try:
+                return decoder.decode(audio, MAX_PACKET_SAMPLES)
+            except Exception:
+                return None
+        return None
+
+    def _encode(self, key, pcm):
+        """(codec, audio) for one listener's mix, or the shared one (key None)."""
+        if not OPUS_AVAILABLE:
+            return CODEC_RAW, pcm
+        encoder = self.encoders.get(key)
+        if encoder is None:
+            encoder = self.encoders[key] = opuslib.Encoder(MIX_SAMPLE_RATE, 1, opuslib.APPLICATION_VOIP)
+            encoder.bitrate = MIX_BITRATE
+        return CODEC_OPUS, encoder.encode(pcm, FRAME_SAMPLES)
+
+    def tick(self):
+        """Mix and queue one frame interval for every listener in the channel."""
+        started = time.thread_time()
+        with self.lock:
+            senders = list(self.pending)
+
+        roster = self.state.get_voice_roster(self.channel)
+        members = {sock for sock, _ in roster}
+        mix = None
+        own = {}  # {speaker sock: its widened frame}
+        for sock in set(senders).union(self.carry):
+            if sock not in members:
+                continue
+            pcm = self._next_frame(sock)
+            if pcm is None:
+                continue
+            own[sock] = wide = widen(pcm)
+            mix = wide if mix is None else audioop.add(mix, wide, 4)
+        if mix is not None:
+            self._send(roster, mix, own)
+        elif self.sounding and self.ending:
+            self._send_end(roster)
+            self.ending = False
+        self.sounding = mix is not None
+
+        # Codec state of members who left
+        for table in (self.decoders, self.encoders, self.carry):
+            for sock in [s for s in table if s is not None and s not in members]:
+                del table[sock]
+        self.ticks += 1
+        self.cpu_time += time.thread_time() - started
+
+    def _pop(self, sock):
+        """sock's oldest pending packet, or None."""
+        with self.lock:
+            pending = self.pending.get(sock)
+            if not pending:
+                return None
+            item = pending.popleft()
+            if not pending:
+                del self.pending[sock]
+            return item
+
+    def _next_frame(self, sock):
+        """One FRAME_BYTES of sock's audio, decoding packets as needed, or
+        None if not that much has arrived (what there is waits in carry)."""
+        pcm = self.carry.pop(sock, b'')
+        while len(pcm) < FRAME_BYTES:
+            item = self._pop(sock)
+            if item is None:
+                if pcm:
+                    self.carry[sock] = pcm
+                return None
+            decoded = self._decode(sock, *item)
+            if decoded:
+                pcm += decoded
+        if len(pcm) > FRAME_BYTES:
+            self.carry[sock] = pcm[FRAME_BYTES:]
+        return pcm[:FRAME_BYTES]
+
+    def _send(self, roster, mix, own):
+        seq = self.seq
+        self.seq = (seq + 1) & 0xFFFF
+        udp_header = build_udp_datagram(UDP_VOICE, seq, timestamp_ms())
+        shared_audio = None
+        shared = [None, None, None, None]  # full-mix frames, by 2 * compact + udp
+        now = time.monotonic()
+        for sock, info in roster:
+            udp = (info["udp_addr"] is not None and self.state.udp_sock is not None
+                   and now - info["udp_seen"] < UDP_PEER_TIMEOUT)
+            if sock in own:
+                if len(own) == 1:
+                    continue  # Only speaker: nothing to hear
+                pcm = narrow(audioop.add(mix, audioop.mul(own[sock], 4, -1), 4))
+                data = self._frame(self._encode(sock, pcm), info["compact"], udp, udp_header)
+            else:
+                key = 2 * info["compact"] + udp
+                data = shared[key]
+                if data is None:
+                    if shared_audio is None:
+                        shared_audio = self._encode(None, narrow(mix))
+                    data = shared[key] = self._frame(shared_audio, info["compact"], udp, udp_header)
+            if udp:
+                info["queue"].put(data, info["udp_addr"])
+            else:
+                info["queue"].put(data)
+            self.frames_out += 1
+            self.bytes_out += len(data)
+
+    def _send_end(self, roster):
+        """Send every listener a talk spurt end from the mix."""
+        seq = self.seq
+        self.seq = (seq + 1) & 0xFFFF
+        udp_header = build_udp_datagram(UDP_VOICE, seq, timestamp_ms())
+        forms = [None, None, None, None]  # by 2 * compact + udp
+        now = time.monotonic()
+        for sock, info in roster:
+            udp = (info["udp_addr"] is not None and self.state.udp_sock is not None
+                   and now - info["udp_seen"] < UDP_PEER_TIMEOUT)
+            key = 2 * info["compact"] + udp
+            data = forms[key]
+            if data is None:
+                data = forms[key] = self._frame((CODEC_SPURT_END, b''), info["compact"], udp, udp_header)
+            if udp:
+                info["queue"].put(data, info["udp_addr"])
+            else:
+                info["queue"].put(data)
+
+    @staticmethod
+    def _frame(encoded, compact, udp, udp_header):
+        codec, audio = encoded
+        body = MIX_TAGS[compact] + AUDIO_HEADER.pack(codec, len(audio)) + audio
+        if udp:
+            return udp_header + body
+        return FRAME_HEADER.pack(len(body)) + body
+
+    def stats(self):
+        """{ticks, frames_in, frames_out, bytes_out, cpu_time}"""
+        with self.lock:
+            return {
+                "ticks": self.ticks, "frames_in": self.frames_in,
+                "frames_out": self.frames_out, "bytes_out": self.bytes_out,
+                "cpu_time": self.cpu_time,
+            }
+
+
+def run_mixers(state):
+    """Mixing thread: every MIX_FRAME_MS, tick each mixed channel."""
+    interval = MIX_FRAME_MS / 1000
+    next_tick = time.monotonic()
+    while True:
+        for mixer in list(state.mixers.values()):
+            try:
+                mixer.tick()
+            except Exception as e:
+                print(f"Ошибка микширования в канале {mixer.channel}: {e}")
+        next_tick += interval
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_tick = time.monotonic()  # Fell behind: don't burst to catch up
+
+
+def start_mixers(state, channel_mgr):
+    """Create mixers for the channels configured for mixing and start the mixing thread."""
+    names = channel_mgr.get_mixing_channels()
+    if not names:
+        return
+    if not MIXING_AVAILABLE:
+        missing = "audioop" if audioop is None else "opuslib"
+        print(f"Микширование недоступно (нет {missing}), каналы {', '.join(names)} работают без него")
+        return
+    for name in names:
+        state.mixers[name] = ChannelMixer(name, state)
+    threading.Thread(target=run_mixers, args=(state,), daemon=True).start()
+    print(f"Микширование на сервере: {', '.join(names)}")
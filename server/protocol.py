@@ -1,5 +1,9 @@
 # Protocol v2 constants and helpers (server-side)
 
+import collections
+import struct
+import time
+
 # Ports
 TEXT_PORT = 5557
 VOICE_PORT = 5556
@@ -37,13 +41,120 @@ RESP_PONG = "PONG"
 EVT_USERLIST = "USERLIST"
 EVT_SYSTEM = "SYSTEM"
 
+# Session state and presence (server -> client), versioned by a global
+# sequence number. STATE is the whole bootstrap, sent in the same write as
+# AUTH_OK; PRESENCE deltas follow:
+#   STATE:<seq>:<json {"channels": [...], "online": [...], "members": {name: [users]},
+#                      "voice": {user: speaker id}}>
+#   PRESENCE:<seq>:ONLINE:<user> | OFFLINE:<user> | MOVE:<user>:<channel or empty>
+#                 | VOICE:<user>:<speaker id, or empty when the voice session ends>
+# A client that sees a sequence gap sends PRESENCE_RESYNC for a new STATE.
+EVT_STATE = "STATE"
+EVT_PRESENCE = "PRESENCE"
+CMD_PRESENCE_RESYNC = "PRESENCE_RESYNC"
+PRESENCE_ONLINE = "ONLINE"
+PRESENCE_OFFLINE = "OFFLINE"
+PRESENCE_MOVE = "MOVE"
+PRESENCE_VOICE = "VOICE"
+
+# UDP voice negotiation (over the text socket, after login)
+CMD_VOICE_UDP = "VOICE_UDP"          # client -> server: request a token
+RESP_VOICE_UDP = "VOICE_UDP"         # server -> client: VOICE_UDP:<token>
+RESP_VOICE_UDP_FAIL = "VOICE_UDP_FAIL"
+
+# Receiver reports (RTCP style), every few seconds for each sender heard over
+# UDP; the server relays one only between members of the same channel:
+#   client -> server  VOICE_REPORT:<loss %>:<jitter ms>:<sender>
+#   server -> sender  VOICE_REPORT:<loss %>:<jitter ms>:<reporter>
+CMD_VOICE_REPORT = "VOICE_REPORT"
+
+# Longest text line accepted from a client (bytes, without the newline)
+MAX_LINE_LENGTH = 64 * 1024
+
 # Voice codec IDs
+CODEC_RAW = 0x00  # 16-bit mono PCM, when libopus is unavailable
 CODEC_OPUS = 0x01
+# Several Opus packets in one voice frame: [1B count] then count x
+# [2B BE length][Opus packet], in order (see VOICE_FRAMING_PREFIX)
+CODEC_OPUS_BUNDLE = 0x02
+# End of a talk spurt (RFC 3389 comfort noise style): no audio, sent once
+# when a sender stops sending (push-to-talk released, voice under the gate,
+# Opus DTX). Its level byte, if any, is the sender's background noise, which
+# receivers may play as comfort noise through the pause.
+CODEC_SPURT_END = 0x03
+
+# Voice frame payloads (after the 4-byte length prefix) come in two formats:
+#   legacy   [2B BE nick_len][nick][1B codec][2B BE audio_len][audio]
+#   compact  [2B BE speaker id][1B codec][2B BE audio_len][audio]
+# Every voice session gets a speaker ID, announced in STATE and PRESENCE
+# VOICE. A client that sends VOICE_COMPACT_PREFIX + username as its voice
+# handshake sends and receives compact payloads; others keep the legacy one.
+# A compact sender that doesn't know its own ID yet sends 0.
+VOICE_COMPACT_PREFIX = "V2:"
+SPEAKER_ID = struct.Struct('>H')
+# In a server-mixed channel listeners get one stream from this pseudo-speaker
+MIX_SPEAKER_ID = 0xFFFF
+MIX_NICKNAME = "*mix*"
+# Both formats continue [1B codec][2B BE audio_len][audio] and may end with
+# one audio level byte (RFC 6464 style: -dBov, 0 loudest, 127 silence),
+# which receivers reading audio_len bytes skip. No byte = level unknown.
+AUDIO_HEADER = struct.Struct('>BH')
+AUDIO_LEVEL_SILENT = 127
+# Frame duration and packetization, negotiated in the voice handshake: the
+# client starts it with VOICE_FRAMING_PREFIX + "<frame ms>x<frames per packet>:"
+# (ahead of any V2: prefix), and the server answers, before any voice, with
+# one frame whose payload is VOICE_FRAMING_PREFIX + "<ms>x<frames>": the
+# framing it accepted. The frames per packet granted is a ceiling: a client
+# may send fewer (the end of a talk spurt, or packetization it adapts to the
+# link). Without it a client sends and gets 20 ms frames, one per packet.
+# Packets of several frames carry CODEC_OPUS_BUNDLE audio; listeners that
+# didn't negotiate get them split into single frames.
+VOICE_FRAMING_PREFIX = "FRAMING:"
+DEFAULT_FRAMING = (20, 1)
+BUNDLE_LENGTH = struct.Struct('>H')
+
+# UDP voice datagrams (same port number as the TCP voice socket):
+#   [1B kind][2B BE seq][4B BE timestamp_ms][body]
+# HELLO body is the token from VOICE_UDP; VOICE body is the TCP frame payload
+# (everything after the 4-byte length prefix).
+UDP_HELLO = 0x01
+UDP_HELLO_ACK = 0x02
+UDP_VOICE = 0x03
+UDP_HEADER = struct.Struct('>BHI')
+
+
+def encode_line(message):
+    """Serialize a protocol message to its newline-terminated UTF-8 bytes."""
+    return (message + "\n").encode('utf-8')
+
+
+def send_bytes(sock, data):
+    """Send all of data, continuing after short writes."""
+    sent = sock.send(data)
+    if sent < len(data):
+        view = memoryview(data)[sent:]
+        while view:
+            view = view[sock.send(view):]
 
 
 def send_line(sock, message):
     """Send a newline-delimited UTF-8 message."""
-    sock.send((message + "\n").encode('utf-8'))
+    send_bytes(sock, encode_line(message))
+
+
+def broadcast_line(sockets, message, exclude_sock=None):
+    """Encode message once and send the same buffer to every socket.
+
+    Failing recipients are skipped; their own handler notices the broken
+    connection.
+    """
+    data = encode_line(message)
+    for sock in sockets:
+        if sock is not exclude_sock:
+            try:
+                send_bytes(sock, data)
+            except Exception:
+                pass
 
 
 def parse_command(line):
@@ -55,3 +166,149 @@ def parse_command(line):
         cmd, _, payload = line.partition(':')
         return cmd, payload
     return line, ''
+
+
+class LineTooLong(ValueError):
+    """A peer sent more than max_line bytes without a newline."""
+
+
+class LineReader:
+    """Incremental newline framing on a reusable bytearray.
+
+    Data is received with recv_into straight into the buffer and the last
+    delimiter is found with bytearray.rfind from where the previous search
+    stopped. Everything up to it is decoded in one go and split into lines,
+    so each complete line is decoded once and a UTF-8 character split
+    across reads is never decoded in halves. The buffer starts at bufsize
+    and only grows (up to max_line) for a long line in progress.
+    """
+
+    def __init__(self, sock=None, max_line=MAX_LINE_LENGTH, bufsize=4096):
+        self.sock = sock
+        self.max_line = max_line
+        self.buf = bytearray(min(bufsize, max_line + 1))
+        self.start = 0  # first unconsumed byte
+        self.end = 0    # end of received data
+        self.scan = 0   # no newline in buf[start:scan]
+        self.lines = collections.deque()  # decoded, not yet returned
+
+    def _make_room(self):
+        pending = self.end - self.start
+        size = len(self.buf)
+        if pending * 2 > size and size <= self.max_line:
+            self.buf.extend(bytes(min(size, self.max_line + 1 - size)))
+        elif self.start:
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.scan -= self.start
+            self.start, self.end = 0, pending
+        else:
+            raise LineTooLong(f"line longer than {self.max_line} bytes")
+
+    def next_line(self):
+        """Pop the next complete non-empty line (stripped), or None if there is none yet."""
+        lines = self.lines
+        while True:
+            while lines:
+                line = lines.popleft().strip()
+                if line:
+                    return line
+            nl = self.buf.rfind(b"\n", self.scan, self.end)
+            if nl < 0:
+                self.scan = self.end
+                if self.end - self.start > self.max_line:
+                    raise LineTooLong(f"line longer than {self.max_line} bytes")
+                if self.start == self.end:
+                    self.start = self.end = self.scan = 0
+                return None
+            lines.extend(self.buf[self.start:nl].decode('utf-8', 'replace').split("\n"))
+            self.start = self.scan = nl + 1
+
+    def fill(self):
+        """recv_into the free end of the buffer. Returns the byte count (0 on EOF)."""
+        if self.end == len(self.buf):
+            self._make_room()
+        n = self.sock.recv_into(memoryview(self.buf)[self.end:])
+        self.end += n
+        return n
+
+    def read_line(self):
+        """Next non-empty line, receiving as needed. Returns None on EOF."""
+        while True:
+            line = self.next_line()
+            if line is not None:
+                return line
+            if not self.fill():
+                return None
+
+    def feed(self, data):
+        """Add bytes received elsewhere. Returns the lines they completed."""
+        lines = []
+        view = memoryview(data)
+        while view:
+            if self.end == len(self.buf):
+                self._make_room()
+            n = min(len(view), len(self.buf) - self.end)
+            self.buf[self.end:self.end + n] = view[:n]
+            self.end += n
+            view = view[n:]
+            line = self.next_line()
+            while line is not None:
+                lines.append(line)
+                line = self.next_line()
+        return lines
+
+
+def timestamp_ms():
+    """Wall clock milliseconds, truncated to 32 bits for UDP headers."""
+    return int(time.time() * 1000) & 0xFFFFFFFF
+
+
+def build_udp_datagram(kind, seq, timestamp, body=b''):
+    """Build a UDP voice datagram."""
+    return UDP_HEADER.pack(kind, seq & 0xFFFF, timestamp & 0xFFFFFFFF) + body
+
+
+def parse_udp_datagram(data):
+    """Parse a UDP voice datagram. Returns (kind, seq, timestamp, body) or None."""
+    if len(data) < UDP_HEADER.size:
+        return None
+    kind, seq, timestamp = UDP_HEADER.unpack_from(data)
+    return kind, seq, timestamp, data[UDP_HEADER.size:]
+
+
+def format_framing(frame_ms, frames):
+    """VOICE_FRAMING_PREFIX + "<ms>x<frames>" for the voice handshake."""
+    return f"{VOICE_FRAMING_PREFIX}{frame_ms}x{frames}"
+
+
+def parse_framing(text):
+    """(frame ms, frames per packet) from "FRAMING:<ms>x<frames>", or None."""
+    if not text.startswith(VOICE_FRAMING_PREFIX):
+        return None
+    ms, sep, frames = text[len(VOICE_FRAMING_PREFIX):].partition("x")
+    if not sep or not ms.isdigit() or not frames.isdigit():
+        return None
+    return int(ms), int(frames)
+
+
+def pack_bundle(packets):
+    """CODEC_OPUS_BUNDLE audio carrying packets (at most 255)."""
+    return bytes((len(packets),)) + b''.join(BUNDLE_LENGTH.pack(len(p)) + p for p in packets)
+
+
+def unpack_bundle(audio):
+    """[Opus packet] from CODEC_OPUS_BUNDLE audio, or None if it is malformed."""
+    if not audio:
+        return None
+    packets = []
+    pos = 1
+    for _ in range(audio[0]):
+        if pos + BUNDLE_LENGTH.size > len(audio):
+            return None
+        size = BUNDLE_LENGTH.unpack_from(audio, pos)[0]
+        pos += BUNDLE_LENGTH.size
+        if pos + size > len(audio):
+            return None
+        packets.append(bytes(audio[pos:pos + size]))
+        pos += size
+    return packets
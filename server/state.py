@@ -1,47 +1,227 @@
+import os
 import threading
+import time
+from server.protocol import SPEAKER_ID, MIX_SPEAKER_ID
 
 
 class ServerState:
-    """Global mutable server state, protected by lock."""
+    """Global mutable server state, protected by lock.
+
+    Besides the per-socket dicts, two indexes are kept up to date by every
+    add_*/remove_*/set_channel so channel and username lookups never scan
+    all connected clients:
+        channel_members  {channel: {username: None}}  (insertion-ordered set)
+        user_sockets     {username: {"text": sock|None, "voice": sock|None}}
+
+    Everything sent to a logged-in text client goes through its
+    TextSendQueue, whose writer alone writes to the socket. Presence changes
+    (login, logout, channel moves) and queueing their PRESENCE delta happen
+    together under presence_lock, which also orders presence_seq; it is
+    always taken before lock, never while holding it. Nothing is sent while
+    it is held.
+
+    For the voice hot path, voice_rosters maps each channel to an immutable
+    tuple of (voice socket, voice info) pairs. Membership changes build a new
+    tuple under the lock and swap it in; relay threads read it without locking.
+
+    Each voice session also gets a 16-bit speaker ID (speaker_ids), which
+    compact voice frames carry instead of the nickname.
+    """
 
     def __init__(self):
         self.lock = threading.Lock()
-        # {socket: {"username": str, "channel": str|None}}
+        # {socket: {"username": str, "channel": str|None, "queue": TextSendQueue}}
         self.text_clients = {}
-        # {socket: {"username": str, "channel": str|None}}
+        # {socket: {"username": str, "channel": str|None, "udp_addr": tuple|None, ...}}
         self.voice_clients = {}
+        self.channel_members = {}
+        self.user_sockets = {}
+        self.voice_rosters = {}
+        self.speaker_ids = {}  # {speaker id: voice socket}
+        self.next_speaker_id = 1
+        # Server-mixed channels: {channel: ChannelMixer}, read without locking
+        self.mixers = {}
+        # {channel: ActiveSpeakers}, created by the relay on first use
+        self.active_speakers = {}
+        self.presence_lock = threading.Lock()
+        self.presence_seq = 0
+        # UDP voice: datagram socket (or asyncio transport), pending tokens, bound peers
+        self.udp_sock = None
+        self.udp_tokens = {}  # {token: username}
+        self.udp_peers = {}   # {addr: voice socket}
+
+    def _user_entry(self, username):
+        entry = self.user_sockets.get(username)
+        if entry is None:
+            entry = self.user_sockets[username] = {"text": None, "voice": None}
+        return entry
 
-    def add_text_client(self, sock, username):
+    def _release_user_entry(self, username, kind, sock):
+        entry = self.user_sockets.get(username)
+        if entry and entry[kind] is sock:
+            entry[kind] = None
+            if entry["text"] is None and entry["voice"] is None:
+                del self.user_sockets[username]
+
+    def _move_member(self, username, old_channel, new_channel):
+        if old_channel is not None:
+            members = self.channel_members.get(old_channel)
+            if members is not None:
+                members.pop(username, None)
+                if not members:
+                    del self.channel_members[old_channel]
+        if new_channel is not None:
+            self.channel_members.setdefault(new_channel, {})[username] = None
+
+    def _publish_roster(self, channel_name):
+        """Swap in a fresh voice roster snapshot for channel_name (lock held)."""
+        if channel_name is None:
+            return
+        users = self.user_sockets
+        roster = tuple(
+            (users[u]["voice"], self.voice_clients[users[u]["voice"]])
+            for u in self.channel_members.get(channel_name, ())
+            if users[u]["voice"] is not None
+        )
+        if roster:
+            self.voice_rosters[channel_name] = roster
+        else:
+            self.voice_rosters.pop(channel_name, None)
+
+    def _allocate_speaker_id(self):
+        """Next free speaker ID (lock held). IDs cycle through 1..65534, so a
+        freed ID is not handed out again while peers may still map it;
+        65535 is MIX_SPEAKER_ID."""
+        for _ in range(MIX_SPEAKER_ID - 1):
+            speaker_id = self.next_speaker_id
+            self.next_speaker_id = speaker_id % (MIX_SPEAKER_ID - 1) + 1
+            if speaker_id not in self.speaker_ids:
+                return speaker_id
+        raise RuntimeError("no free speaker IDs")
+
+    def add_text_client(self, sock, username, queue):
+        """Register a logged-in text connection with its outbound TextSendQueue."""
         with self.lock:
-            self.text_clients[sock] = {"username": username, "channel": None}
+            self.text_clients[sock] = {"username": username, "channel": None, "queue": queue}
+            self._user_entry(username)["text"] = sock
 
     def remove_text_client(self, sock):
         with self.lock:
             info = self.text_clients.pop(sock, None)
+            if info:
+                self._move_member(info["username"], info["channel"], None)
+                self._release_user_entry(info["username"], "text", sock)
+                self._publish_roster(info["channel"])
             return info
 
-    def add_voice_client(self, sock, username):
+    def add_voice_client(self, sock, username, queue, compact=False, framing=None):
+        """Register a voice connection with its outbound VoiceSendQueue.
+
+        If the user already joined a channel over text, the voice session
+        starts out in that channel. compact selects the payload format this
+        client receives; framing is the (frame ms, frames per packet) it
+        negotiated, None if it didn't (it then only receives single frames).
+        Returns the session's speaker ID.
+        """
         with self.lock:
-            self.voice_clients[sock] = {"username": username, "channel": None}
+            entry = self._user_entry(username)
+            text_info = self.text_clients.get(entry["text"])
+            speaker_id = self._allocate_speaker_id()
+            nick = username.encode('utf-8')
+            self.voice_clients[sock] = {
+                "username": username,
+                "channel": text_info["channel"] if text_info else None,
+                "queue": queue, "udp_addr": None, "udp_seen": 0.0, "tx_seq": 0,
+                "compact": compact, "framing": framing, "split_seq": 0,
+                "speaker_id": speaker_id,
+                # Prebuilt payload prefixes for both formats
+                "speaker_tag": SPEAKER_ID.pack(speaker_id),
+                "nick_tag": SPEAKER_ID.pack(len(nick)) + nick,
+            }
+            self.speaker_ids[speaker_id] = sock
+            entry["voice"] = sock
+            self._publish_roster(self.voice_clients[sock]["channel"])
+            return speaker_id
 
     def remove_voice_client(self, sock):
         with self.lock:
-            return self.voice_clients.pop(sock, None)
+            info = self.voice_clients.pop(sock, None)
+            if info:
+                self._release_user_entry(info["username"], "voice", sock)
+                self._publish_roster(info["channel"])
+                del self.speaker_ids[info["speaker_id"]]
+                if info["udp_addr"]:
+                    self.udp_peers.pop(info["udp_addr"], None)
+                for token in [t for t, u in self.udp_tokens.items() if u == info["username"]]:
+                    del self.udp_tokens[token]
+            return info
+
+    def get_voice_queue_stats(self):
+        """Outbound queue counters per voice connection: {username: {queued, sent, dropped, pending}}."""
+        with self.lock:
+            infos = list(self.voice_clients.values())
+        return {info["username"]: info["queue"].stats() for info in infos}
+
+    def issue_udp_token(self, username):
+        """Create a one-time token binding a UDP address to username's voice session."""
+        token = os.urandom(8).hex()
+        with self.lock:
+            self.udp_tokens[token] = username
+        return token
+
+    def bind_udp_peer(self, token, addr):
+        """Attach a UDP address to the voice session that owns token.
+
+        Returns the voice socket, or None if the token is unknown or the user
+        has no voice connection yet (the client retries HELLO).
+        """
+        with self.lock:
+            username = self.udp_tokens.get(token)
+            entry = self.user_sockets.get(username)
+            if entry is None or entry["voice"] is None:
+                return None
+            vs = entry["voice"]
+            vinfo = self.voice_clients[vs]
+            del self.udp_tokens[token]
+            if vinfo["udp_addr"]:
+                self.udp_peers.pop(vinfo["udp_addr"], None)
+            vinfo["udp_addr"] = addr
+            vinfo["udp_seen"] = time.monotonic()
+            self.udp_peers[addr] = vs
+            return vs
+
+    def touch_udp_peer(self, addr):
+        """Refresh a bound UDP peer. Returns its voice socket or None."""
+        sock = self.udp_peers.get(addr)
+        if sock is not None:
+            info = self.voice_clients.get(sock)
+            if info:
+                info["udp_seen"] = time.monotonic()
+        return sock
 
     def set_channel(self, sock, channel_name):
         """Set the channel for a text client and its linked voice client."""
         with self.lock:
-            if sock in self.text_clients:
-                self.text_clients[sock]["channel"] = channel_name
+            info = self.text_clients.get(sock)
+            if not info:
+                return
+            username = info["username"]
+            old_channel = info["channel"]
+            self._move_member(username, old_channel, channel_name)
+            info["channel"] = channel_name
             # Also update voice client for same username
-            username = None
-            if sock in self.text_clients:
-                username = self.text_clients[sock]["username"]
-            if username:
-                for vs, vinfo in self.voice_clients.items():
-                    if vinfo["username"] == username:
-                        vinfo["channel"] = channel_name
-                        break
+            vs = self.user_sockets[username]["voice"]
+            if vs is not None:
+                self.voice_clients[vs]["channel"] = channel_name
+                if old_channel != channel_name:
+                    self._publish_roster(old_channel)
+                self._publish_roster(channel_name)
+
+    def get_text_socket(self, username):
+        """username's text socket, or None if not logged in."""
+        with self.lock:
+            entry = self.user_sockets.get(username)
+            return entry["text"] if entry else None
 
     def get_channel(self, sock):
         with self.lock:
@@ -63,30 +243,66 @@ class ServerState:
 
     def get_users_in_channel(self, channel_name):
         with self.lock:
-            return [
-                info["username"]
-                for info in self.text_clients.values()
-                if info.get("channel") == channel_name
-            ]
+            return list(self.channel_members.get(channel_name, ()))
 
     def get_text_sockets_in_channel(self, channel_name):
         with self.lock:
-            return [
-                sock for sock, info in self.text_clients.items()
-                if info.get("channel") == channel_name
-            ]
+            users = self.user_sockets
+            return [users[u]["text"] for u in self.channel_members.get(channel_name, ())]
 
     def get_voice_sockets_in_channel(self, channel_name):
         with self.lock:
+            users = self.user_sockets
             return [
-                sock for sock, info in self.voice_clients.items()
-                if info.get("channel") == channel_name
+                users[u]["voice"] for u in self.channel_members.get(channel_name, ())
+                if users[u]["voice"] is not None
             ]
 
+    def get_voice_roster(self, channel_name):
+        """Lock-free snapshot of ((voice socket, voice info), ...) in a channel."""
+        return self.voice_rosters.get(channel_name, ())
+
+    def get_speaker_id(self, username):
+        """Speaker ID of username's current voice session, or None."""
+        with self.lock:
+            entry = self.user_sockets.get(username)
+            if entry is None or entry["voice"] is None:
+                return None
+            return self.voice_clients[entry["voice"]]["speaker_id"]
+
+    def get_presence_snapshot(self):
+        """{"online": [usernames], "members": {channel: [usernames]}, "voice": {username: speaker id}}"""
+        with self.lock:
+            return {
+                "online": [info["username"] for info in self.text_clients.values()],
+                "members": {ch: list(members) for ch, members in self.channel_members.items()},
+                "voice": {
+                    u: self.voice_clients[entry["voice"]]["speaker_id"]
+                    for u, entry in self.user_sockets.items() if entry["voice"] is not None
+                },
+            }
+
     def get_all_text_sockets(self):
         with self.lock:
             return list(self.text_clients.keys())
 
+    def get_text_queues(self, exclude_sock=None, channel_name=None):
+        """Outbound TextSendQueues of the logged-in clients (in channel_name,
+        if given) but exclude_sock."""
+        with self.lock:
+            if channel_name is None:
+                socks = self.text_clients
+            else:
+                users = self.user_sockets
+                socks = [users[u]["text"] for u in self.channel_members.get(channel_name, ())]
+            return [self.text_clients[sock]["queue"] for sock in socks if sock is not exclude_sock]
+
+    def get_text_queue(self, sock):
+        with self.lock:
+            info = self.text_clients.get(sock)
+            return info["queue"] if info else None
+
     def is_username_online(self, username):
         with self.lock:
-            return any(info["username"] == username for info in self.text_clients.values())
+            entry = self.user_sockets.get(username)
+            return entry is not None and entry["text"] is not None
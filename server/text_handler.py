@@ -1,41 +1,40 @@
+import json
 import socket
 import threading
 import struct
 from server.protocol import (
-    send_line, parse_command,
+    send_line, send_bytes, encode_line, parse_command, LineReader,
     CMD_REGISTER, CMD_LOGIN, CMD_CREATE_CHANNEL, CMD_DELETE_CHANNEL,
     CMD_JOIN_CHANNEL, CMD_LEAVE_CHANNEL, CMD_MSG, CMD_TYPING, CMD_PING,
     RESP_REG_OK, RESP_REG_FAIL, RESP_AUTH_OK, RESP_AUTH_FAIL,
     EVT_CHANNEL_CREATED, EVT_CHANNEL_DELETED, EVT_CHANNEL_DELETE_FAIL,
     EVT_USER_JOINED_CHANNEL, EVT_USER_LEFT_CHANNEL, EVT_CHANNEL_LIST,
-    EVT_CHANNEL_USERS, EVT_USERLIST, EVT_SYSTEM, RESP_PONG,
+    EVT_SYSTEM, RESP_PONG,
+    CMD_VOICE_UDP, RESP_VOICE_UDP, RESP_VOICE_UDP_FAIL, CMD_VOICE_REPORT,
+    EVT_STATE, EVT_PRESENCE, CMD_PRESENCE_RESYNC,
+    PRESENCE_ONLINE, PRESENCE_OFFLINE, PRESENCE_MOVE, PRESENCE_VOICE,
 )
+from server.config import TEXT_QUEUE_BYTES
+from server.text_queue import TextSendQueue
 
 
-def broadcast_text(state, message, exclude_sock=None, channel=None):
-    """Send text message to all authenticated clients, optionally filtered by channel."""
-    if channel:
-        sockets = state.get_text_sockets_in_channel(channel)
-    else:
-        sockets = state.get_all_text_sockets()
+def queue_line(queues, message):
+    """Encode message once and queue the same buffer on every TextSendQueue."""
+    data = encode_line(message)
+    for queue in queues:
+        queue.put(data)
 
-    for sock in sockets:
-        if sock != exclude_sock:
-            try:
-                send_line(sock, message)
-            except Exception:
-                pass
 
+def send_text(state, sock, message):
+    """Queue message for one logged-in client; dropped if it has left."""
+    queue = state.get_text_queue(sock)
+    if queue is not None:
+        queue.put(encode_line(message))
 
-def send_userlist(state):
-    """Send the online user list to all clients."""
-    users = state.get_all_usernames()
-    msg = f"{EVT_USERLIST}:{','.join(users)}"
-    for sock in state.get_all_text_sockets():
-        try:
-            send_line(sock, msg)
-        except Exception:
-            pass
+
+def broadcast_text(state, message, exclude_sock=None, channel=None):
+    """Send text message to all authenticated clients, optionally filtered by channel."""
+    queue_line(state.get_text_queues(exclude_sock, channel), message)
 
 
 def send_channel_list(state, channel_mgr, sock=None):
@@ -43,187 +42,250 @@ def send_channel_list(state, channel_mgr, sock=None):
     names = channel_mgr.get_channel_names()
     msg = f"{EVT_CHANNEL_LIST}:{','.join(names)}"
     if sock:
+        send_text(state, sock, msg)
+    else:
+        queue_line(state.get_text_queues(), msg)
+
+
+def build_state_line(state, channel_mgr):
+    """STATE snapshot at the current presence sequence (presence_lock held)."""
+    snapshot = {"channels": channel_mgr.get_channel_names()}
+    snapshot.update(state.get_presence_snapshot())
+    return f"{EVT_STATE}:{state.presence_seq}:{json.dumps(snapshot, ensure_ascii=False, separators=(',', ':'))}"
+
+
+def publish_presence(state, op, username, detail=None, exclude_sock=None):
+    """Queue one presence delta under the next sequence number (presence_lock held).
+
+    detail is the channel for MOVE and the speaker ID for VOICE. Each
+    client's writer sends it once the lock is released.
+    """
+    state.presence_seq += 1
+    msg = f"{EVT_PRESENCE}:{state.presence_seq}:{op}:{username}"
+    if op in (PRESENCE_MOVE, PRESENCE_VOICE):
+        msg += f":{'' if detail is None else detail}"
+    queue_line(state.get_text_queues(exclude_sock), msg)
+
+
+def process_auth_line(client, line, auth_mgr, state):
+    """Handle one line of the authentication phase. Returns username on successful login.
+
+    AUTH_OK itself is sent by client_logged_in, together with STATE.
+    """
+    cmd, payload = parse_command(line)
+
+    if cmd == CMD_REGISTER:
+        parts = payload.split(":", 1)
+        if len(parts) != 2:
+            send_line(client, f"{RESP_REG_FAIL}:Неверный формат")
+            return None
+        username, password = parts
+        ok, err = auth_mgr.register(username, password)
+        if ok:
+            send_line(client, RESP_REG_OK)
+        else:
+            send_line(client, f"{RESP_REG_FAIL}:{err}")
+
+    elif cmd == CMD_LOGIN:
+        parts = payload.split(":", 1)
+        if len(parts) != 2:
+            send_line(client, f"{RESP_AUTH_FAIL}:Неверный формат")
+            return None
+        username, password = parts
+        if state.is_username_online(username):
+            send_line(client, f"{RESP_AUTH_FAIL}:Уже в сети")
+            return None
+        ok, err = auth_mgr.login(username, password)
+        if ok:
+            return username
+        send_line(client, f"{RESP_AUTH_FAIL}:{err}")
+
+    else:
+        send_line(client, f"{RESP_AUTH_FAIL}:Сначала войдите (LOGIN/REGISTER)")
+
+    return None
+
+
+def process_text_line(client, username, line, state, channel_mgr):
+    """Handle one protocol line from an authenticated client.
+
+    Everything it sends goes through the recipients' TextSendQueues.
+    """
+    cmd, payload = parse_command(line)
+
+    if cmd == CMD_MSG:
+        channel = state.get_channel(client)
+        if channel:
+            broadcast_text(state, f"{CMD_MSG}:{username}:{payload}",
+                           exclude_sock=client, channel=channel)
+
+    elif cmd == CMD_TYPING:
+        channel = state.get_channel(client)
+        if channel:
+            broadcast_text(state, f"{CMD_TYPING}:{username}",
+                           exclude_sock=client, channel=channel)
+
+    elif cmd == CMD_PING:
+        send_text(state, client, RESP_PONG)
+
+    elif cmd == CMD_VOICE_UDP:
+        if state.udp_sock is None:
+            send_text(state, client, RESP_VOICE_UDP_FAIL)
+        else:
+            send_text(state, client, f"{RESP_VOICE_UDP}:{state.issue_udp_token(username)}")
+
+    elif cmd == CMD_VOICE_REPORT:
+        parts = payload.split(":", 2)
         try:
-            send_line(sock, msg)
-        except Exception:
-            pass
+            loss, jitter = float(parts[0]), float(parts[1])
+            sender = parts[2]
+        except (ValueError, IndexError):
+            return
+        if not (0 <= loss <= 100 and 0 <= jitter <= 10000):  # also rejects nan
+            return
+        sender_sock = state.get_text_socket(sender)
+        channel = state.get_channel(client)
+        if sender_sock is not None and channel and state.get_channel(sender_sock) == channel:
+            send_text(state, sender_sock, f"{CMD_VOICE_REPORT}:{loss:g}:{jitter:g}:{username}")
+
+    elif cmd == CMD_CREATE_CHANNEL:
+        ok, err = channel_mgr.create_channel(payload)
+        if ok:
+            broadcast_text(state, f"{EVT_CHANNEL_CREATED}:{payload}")
+            send_channel_list(state, channel_mgr)
+        else:
+            send_text(state, client, f"{EVT_CHANNEL_DELETE_FAIL}:{err}")
+
+    elif cmd == CMD_DELETE_CHANNEL:
+        ok, err = channel_mgr.delete_channel(payload)
+        if ok:
+            # Move affected users to no channel
+            with state.presence_lock:
+                for s in state.get_text_sockets_in_channel(payload):
+                    member = state.get_username(s)
+                    state.set_channel(s, None)
+                    publish_presence(state, PRESENCE_MOVE, member, None)
+            broadcast_text(state, f"{EVT_CHANNEL_DELETED}:{payload}")
+            send_channel_list(state, channel_mgr)
+        else:
+            send_text(state, client, f"{EVT_CHANNEL_DELETE_FAIL}:{err}")
+
+    elif cmd == CMD_JOIN_CHANNEL:
+        if not channel_mgr.channel_exists(payload):
+            send_text(state, client, f"{EVT_SYSTEM}:Канал не найден")
+            return
+
+        old_channel = state.get_channel(client)
+        if old_channel:
+            broadcast_text(state, f"{EVT_USER_LEFT_CHANNEL}:{username}:{old_channel}")
+
+        with state.presence_lock:
+            state.set_channel(client, payload)
+            publish_presence(state, PRESENCE_MOVE, username, payload)
+        broadcast_text(state, f"{EVT_USER_JOINED_CHANNEL}:{username}:{payload}")
+
+    elif cmd == CMD_LEAVE_CHANNEL:
+        old_channel = state.get_channel(client)
+        if old_channel:
+            with state.presence_lock:
+                state.set_channel(client, None)
+                publish_presence(state, PRESENCE_MOVE, username, None)
+            broadcast_text(state, f"{EVT_USER_LEFT_CHANNEL}:{username}:{old_channel}")
+
+    elif cmd == CMD_PRESENCE_RESYNC:
+        # Queued with the deltas, so the snapshot lands in sequence order
+        with state.presence_lock:
+            send_text(state, client, build_state_line(state, channel_mgr))
+
     else:
-        for s in state.get_all_text_sockets():
-            try:
-                send_line(s, msg)
-            except Exception:
-                pass
+        send_text(state, client, f"{EVT_SYSTEM}:Неизвестная команда")
+
+
+def client_logged_in(client, username, queue, state, channel_mgr):
+    """Register an authenticated client and announce it to everyone.
+
+    The others get an ONLINE delta; the new client gets AUTH_OK and the STATE
+    snapshot at that same sequence number in a single write. queue is the
+    client's TextSendQueue, which from here on carries everything sent to
+    it; the engine starts its writer, the only one writing to the socket,
+    after this returns. Lines queued by others since add_text_client stay
+    behind the bootstrap.
+    """
+    with state.presence_lock:
+        state.add_text_client(client, username, queue)
+        publish_presence(state, PRESENCE_ONLINE, username, exclude_sock=client)
+        queue.put(encode_line(RESP_AUTH_OK) + encode_line(build_state_line(state, channel_mgr)), first=True)
+    print(f"{username} вошёл в систему")
+    broadcast_text(state, f"{EVT_SYSTEM}:{username} присоединился!", exclude_sock=client)
+
+
+def client_logged_out(client, username, state):
+    """Unregister a disconnected client, close it and notify the others."""
+    with state.presence_lock:
+        info = state.remove_text_client(client)
+        publish_presence(state, PRESENCE_OFFLINE, username)
+    if info:
+        info["queue"].close()
+    try:
+        client.close()
+    except Exception:
+        pass
 
+    broadcast_text(state, f"{EVT_SYSTEM}:{username} покинул чат")
+    print(f"{username} отключился")
 
-def send_channel_users(state, channel_name, sock=None):
-    """Send user list for a specific channel."""
-    users = state.get_users_in_channel(channel_name)
-    msg = f"{EVT_CHANNEL_USERS}:{channel_name}:{','.join(users)}"
-    if sock:
+
+def drain_text_queue(sock, queue):
+    """Writer thread for one text connection's TextSendQueue (threaded engine)."""
+    while True:
+        data = queue.get()
+        if data is None:
+            break
         try:
-            send_line(sock, msg)
+            send_bytes(sock, data)
         except Exception:
-            pass
-    else:
-        # Send to all clients so everyone sees the update
-        for s in state.get_all_text_sockets():
-            try:
-                send_line(s, msg)
-            except Exception:
-                pass
+            break
+        queue.sent()
 
 
 def handle_auth(client, auth_mgr, state):
-    """Handle authentication phase. Returns username on success, None on failure."""
-    buffer = ""
+    """Handle authentication phase. Returns (username, reader) on success, None on failure."""
+    reader = LineReader(client)
     while True:
         try:
-            data = client.recv(4096).decode('utf-8')
-            if not data:
+            line = reader.read_line()
+            if line is None:
                 return None
 
-            buffer += data
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                line = line.strip()
-                if not line:
-                    continue
-
-                cmd, payload = parse_command(line)
-
-                if cmd == CMD_REGISTER:
-                    parts = payload.split(":", 1)
-                    if len(parts) != 2:
-                        send_line(client, f"{RESP_REG_FAIL}:Неверный формат")
-                        continue
-                    username, password = parts
-                    ok, err = auth_mgr.register(username, password)
-                    if ok:
-                        send_line(client, RESP_REG_OK)
-                    else:
-                        send_line(client, f"{RESP_REG_FAIL}:{err}")
-
-                elif cmd == CMD_LOGIN:
-                    parts = payload.split(":", 1)
-                    if len(parts) != 2:
-                        send_line(client, f"{RESP_AUTH_FAIL}:Неверный формат")
-                        continue
-                    username, password = parts
-                    if state.is_username_online(username):
-                        send_line(client, f"{RESP_AUTH_FAIL}:Уже в сети")
-                        continue
-                    ok, err = auth_mgr.login(username, password)
-                    if ok:
-                        send_line(client, RESP_AUTH_OK)
-                        return username, buffer
-                    else:
-                        send_line(client, f"{RESP_AUTH_FAIL}:{err}")
-
-                else:
-                    send_line(client, f"{RESP_AUTH_FAIL}:Сначала войдите (LOGIN/REGISTER)")
+            username = process_auth_line(client, line, auth_mgr, state)
+            if username:
+                return username, reader
 
         except Exception:
             return None
 
 
-def handle_text_client(client, username, init_buffer, state, auth_mgr, channel_mgr):
-    """Handle messages from an authenticated client."""
-    buffer = init_buffer
+def handle_text_client(client, username, reader, queue, state, auth_mgr, channel_mgr):
+    """Handle messages from an authenticated client.
+
+    reader is the LineReader from handle_auth; it may already hold lines.
+    The next line is read only once the client's own queue is below half
+    of TEXT_QUEUE_BYTES, so it can't outrun its writer.
+    """
     while True:
         try:
-            data = client.recv(4096).decode('utf-8')
-            if not data:
+            line = reader.read_line()
+            if line is None:
                 break
 
-            buffer += data
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                line = line.strip()
-                if not line:
-                    continue
-
-                cmd, payload = parse_command(line)
-
-                if cmd == CMD_MSG:
-                    channel = state.get_channel(client)
-                    if channel:
-                        broadcast_text(state, f"{CMD_MSG}:{username}:{payload}",
-                                       exclude_sock=client, channel=channel)
-
-                elif cmd == CMD_TYPING:
-                    channel = state.get_channel(client)
-                    if channel:
-                        broadcast_text(state, f"{CMD_TYPING}:{username}",
-                                       exclude_sock=client, channel=channel)
-
-                elif cmd == CMD_PING:
-                    send_line(client, RESP_PONG)
-
-                elif cmd == CMD_CREATE_CHANNEL:
-                    ok, err = channel_mgr.create_channel(payload)
-                    if ok:
-                        broadcast_text(state, f"{EVT_CHANNEL_CREATED}:{payload}")
-                        send_channel_list(state, channel_mgr)
-                    else:
-                        send_line(client, f"{EVT_CHANNEL_DELETE_FAIL}:{err}")
-
-                elif cmd == CMD_DELETE_CHANNEL:
-                    # Move users from deleted channel to General
-                    old_users = state.get_users_in_channel(payload)
-                    ok, err = channel_mgr.delete_channel(payload)
-                    if ok:
-                        # Move affected users to no channel
-                        for s in state.get_all_text_sockets():
-                            if state.get_channel(s) == payload:
-                                state.set_channel(s, None)
-                        broadcast_text(state, f"{EVT_CHANNEL_DELETED}:{payload}")
-                        send_channel_list(state, channel_mgr)
-                    else:
-                        send_line(client, f"{EVT_CHANNEL_DELETE_FAIL}:{err}")
-
-                elif cmd == CMD_JOIN_CHANNEL:
-                    if not channel_mgr.channel_exists(payload):
-                        send_line(client, f"{EVT_SYSTEM}:Канал не найден")
-                        continue
-
-                    old_channel = state.get_channel(client)
-                    if old_channel:
-                        state.set_channel(client, None)
-                        broadcast_text(state, f"{EVT_USER_LEFT_CHANNEL}:{username}:{old_channel}")
-                        send_channel_users(state, old_channel)
-
-                    state.set_channel(client, payload)
-                    broadcast_text(state, f"{EVT_USER_JOINED_CHANNEL}:{username}:{payload}")
-                    send_channel_users(state, payload)
-                    if old_channel and old_channel != payload:
-                        send_channel_users(state, old_channel)
-
-                elif cmd == CMD_LEAVE_CHANNEL:
-                    old_channel = state.get_channel(client)
-                    if old_channel:
-                        state.set_channel(client, None)
-                        broadcast_text(state, f"{EVT_USER_LEFT_CHANNEL}:{username}:{old_channel}")
-                        send_channel_users(state, old_channel)
-
-                else:
-                    send_line(client, f"{EVT_SYSTEM}:Неизвестная команда")
+            process_text_line(client, username, line, state, channel_mgr)
+            queue.wait_below(TEXT_QUEUE_BYTES // 2)
 
         except Exception:
             break
 
     # Client disconnected
-    old_channel = state.get_channel(client)
-    state.remove_text_client(client)
-    try:
-        client.close()
-    except Exception:
-        pass
-
-    broadcast_text(state, f"{EVT_SYSTEM}:{username} покинул чат")
-    send_userlist(state)
-    if old_channel:
-        send_channel_users(state, old_channel)
-    print(f"{username} отключился")
+    client_logged_out(client, username, state)
 
 
 def accept_text_clients(text_server, state, auth_mgr, channel_mgr):
@@ -242,13 +304,11 @@ def accept_text_clients(text_server, state, auth_mgr, channel_mgr):
                         pass
                     return
 
-                username, remaining_buffer = result
-                state.add_text_client(c, username)
-                print(f"{username} вошёл в систему")
-                broadcast_text(state, f"{EVT_SYSTEM}:{username} присоединился!", exclude_sock=c)
-                send_userlist(state)
-                send_channel_list(state, channel_mgr, sock=c)
-                handle_text_client(c, username, remaining_buffer, state, auth_mgr, channel_mgr)
+                username, reader = result
+                queue = TextSendQueue()
+                client_logged_in(c, username, queue, state, channel_mgr)
+                threading.Thread(target=drain_text_queue, args=(c, queue), daemon=True).start()
+                handle_text_client(c, username, reader, queue, state, auth_mgr, channel_mgr)
 
             t = threading.Thread(target=client_thread, daemon=True)
             t.start()
@@ -0,0 +1,94 @@
+import collections
+import threading
+from server.config import TEXT_QUEUE_BYTES
+
+
+class TextSendQueue:
+    """Outbound line queue owned by one logged-in text connection.
+
+    Every line sent to the client is put() here, starting with the login
+    bootstrap, and the engine's writer is the only one writing to the
+    socket, so lines never interleave. Presence deltas and STATE snapshots
+    are put() while presence_lock is held, so each client gets them in
+    presence_seq order, and sent after it is released: a client that
+    stopped reading stalls only its own writer. Past maxbytes queued (and
+    being written), the oldest lines are dropped; if one was a delta, the
+    client sees the gap in presence_seq and asks for a RESYNC.
+
+    notify, if set, is called after every put (the asyncio engine uses it to
+    flush the queue on its loop from any thread).
+    """
+
+    def __init__(self, maxbytes=TEXT_QUEUE_BYTES):
+        self.maxbytes = maxbytes
+        self.lines = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.notify = None
+        self.pending = 0  # bytes queued or handed to the writer and not yet sent
+        self.writing = 0
+        self.dropped = 0
+
+    def put(self, data, first=False):
+        """Queue data; first puts it ahead of everything queued so far (the
+        login bootstrap, before the writer starts)."""
+        with self.cond:
+            if self.closed:
+                return
+            if first:
+                self.lines.appendleft(data)
+            else:
+                self.lines.append(data)
+            self.pending += len(data)
+            while self.pending > self.maxbytes and len(self.lines) > 1:
+                self.pending -= len(self.lines.popleft())
+                self.dropped += 1
+            self.cond.notify_all()
+        if self.notify:
+            self.notify()
+
+    def pop_all(self):
+        """Everything queued as one buffer, or None, without blocking (for
+        writes that never block: it counts as sent)."""
+        with self.cond:
+            data = self._take()
+            self.sent()
+            return data
+
+    def get(self):
+        """Block until something is queued and return it all; call sent()
+        once it is written. None once closed."""
+        with self.cond:
+            while not self.closed:
+                data = self._take()
+                if data is not None:
+                    return data
+                self.cond.wait()
+            return None
+
+    def sent(self):
+        """The buffer from get() is written."""
+        with self.cond:
+            self.pending -= self.writing
+            self.writing = 0
+            self.cond.notify_all()
+
+    def wait_below(self, limit):
+        """Block while more than limit bytes are pending (and not closed)."""
+        with self.cond:
+            while not self.closed and self.pending > limit:
+                self.cond.wait()
+
+    def _take(self):
+        if not self.lines:
+            return None
+        data = b''.join(self.lines)
+        self.lines.clear()
+        self.writing = len(data)
+        return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.lines.clear()
+            self.cond.notify_all()
@@ -1,62 +1,427 @@
 import socket
 import threading
 import struct
-from server.protocol import CODEC_OPUS
+import time
+from server.protocol import (
+    CODEC_OPUS, CODEC_OPUS_BUNDLE, CODEC_SPURT_END, UDP_HELLO, UDP_HELLO_ACK, UDP_VOICE, UDP_HEADER,
+    VOICE_COMPACT_PREFIX, VOICE_FRAMING_PREFIX, SPEAKER_ID, AUDIO_HEADER, PRESENCE_VOICE,
+    build_udp_datagram, parse_udp_datagram, timestamp_ms,
+    format_framing, parse_framing, unpack_bundle,
+)
+from server.config import (
+    MAX_VOICE_FRAME, UDP_PEER_TIMEOUT, FORWARD_LOUDEST, VOICE_STATS_INTERVAL,
+    VOICE_FRAME_DURATIONS, VOICE_MAX_PACKET_MS,
+)
+from server.active_speakers import ActiveSpeakers
+from server.text_handler import publish_presence
+from server.voice_queue import VoiceSendQueue
 
 
-def recv_exact(sock, n):
-    """Read exactly n bytes from socket."""
-    data = b''
-    while len(data) < n:
-        chunk = sock.recv(n - len(data))
-        if not chunk:
+FRAME_HEADER = struct.Struct('>I')
+
+
+class VoiceFrameBuffer:
+    """Reusable receive buffer that cuts length-prefixed voice frames.
+
+    The socket writes straight into writable() (recv_into, or an asyncio
+    BufferedProtocol's get_buffer); next_frame() returns each complete frame,
+    length header included, as a single bytes copy. That one object is what
+    every recipient queue shares: frames outlive this buffer in the queues,
+    so the buffer itself can't be handed out.
+
+    The buffer only grows (to fit one frame of up to max_frame) by being
+    replaced, never resized, since a transport may still hold a view of it.
+    """
+
+    def __init__(self, max_frame=MAX_VOICE_FRAME, bufsize=8192):
+        self.max_frame = max_frame
+        self.buf = bytearray(bufsize)
+        self.start = 0
+        self.end = 0
+
+    def _compact(self, size=0):
+        pending = self.end - self.start
+        if size > len(self.buf):
+            buf = bytearray(size)
+            buf[:pending] = self.buf[self.start:self.end]
+            self.buf = buf
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def writable(self):
+        """Free tail of the buffer to receive into."""
+        if self.end == len(self.buf):
+            self._compact()
+        return memoryview(self.buf)[self.end:]
+
+    def filled(self, n):
+        """Account for n bytes received into writable()."""
+        self.end += n
+
+    def next_frame(self):
+        """Pop the next complete frame (4-byte length + payload) as bytes, or None.
+
+        Raises ValueError for a frame longer than max_frame.
+        """
+        avail = self.end - self.start
+        if avail < 4:
             return None
-        data += chunk
-    return data
+        size = FRAME_HEADER.unpack_from(self.buf, self.start)[0]
+        if size > self.max_frame:
+            raise ValueError(f"voice frame of {size} bytes")
+        size += 4
+        if avail < size:
+            if self.start + size > len(self.buf):
+                self._compact(size)
+            return None
+        frame = bytes(memoryview(self.buf)[self.start:self.start + size])
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frame
+
+
+def relabel_payload(payload, sender_info, compact):
+    """The sender's voice payload in the legacy or compact format.
+
+    payload is a memoryview of the payload as the sender sent it; it is
+    returned as is when it already has the wanted format and speaker.
+    Returns None for a malformed legacy payload.
+    """
+    if sender_info["compact"]:
+        if compact:
+            if payload[:2] == sender_info["speaker_tag"]:
+                return payload
+            return sender_info["speaker_tag"] + payload[2:]
+        return sender_info["nick_tag"] + payload[2:]
+    if not compact:
+        return payload
+    if len(payload) < 2:
+        return None
+    skip = 2 + SPEAKER_ID.unpack_from(payload)[0]
+    if len(payload) < skip:
+        return None
+    return sender_info["speaker_tag"] + payload[skip:]
+
+
+def audio_offset(payload, compact):
+    """Offset of the [codec][audio_len] header in a voice payload, or None if it is cut short."""
+    if compact:
+        offset = 2
+    elif len(payload) >= 2:
+        offset = 2 + SPEAKER_ID.unpack_from(payload)[0]
+    else:
+        return None
+    return offset if len(payload) >= offset + AUDIO_HEADER.size else None
+
+
+def payload_codec(payload, compact):
+    """Codec byte of a voice payload, or None if it is cut short."""
+    offset = audio_offset(payload, compact)
+    return None if offset is None else payload[offset]
+
 
+def payload_level(payload, compact):
+    """Audio level byte at the end of a voice payload, or None if it has none."""
+    offset = audio_offset(payload, compact)
+    if offset is None:
+        return None
+    end = offset + AUDIO_HEADER.size + AUDIO_HEADER.unpack_from(payload, offset)[1]
+    return payload[end] if len(payload) > end else None
 
-def broadcast_voice(framed_data, sender_sock, state):
-    """Broadcast voice frame to all voice clients in the same channel as sender."""
+
+def split_bundle(payload, compact):
+    """A CODEC_OPUS_BUNDLE payload as one CODEC_OPUS payload per packet in it,
+    each with the same speaker prefix and audio level byte.
+
+    Returns None if payload carries no bundle or a malformed one.
+    """
+    offset = audio_offset(payload, compact)
+    if offset is None:
+        return None
+    codec, length = AUDIO_HEADER.unpack_from(payload, offset)
+    start = offset + AUDIO_HEADER.size
+    if codec != CODEC_OPUS_BUNDLE:
+        return None
+    packets = unpack_bundle(payload[start:start + length])
+    if not packets:
+        return None
+    prefix = bytes(payload[:offset])
+    level = bytes(payload[start + length:start + length + 1])
+    return [prefix + AUDIO_HEADER.pack(CODEC_OPUS, len(p)) + p + level for p in packets]
+
+
+def split_forms(body, compact, udp, sender_info):
+    """What a listener that didn't negotiate framing gets for body: one TCP
+    write of single-frame frames, or a list of datagrams. Datagrams are
+    numbered from the sender's split_seq, so those listeners see one
+    sequence per frame.
+    """
+    pieces = split_bundle(body, compact) or [body]
+    if not udp:
+        return b''.join(FRAME_HEADER.pack(len(piece)) + piece for piece in pieces)
+    timestamp = timestamp_ms()
+    datagrams = []
+    for piece in pieces:
+        seq = sender_info["split_seq"]
+        sender_info["split_seq"] = (seq + 1) & 0xFFFF
+        datagrams.append(build_udp_datagram(UDP_VOICE, seq, timestamp) + piece)
+    return datagrams
+
+
+def broadcast_voice(frame, sender_sock, state, datagram=None):
+    """Broadcast voice frame to all voice clients in the same channel as sender.
+
+    frame is the sender's TCP frame (4-byte length + payload) as bytes; a
+    sender on UDP passes its VOICE datagram as received instead, and frame
+    is None. Each recipient gets the payload in its own format (legacy or
+    compact, see protocol.py) over its own transport. Each of those forms is
+    built at most once, the one matching what the sender sent is relayed as
+    received, and the same object is queued for every recipient that needs
+    it; each recipient's writer does the I/O. Listeners that didn't
+    negotiate framing get a bundling sender's packets split into single
+    frames (split_forms).
+
+    Frames with an audio level are dropped unless the sender is one of the
+    channel's FORWARD_LOUDEST active speakers; a talk spurt end's level is
+    background noise, so it only needs the sender to hold its slot. In a
+    server-mixed channel the frame then goes to the channel's ChannelMixer
+    instead.
+    """
     sender_info = state.voice_clients.get(sender_sock)
     if not sender_info or not sender_info.get("channel"):
         return
-
     channel = sender_info["channel"]
-    targets = state.get_voice_sockets_in_channel(channel)
 
-    for sock in targets:
-        if sock != sender_sock:
+    if datagram is not None:
+        received, payload = datagram, memoryview(datagram)[UDP_HEADER.size:]
+    else:
+        received, payload = frame, memoryview(frame)[4:]
+    now = time.monotonic()
+    if FORWARD_LOUDEST:
+        level = payload_level(payload, sender_info["compact"])
+        if level is not None:
+            speakers = state.active_speakers.get(channel)
+            if speakers is None:
+                speakers = state.active_speakers.setdefault(channel, ActiveSpeakers())
+            if payload_codec(payload, sender_info["compact"]) == CODEC_SPURT_END:
+                if not speakers.holds(sender_sock):
+                    return
+            elif not speakers.admit(sender_sock, level, now):
+                return
+    mixer = state.mixers.get(channel)
+    if mixer is not None:
+        mixer.push(sender_sock, payload, sender_info["compact"])
+        return
+    framing = sender_info["framing"]
+    bundles = framing is not None and framing[1] > 1
+    forms = [None] * 8  # what to queue, by 4 * split + 2 * compact + udp
+    udp_header = None
+    for sock, info in state.get_voice_roster(channel):
+        if sock is sender_sock:
+            continue
+        udp = (info["udp_addr"] is not None and state.udp_sock is not None
+               and now - info["udp_seen"] < UDP_PEER_TIMEOUT)
+        split = bundles and info["framing"] is None
+        key = 4 * split + 2 * info["compact"] + udp
+        data = forms[key]
+        if data is None:
+            body = relabel_payload(payload, sender_info, info["compact"])
+            if body is None:
+                continue
+            if split:
+                data = split_forms(body, info["compact"], udp, sender_info)
+            elif body is payload and udp == (datagram is not None):
+                data = received
+            elif udp:
+                if udp_header is None:
+                    if datagram is not None:
+                        udp_header = datagram[:UDP_HEADER.size]
+                    else:
+                        seq = sender_info["tx_seq"]
+                        sender_info["tx_seq"] = (seq + 1) & 0xFFFF
+                        udp_header = build_udp_datagram(UDP_VOICE, seq, timestamp_ms())
+                data = udp_header + body
+            else:
+                data = FRAME_HEADER.pack(len(body)) + body
+            forms[key] = data
+        if split and udp:
+            for item in data:
+                info["queue"].put(item, info["udp_addr"])
+        elif udp:
+            info["queue"].put(data, info["udp_addr"])
+        else:
+            info["queue"].put(data)
+
+
+def send_queued_item(sock, data, udp_addr, state):
+    """Write one dequeued frame to its transport (blocking for TCP)."""
+    if udp_addr:
+        state.udp_sock.sendto(data, udp_addr)
+    else:
+        sock.sendall(data)
+
+
+def drain_voice_queue(sock, queue, state):
+    """Writer thread for one voice connection (threaded engine)."""
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        data, udp_addr = item
+        try:
+            send_queued_item(sock, data, udp_addr, state)
+        except Exception:
+            if not udp_addr:
+                break
+            continue
+        queue.mark_sent()
+
+
+def negotiate_framing(frame_ms, frames):
+    """The (frame ms, frames per packet) granted for a requested framing:
+    the nearest allowed duration, and no more frames than fit in
+    VOICE_MAX_PACKET_MS."""
+    if frame_ms not in VOICE_FRAME_DURATIONS:
+        frame_ms = min(VOICE_FRAME_DURATIONS, key=lambda ms: abs(ms - frame_ms))
+    return frame_ms, max(1, min(frames, VOICE_MAX_PACKET_MS // frame_ms))
+
+
+def register_voice_client(voice_client, handshake, queue, state):
+    """Register a voice connection from its handshake and announce its speaker ID.
+
+    handshake is the first thing the client sends: its username, prefixed
+    with VOICE_COMPACT_PREFIX if it speaks the compact frame format, and
+    before that with its framing request (see protocol.VOICE_FRAMING_PREFIX),
+    answered here ahead of any voice frame. Returns the username.
+    """
+    framing = None
+    if handshake.startswith(VOICE_FRAMING_PREFIX):
+        end = handshake.find(":", len(VOICE_FRAMING_PREFIX))
+        requested = parse_framing(handshake[:end]) if end > 0 else None
+        if requested:
+            framing = negotiate_framing(*requested)
+            handshake = handshake[end + 1:]
+            reply = format_framing(*framing).encode('ascii')
+            # Queued before the session is in any roster: nothing can overtake it
+            queue.put(FRAME_HEADER.pack(len(reply)) + reply)
+    compact = handshake.startswith(VOICE_COMPACT_PREFIX)
+    username = handshake[len(VOICE_COMPACT_PREFIX):] if compact else handshake
+    with state.presence_lock:
+        speaker_id = state.add_voice_client(voice_client, username, queue, compact, framing)
+        publish_presence(state, PRESENCE_VOICE, username, speaker_id)
+    return username
+
+
+def voice_client_closed(voice_client, state):
+    """Unregister a voice connection, stop its writer and report a lossy link."""
+    with state.presence_lock:
+        info = state.remove_voice_client(voice_client)
+        # A reconnect may already have registered a newer session for the user
+        if info and state.get_speaker_id(info["username"]) is None:
+            publish_presence(state, PRESENCE_VOICE, info["username"])
+    try:
+        voice_client.close()
+    except Exception:
+        pass
+    if info:
+        info["queue"].close()
+        stats = info["queue"].stats()
+        if stats["dropped"]:
+            print(f"Голос {info['username']}: отправлено {stats['sent']}, "
+                  f"отброшено {stats['dropped']} из {stats['queued']} кадров")
+
+
+def report_voice_queues(state, interval=VOICE_STATS_INTERVAL):
+    """Every interval seconds, print the voice connections whose outbound
+    queues dropped frames since the last report: a listener that can't keep up."""
+    last = {}
+    while True:
+        time.sleep(interval)
+        stats = state.get_voice_queue_stats()
+        lagging = []
+        for username, counts in stats.items():
+            before = last.get(username, 0)
+            if counts["dropped"] < before:  # a new connection since the last report
+                before = 0
+            if counts["dropped"] > before:
+                lagging.append(f"{username} +{counts['dropped'] - before} "
+                               f"(отправлено {counts['sent']}, в очереди {counts['pending']})")
+        last = {username: counts["dropped"] for username, counts in stats.items()}
+        if lagging:
+            print(f"Отброшены голосовые кадры: {'; '.join(lagging)}")
+
+
+def start_voice_queue_reports(state):
+    """Start the report_voice_queues thread, unless VOICE_STATS_INTERVAL is 0."""
+    if VOICE_STATS_INTERVAL:
+        threading.Thread(target=report_voice_queues, args=(state,), daemon=True).start()
+
+
+def handle_voice_datagram(data, addr, state):
+    """Handle one UDP datagram: HELLO binds/refreshes a peer, VOICE is relayed.
+
+    data may be a memoryview of the receive buffer; it is copied once, and
+    only for a VOICE datagram that gets relayed.
+    """
+    parsed = parse_udp_datagram(data)
+    if not parsed:
+        return
+    kind, seq, timestamp, body = parsed
+
+    if kind == UDP_HELLO:
+        sender_sock = state.touch_udp_peer(addr)
+        if sender_sock is None:
+            try:
+                token = bytes(body).decode('ascii')
+            except UnicodeDecodeError:
+                return
+            sender_sock = state.bind_udp_peer(token, addr)
+        if sender_sock is not None:
             try:
-                sock.send(framed_data)
+                state.udp_sock.sendto(build_udp_datagram(UDP_HELLO_ACK, seq, timestamp), addr)
             except Exception:
                 pass
 
+    elif kind == UDP_VOICE:
+        sender_sock = state.touch_udp_peer(addr)
+        if sender_sock is None or len(body) > MAX_VOICE_FRAME:
+            return
+        broadcast_voice(None, sender_sock, state, datagram=bytes(data))
+
+
+def serve_voice_udp(udp_sock, state):
+    """Receive loop for the UDP voice socket."""
+    state.udp_sock = udp_sock
+    buf = bytearray(UDP_HEADER.size + MAX_VOICE_FRAME)
+    view = memoryview(buf)
+    while True:
+        try:
+            n, addr = udp_sock.recvfrom_into(buf)
+        except OSError:
+            # ICMP port unreachable from a vanished peer surfaces here on some platforms
+            continue
+        handle_voice_datagram(view[:n], addr, state)
+
 
 def handle_voice_client(voice_client, state):
     """Handle voice data from a single client."""
+    frames = VoiceFrameBuffer()
     while True:
         try:
-            len_data = recv_exact(voice_client, 4)
-            if not len_data:
-                break
-            msg_len = struct.unpack('>I', len_data)[0]
-            if msg_len > 65536:
-                break
-            voice_data = recv_exact(voice_client, msg_len)
-            if not voice_data:
-                break
-
-            # Reframe: prepend the length header back for broadcasting
-            framed = struct.pack('>I', msg_len) + voice_data
-            broadcast_voice(framed, voice_client, state)
+            frame = frames.next_frame()
+            if frame is None:
+                n = voice_client.recv_into(frames.writable())
+                if not n:
+                    break
+                frames.filled(n)
+                continue
+            broadcast_voice(frame, voice_client, state)
         except Exception:
             break
 
-    state.remove_voice_client(voice_client)
-    try:
-        voice_client.close()
-    except Exception:
-        pass
+    voice_client_closed(voice_client, state)
 
 
 def accept_voice_clients(voice_server, state):
@@ -72,9 +437,11 @@ def accept_voice_clients(voice_server, state):
             except Exception:
                 nick_data = ""
 
-            state.add_voice_client(voice_client, nick_data)
+            queue = VoiceSendQueue()
+            nick_data = register_voice_client(voice_client, nick_data, queue, state)
             print(f"Голосовое подключение от {address} ({nick_data})")
 
+            threading.Thread(target=drain_voice_queue, args=(voice_client, queue, state), daemon=True).start()
             t = threading.Thread(target=handle_voice_client, args=(voice_client, state), daemon=True)
             t.start()
         except Exception as e:
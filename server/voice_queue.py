@@ -0,0 +1,87 @@
+import collections
+import threading
+import time
+from server.config import VOICE_QUEUE_FRAMES, VOICE_MAX_AGE
+
+
+class VoiceSendQueue:
+    """Bounded outbound frame queue owned by one voice connection.
+
+    broadcast_voice only put()s; the engine's writer drains it, so a slow
+    listener never stalls the sender's thread. When full, the oldest frame is
+    dropped; frames older than max_age are dropped when dequeued.
+
+    Items are (data, udp_addr): udp_addr is None for TCP frames.
+    notify, if set, is called after every put (the asyncio engine uses it to
+    wake its writer task from any thread).
+    """
+
+    def __init__(self, maxlen=VOICE_QUEUE_FRAMES, max_age=VOICE_MAX_AGE):
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self.frames = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.notify = None
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def put(self, data, udp_addr=None):
+        with self.cond:
+            if self.closed:
+                return
+            if len(self.frames) >= self.maxlen:
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append((time.monotonic(), data, udp_addr))
+            self.queued += 1
+            self.cond.notify()
+        if self.notify:
+            self.notify()
+
+    def _pop_fresh(self):
+        now = time.monotonic()
+        while self.frames:
+            queued_at, data, udp_addr = self.frames.popleft()
+            if now - queued_at <= self.max_age:
+                return data, udp_addr
+            self.dropped += 1
+        return None
+
+    def pop(self):
+        """Next fresh item or None, without blocking."""
+        with self.cond:
+            return self._pop_fresh()
+
+    def get(self):
+        """Block until a fresh item is available. Returns None once closed."""
+        with self.cond:
+            while not self.closed:
+                item = self._pop_fresh()
+                if item is not None:
+                    return item
+                self.cond.wait()
+            return None
+
+    def mark_sent(self):
+        with self.cond:
+            self.sent += 1
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            self.cond.notify_all()
+        if self.notify:
+            self.notify()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "queued": self.queued,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "pending": len(self.frames),
+            }